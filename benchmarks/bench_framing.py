@@ -0,0 +1,185 @@
+"""Framing codec versus the reader and writer it has replaced.
+
+Frames of 1 KB, 32 KB and 64 KB (the largest legacy frame) are sent
+over a socket pair. Reading is timed while another thread keeps the
+socket fed, writing while another thread keeps it drained. Peak memory
+is that of a single read or write of a frame that fits in the socket
+buffer.
+
+    python benchmarks/bench_framing.py
+"""
+import socket
+from threading import Thread
+
+from common import best_time, load_module, peak_memory, print_table
+
+
+framing = load_module("framing")
+
+FRAME_SIZES = (1024, 32768, 65535)
+FRAMES_PER_RUN = 200
+SOCKET_BUFFER_SIZE = 1 << 20
+
+
+class OldSockClient(object):
+    """Reading and writing as done before the framing codec."""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def _read_sock(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.recv(min(framing.CHUNK_SIZE, length - len(data)))
+            if chunk == b'':
+                return None
+
+            data += chunk
+
+        return data
+
+    def _write_sock(self, data):
+        total_sent = 0
+        while total_sent < len(data):
+            total_sent += self.sock.send(data[total_sent:])
+
+    def receive_message(self):
+        length_bytes = bytearray(self._read_sock(2))
+        length = length_bytes[0] * 256 + length_bytes[1]
+        return self._read_sock(length)
+
+    def send_message(self, message):
+        length = len(message)
+        length_bytes = bytes(bytearray((length // 256, length % 256)))
+        self._write_sock(length_bytes + message)
+
+
+class NewSockClient(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = framing.FrameReader(framing.LEGACY_HEADER)
+
+    def receive_message(self):
+        fields, message = self.reader.read_frame(self.sock)
+        return message
+
+    def send_message(self, message):
+        framing.write_frame(
+            self.sock, framing.LEGACY_HEADER, (len(message), ), message)
+
+
+def socket_pair():
+    a, b = socket.socketpair()
+    for sock in (a, b):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+    return a, b
+
+
+def feed(sock, frame, count):
+    for i in range(count):
+        sock.sendall(frame)
+
+
+def drain(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    while size:
+        size -= sock.recv_into(view[:min(size, len(buffer))])
+
+
+def time_reads(client_class, message_size):
+    frame = framing.LEGACY_HEADER.pack(message_size) + b'x' * message_size
+    sender, receiver = socket_pair()
+    client = client_class(receiver)
+
+    def run():
+        feeder = Thread(target=feed, args=(sender, frame, FRAMES_PER_RUN))
+        feeder.start()
+        for i in range(FRAMES_PER_RUN):
+            client.receive_message()
+
+        feeder.join()
+
+    try:
+        return best_time(run, number=1) / FRAMES_PER_RUN
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def time_writes(client_class, message_size):
+    message = b'x' * message_size
+    frame_size = framing.LEGACY_HEADER.size + message_size
+    sender, receiver = socket_pair()
+    client = client_class(sender)
+
+    def run():
+        drainer = Thread(
+            target=drain, args=(receiver, frame_size * FRAMES_PER_RUN))
+
+        drainer.start()
+        for i in range(FRAMES_PER_RUN):
+            client.send_message(message)
+
+        drainer.join()
+
+    try:
+        return best_time(run, number=1) / FRAMES_PER_RUN
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def read_peak_memory(client_class, message_size):
+    frame = framing.LEGACY_HEADER.pack(message_size) + b'x' * message_size
+    sender, receiver = socket_pair()
+    client = client_class(receiver)
+    try:
+        # Warm the reader up, so that its buffer is not counted
+        sender.sendall(frame)
+        client.receive_message()
+
+        sender.sendall(frame)
+        return peak_memory(client.receive_message)
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def write_peak_memory(client_class, message_size):
+    message = b'x' * message_size
+    sender, receiver = socket_pair()
+    client = client_class(sender)
+    try:
+        return peak_memory(lambda: client.send_message(message))
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def main():
+    rows = []
+    for message_size in FRAME_SIZES:
+        for name, client_class in (
+                ("old", OldSockClient), ("framing", NewSockClient)):
+
+            read_time = time_reads(client_class, message_size)
+            write_time = time_writes(client_class, message_size)
+            rows.append((
+                message_size,
+                name,
+                "{:.1f}".format(message_size / read_time / 1e6),
+                read_peak_memory(client_class, message_size),
+                "{:.1f}".format(message_size / write_time / 1e6),
+                write_peak_memory(client_class, message_size),
+            ))
+
+    print_table((
+        "frame bytes", "codec", "read MB/s", "read peak B",
+        "write MB/s", "write peak B",
+    ), rows)
+
+
+if __name__ == "__main__":
+    main()
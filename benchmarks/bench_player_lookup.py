@@ -0,0 +1,138 @@
+"""MOTDPlayerManager lookups by community ID: linear scan versus index.
+
+The SRCDS package can't be imported without Source.Python, so both
+managers are reproduced here with the same data structures the package
+uses: the old one scans every MOTDPlayer, the new one keeps dicts keyed
+by community ID and userid next to the index-keyed one. Every request
+the site makes (set_identity) costs one lookup; a tenth of them are for
+players who have left.
+
+    python benchmarks/bench_player_lookup.py
+"""
+from random import Random
+
+from common import best_time, print_table
+
+
+SLOT_COUNTS = (64, 128)
+LOOKUPS_PER_RUN = 10000
+MISS_RATIO = 0.1
+
+# Request rate the CPU share is calculated for
+REQUESTS_PER_SECOND = 10000
+
+BASE_COMMUNITYID = 76561197960265728
+
+
+class FakeMOTDPlayer(object):
+    def __init__(self, index, userid, communityid):
+        self.index = index
+        self.userid = userid
+        self.communityid = communityid
+
+
+class ScanningManager(dict):
+    """Lookup as done before the secondary indexes."""
+    def create(self, motd_player):
+        self[motd_player.index] = motd_player
+
+    def get_by_communityid(self, communityid):
+        for motd_player in self.values():
+            if motd_player.communityid == communityid:
+                return motd_player
+        return None
+
+    def get_many_by_communityid(self, communityids):
+        result = {}
+        for communityid in communityids:
+            motd_player = self.get_by_communityid(communityid)
+            if motd_player is not None:
+                result[communityid] = motd_player
+
+        return result
+
+
+class IndexedManager(dict):
+    def __init__(self):
+        super(IndexedManager, self).__init__()
+
+        self._by_communityid = {}
+        self._by_userid = {}
+
+    def create(self, motd_player):
+        self[motd_player.index] = motd_player
+        self._by_communityid[motd_player.communityid] = motd_player
+        self._by_userid[motd_player.userid] = motd_player
+
+    def get_by_communityid(self, communityid):
+        return self._by_communityid.get(communityid)
+
+    def get_many_by_communityid(self, communityids):
+        by_communityid = self._by_communityid
+        return {
+            communityid: by_communityid[communityid]
+            for communityid in communityids
+            if communityid in by_communityid
+        }
+
+
+def fill(manager, slot_count):
+    for index in range(1, slot_count + 1):
+        manager.create(FakeMOTDPlayer(
+            index, index + 100, str(BASE_COMMUNITYID + index)))
+
+
+def get_requests(slot_count, random):
+    requests = []
+    for i in range(LOOKUPS_PER_RUN):
+        if random.random() < MISS_RATIO:
+            requests.append(str(BASE_COMMUNITYID + slot_count + 1 + i))
+        else:
+            requests.append(
+                str(BASE_COMMUNITYID + random.randint(1, slot_count)))
+
+    return requests
+
+
+def main():
+    rows = []
+    for slot_count in SLOT_COUNTS:
+        requests = get_requests(slot_count, Random(slot_count))
+        everyone = [
+            str(BASE_COMMUNITYID + index)
+            for index in range(1, slot_count + 1)
+        ]
+
+        for name, manager_class in (
+                ("scan", ScanningManager), ("index", IndexedManager)):
+
+            manager = manager_class()
+            fill(manager, slot_count)
+
+            def lookups():
+                get = manager.get_by_communityid
+                for communityid in requests:
+                    get(communityid)
+
+            lookup_time = best_time(lookups, number=5) / LOOKUPS_PER_RUN
+            bulk_time = best_time(
+                lambda: manager.get_many_by_communityid(everyone), number=50)
+
+            rows.append((
+                slot_count,
+                name,
+                "{:.0f}".format(lookup_time * 1e9),
+                "{:.2f}".format(
+                    lookup_time * REQUESTS_PER_SECOND * 100),
+                "{:.1f}".format(bulk_time * 1e6),
+            ))
+
+    print_table((
+        "slots", "manager", "ns/lookup",
+        "% CPU @ {} req/s".format(REQUESTS_PER_SECOND),
+        "us/bulk lookup of all",
+    ), rows)
+
+
+if __name__ == "__main__":
+    main()
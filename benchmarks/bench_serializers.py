@@ -0,0 +1,110 @@
+"""Message serializers: encode and decode cost and bytes on the wire.
+
+Every codec encodes the same messages a page exchange is made of: a
+small receive_custom_data request, an answer with a top 10 table and a
+larger answer with a 64 player scoreboard. "json" is the stdlib codec the
+bridge fell back to before, "orjson" is JSONSerializer with orjson
+installed, "msgpack" is MsgpackSerializer. Needs orjson and msgpack for
+the full table, missing ones are skipped.
+
+    python benchmarks/bench_serializers.py
+"""
+from json import dumps, loads
+
+from common import best_time, load_module, print_table
+
+
+serializers = load_module("serializers")
+
+BASE_COMMUNITYID = 76561197960265728
+
+
+def get_messages():
+    request = {
+        'action': "receive_custom_data",
+        'custom_data': {'action': "top10", 'map': "de_dust2"},
+    }
+    top10 = {
+        'status': "OK",
+        'custom_data': {
+            'action': "top10",
+            'players': [
+                {
+                    'steamid': str(BASE_COMMUNITYID + i),
+                    'name': "Player {}".format(i),
+                    'kills': 1000 - i * 37,
+                    'deaths': 200 + i * 11,
+                    'accuracy': 0.5 - i / 100,
+                }
+                for i in range(10)
+            ],
+        },
+    }
+    scoreboard = {
+        'status': "OK",
+        'custom_data': {
+            'action': "scoreboard",
+            'round': 17,
+            'players': [
+                {
+                    'steamid': str(BASE_COMMUNITYID + i),
+                    'name': "Player {}".format(i),
+                    'team': i % 2 + 2,
+                    'score': i * 3,
+                    'ping': 20 + i,
+                    'alive': i % 3 != 0,
+                }
+                for i in range(64)
+            ],
+        },
+    }
+    return (
+        ("request", request),
+        ("top 10", top10),
+        ("scoreboard", scoreboard),
+    )
+
+
+class StdlibJSON(object):
+    """JSON as encoded before orjson and ujson were picked up."""
+    def encode(self, obj):
+        return dumps(obj).encode('utf-8')
+
+    def decode(self, message):
+        return loads(message.decode('utf-8'))
+
+
+def get_codecs():
+    codecs = [("json", StdlibJSON())]
+    if serializers.orjson is not None:
+        codecs.append(("orjson", serializers.JSONSerializer()))
+
+    if serializers.msgpack is not None:
+        codecs.append(("msgpack", serializers.MsgpackSerializer()))
+
+    return codecs
+
+
+def main():
+    rows = []
+    for message_name, message in get_messages():
+        for codec_name, codec in get_codecs():
+            encoded = codec.encode(message)
+            assert codec.decode(encoded) == message
+
+            encode_time = best_time(lambda: codec.encode(message), number=2000)
+            decode_time = best_time(lambda: codec.decode(encoded), number=2000)
+            rows.append((
+                message_name,
+                codec_name,
+                len(encoded),
+                "{:.2f}".format(encode_time * 1e6),
+                "{:.2f}".format(decode_time * 1e6),
+            ))
+
+    print_table(
+        ("message", "codec", "bytes", "encode us", "decode us"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Auth token engine versus the per-user code it has replaced.
+
+Times issuing one token, issuing tokens for a whole server at once
+(get_tokens), checking a token and generating a new salt.
+
+    python benchmarks/bench_tokens.py
+"""
+from hashlib import sha512
+import os
+from random import choice
+import string
+
+from common import best_time, load_module, print_table
+
+
+tokens = load_module("tokens")
+
+SERVER_ID = "my_server"
+PLUGIN_ID = "my_plugin"
+PAGE_ID = "my_page"
+SESSION_ID = 42
+SECRET_SALT = os.urandom(32)
+PLAYER_COUNT = 64
+STEAMIDS = [str(76561197960265728 + i) for i in range(PLAYER_COUNT)]
+
+SALT_CHARACTERS = string.ascii_letters + string.digits
+SALT_LENGTH = 64
+
+
+def old_get_token(salt, steamid):
+    return sha512(
+        (
+            salt +
+            SERVER_ID +
+            PLUGIN_ID +
+            steamid +
+            PAGE_ID +
+            str(SESSION_ID)
+        ).encode('ascii') + SECRET_SALT
+    ).hexdigest()
+
+
+def old_get_new_salt():
+    return ''.join([choice(SALT_CHARACTERS) for x in range(SALT_LENGTH)])
+
+
+def main():
+    engine = tokens.TokenEngine(SERVER_ID, SECRET_SALT)
+    salt = tokens.get_new_salt()
+    steamid = STEAMIDS[0]
+    requests = [(salt, steamid_, SESSION_ID) for steamid_ in STEAMIDS]
+    token = engine.get_token(salt, PLUGIN_ID, steamid, PAGE_ID, SESSION_ID)
+
+    assert token == old_get_token(salt, steamid)
+
+    cases = (
+        (
+            "issue token",
+            lambda: old_get_token(salt, steamid),
+            lambda: engine.get_token(
+                salt, PLUGIN_ID, steamid, PAGE_ID, SESSION_ID),
+        ),
+        (
+            "issue {} tokens".format(PLAYER_COUNT),
+            lambda: [old_get_token(salt, steamid_) for steamid_ in STEAMIDS],
+            lambda: engine.get_tokens(PLUGIN_ID, PAGE_ID, requests),
+        ),
+        (
+            "check token",
+            lambda: token == old_get_token(salt, steamid),
+            lambda: tokens.compare_tokens(token, engine.get_token(
+                salt, PLUGIN_ID, steamid, PAGE_ID, SESSION_ID)),
+        ),
+        (
+            "new salt",
+            old_get_new_salt,
+            tokens.get_new_salt,
+        ),
+    )
+
+    rows = []
+    for name, old, new in cases:
+        old_time = best_time(old, number=2000)
+        new_time = best_time(new, number=2000)
+        rows.append((
+            name,
+            "{:.2f}".format(old_time * 1e6),
+            "{:.2f}".format(new_time * 1e6),
+            "{:.2f}x".format(old_time / new_time),
+        ))
+
+    print_table(("operation", "old us", "engine us", "speedup"), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Lookup latency of motdplayer_users with and without the unique index.
+
+The table is created in an in-memory SQLite database, the same way the
+bridge defines it (the old table had no index at all), and filled with
+10k, 100k and 1M users spread over a few servers. Every lookup is the
+one the decorators make: by server ID and SteamID. Needs SQLAlchemy.
+
+    python benchmarks/bench_user_lookup.py
+"""
+from random import Random
+
+from sqlalchemy import (
+    Column, create_engine, Index, Integer, MetaData, select, String, Table)
+
+from common import best_time, print_table
+
+
+ROW_COUNTS = (10000, 100000, 1000000)
+LOOKUPS_PER_RUN = 200
+SERVER_IDS = ("server1", "server2", "server3", "server4")
+BASE_COMMUNITYID = 76561197960265728
+INSERT_BATCH_SIZE = 50000
+
+
+def create_table(indexed):
+    metadata = MetaData()
+    table = Table(
+        "motdplayer_users", metadata,
+        Column('id', Integer, primary_key=True),
+        Column('server_id', String(32)),
+        Column('steamid', String(32)),
+        Column('salt', String(64)),
+        Column('web_salt', String(64)),
+    )
+    if indexed:
+        Index("uq_motdplayer_users_server_id_steamid",
+              table.c.server_id, table.c.steamid, unique=True)
+
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    return engine, table
+
+
+def fill(engine, table, row_count):
+    salt = "x" * 64
+    with engine.begin() as connection:
+        for start in range(0, row_count, INSERT_BATCH_SIZE):
+            end = min(start + INSERT_BATCH_SIZE, row_count)
+            connection.execute(table.insert(), [
+                {
+                    'server_id': SERVER_IDS[i % len(SERVER_IDS)],
+                    'steamid': str(BASE_COMMUNITYID + i),
+                    'salt': salt,
+                    'web_salt': salt,
+                }
+                for i in range(start, end)
+            ])
+
+
+def main():
+    rows = []
+    for row_count in ROW_COUNTS:
+        random = Random(row_count)
+        users = []
+        for i in range(LOOKUPS_PER_RUN):
+            user_number = random.randrange(row_count)
+            users.append((
+                SERVER_IDS[user_number % len(SERVER_IDS)],
+                str(BASE_COMMUNITYID + user_number),
+            ))
+
+        for indexed in (False, True):
+            engine, table = create_table(indexed)
+            fill(engine, table, row_count)
+
+            with engine.connect() as connection:
+                def lookups():
+                    for server_id, steamid in users:
+                        connection.execute(
+                            select(table.c.salt, table.c.web_salt).where(
+                                table.c.steamid == steamid,
+                                table.c.server_id == server_id,
+                            )
+                        ).first()
+
+                # Scans are slow, so they're timed over fewer runs
+                lookup_time = best_time(
+                    lookups, number=1, repeat=3) / LOOKUPS_PER_RUN
+
+            engine.dispose()
+            rows.append((
+                row_count,
+                "unique index" if indexed else "none",
+                "{:.1f}".format(lookup_time * 1e6),
+            ))
+
+    print_table(("rows", "index", "us/lookup"), rows)
+
+
+if __name__ == "__main__":
+    main()
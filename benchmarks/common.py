@@ -0,0 +1,53 @@
+"""Helpers shared by the benchmarks.
+
+Benchmarks are standalone scripts (python benchmarks/<name>.py) that
+need nothing but the standard library and the optional packages they
+mention. Modules that don't depend on Flask or Source.Python are loaded
+straight from their files, so neither of them has to be installed.
+"""
+import importlib.util
+import os
+import timeit
+import tracemalloc
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FLASK_PACKAGE_DIR = os.path.join(REPO_DIR, "flask", "motdplayer")
+
+
+def load_module(name):
+    """Load motdplayer/<name>.py of the bridge as a standalone module."""
+    path = os.path.join(FLASK_PACKAGE_DIR, name + ".py")
+    spec = importlib.util.spec_from_file_location(
+        "motdplayer_" + name, path)
+
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_time(func, number, repeat=5):
+    """Return the best time (seconds) one call of func took."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def peak_memory(func):
+    """Return how many bytes func had allocated at most at once."""
+    tracemalloc.start()
+    try:
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+
+def print_table(headers, rows):
+    widths = [
+        max(len(str(value)) for value in column)
+        for column in zip(headers, *rows)
+    ]
+    for row in [headers] + list(rows):
+        print("  ".join(
+            str(value).rjust(width) for value, width in zip(row, widths)))
@@ -20,31 +20,128 @@ var MOTDPlayer = function (serverId, pluginId, pageId, steamid, authToken, sessi
 
     var loadingScreenNode;
     var authMethod = +/\/[\w\-]+\/\w+\/[\w\-]+\/\d+\/(1|2)\/\w+\/\d+\//g.exec(location.href)[1];
-    this.post = function (data, successCallback, errorCallback) {
-        ajaxPostJson("/" + serverId + "/" + pluginId + "/" + pageId + "/" + steamid + "/" + authMethod + "/" + authToken + "/" + sessionId + "/",
-            {
+
+    // Polls can only be made with a web token; ones started before the
+    // page got it wait here
+    var waitingForWebToken = [];
+
+    var setWebAuthToken = function (newAuthToken) {
+        authMethod = 2;
+        authToken = newAuthToken;
+
+        var waiting = waitingForWebToken;
+        waitingForWebToken = [];
+        for (var i=0; i<waiting.length; i++)
+            waiting[i]();
+    }
+
+    // Posts made within postBatchDelay ms (or while the previous posts are
+    // still on their way) are sent together as one request
+    var postBatchDelay = 10;
+    var postQueue = [];
+    var postTimer = null;
+    var postInProgress = false;
+
+    // cacheKey -> {hash: ..., data: ...} of the last answer to a post made
+    // with that cacheKey; server only resends custom_data if it has changed
+    var responseCache = {};
+
+    var getKnownHash = function (post) {
+        if (post.cacheKey === undefined)
+            return null;
+
+        var cached = responseCache[post.cacheKey];
+        return cached ? cached.hash : "";
+    }
+
+    var getCustomData = function (post, result) {
+        if (post.cacheKey === undefined)
+            return result['custom_data'];
+
+        if (result['not_modified'])
+            return responseCache[post.cacheKey].data;
+
+        responseCache[post.cacheKey] = {
+            hash: result['custom_data_hash'],
+            data: result['custom_data']
+        };
+        return result['custom_data'];
+    }
+
+    var sendPosts = function () {
+        postTimer = null;
+        if (postInProgress || !postQueue.length)
+            return;
+
+        var batch = postQueue;
+        postQueue = [];
+        postInProgress = true;
+
+        var request;
+        if (batch.length == 1)
+            request = {
                 action: "receive-custom-data",
-                custom_data: data
-            }, function (response) {
+                custom_data: batch[0].data,
+                custom_data_hash: getKnownHash(batch[0])
+            };
+        else
+            request = {
+                action: "receive-custom-data-batch",
+                custom_data_batch: batch.map(function (post) {
+                    return post.data;
+                }),
+                custom_data_hash_batch: batch.map(getKnownHash)
+            };
+
+        ajaxPostJson("/" + serverId + "/" + pluginId + "/" + pageId + "/" + steamid + "/" + authMethod + "/" + authToken + "/" + sessionId + "/",
+            request, function (response) {
+                postInProgress = false;
+
                 if (response['status'] == "OK") {
-                    authMethod = 2;
-                    authToken = response['web_auth_token'];
+                    setWebAuthToken(response['web_auth_token']);
 
                     if (loadingScreenNode) {
                         loadingScreenNode.parentNode.removeChild(loadingScreenNode);
                         loadingScreenNode = null;
                     }
 
-                    successCallback(response['custom_data']);
+                    var results = batch.length == 1 ? [response] : response['custom_data_batch'];
+                    for (var i=0; i<batch.length; i++)
+                        if (results[i]['status'] == "OK")
+                            batch[i].successCallback(getCustomData(batch[i], results[i]));
+                        else
+                            if (batch[i].errorCallback)
+                                batch[i].errorCallback(results[i]['status']);
                 }
                 else
-                    if (errorCallback)
-                        errorCallback(response['status']);
+                    for (var i=0; i<batch.length; i++)
+                        if (batch[i].errorCallback)
+                            batch[i].errorCallback(response['status']);
+
+                sendPosts();
             }, function () {
-                if (errorCallback)
-                    errorCallback("ERROR_AJAX_FAILURE");
+                postInProgress = false;
+
+                for (var i=0; i<batch.length; i++)
+                    if (batch[i].errorCallback)
+                        batch[i].errorCallback("ERROR_AJAX_FAILURE");
+
+                sendPosts();
             }
         );
+    }
+
+    this.post = function (data, successCallback, errorCallback, cacheKey) {
+        postQueue.push({
+            data: data,
+            successCallback: successCallback,
+            errorCallback: errorCallback,
+            cacheKey: cacheKey
+        });
+
+        if (!postTimer && !postInProgress)
+            postTimer = setTimeout(sendPosts, postBatchDelay);
+
         if (!loadingScreenNode) {
             loadingScreenNode = document.getElementsByTagName('body')[0].appendChild(document.createElement('div'));
             loadingScreenNode.classList.add('motdplayer-ajax-loading-screen');
@@ -57,9 +154,8 @@ var MOTDPlayer = function (serverId, pluginId, pageId, steamid, authToken, sessi
                 action: "retarget",
             }, function (response) {
                 if (response['status'] == "OK") {
-                    authMethod = 2;
-                    authToken = response['web_auth_token'];
                     pageId = newPageId;
+                    setWebAuthToken(response['web_auth_token']);
 
                     if (loadingScreenNode) {
                         loadingScreenNode.parentNode.removeChild(loadingScreenNode);
@@ -82,19 +178,119 @@ var MOTDPlayer = function (serverId, pluginId, pageId, steamid, authToken, sessi
         }
     }
 
+    // Poll errors that go away by themselves (e.g. SRCDS is restarting or
+    // has too many polls waiting already) are retried after a delay that
+    // doubles up to pollRetryMaxDelay ms
+    var pollRetryMinDelay = 500;
+    var pollRetryMaxDelay = 30000;
+    var transientPollErrors = [
+        "ERROR_SRCDS_UNAVAILABLE", "ERROR_SRCDS_FAILURE", "ERROR_AJAX_FAILURE"
+    ];
+
+    this.listen = function (callback, errorCallback) {
+        var retryDelay = pollRetryMinDelay;
+
+        var retry = function () {
+            setTimeout(poll, retryDelay);
+            retryDelay = Math.min(retryDelay * 2, pollRetryMaxDelay);
+        }
+
+        var poll = function () {
+            if (authMethod != 2) {
+                waitingForWebToken.push(poll);
+                return;
+            }
+
+            // Poll doesn't use up the token, and it doesn't get a new one
+            var pollAuthToken = authToken;
+            ajaxPostJson("/json/poll/" + serverId + "/" + pluginId + "/" + pageId + "/" + steamid + "/" + pollAuthToken + "/" + sessionId + "/",
+                {
+                    action: "poll",
+                }, function (response) {
+                    if (response['status'] == "OK") {
+                        retryDelay = pollRetryMinDelay;
+                        for (var key in response['custom_data']) {
+                            callback(response['custom_data']);
+                            break;
+                        }
+
+                        poll();
+                    }
+                    else if (transientPollErrors.indexOf(response['status']) != -1)
+                        retry();
+
+                    // Token was replaced by a post made while polling
+                    else if (response['status'] == "ERROR_INVALID_AUTH" && pollAuthToken != authToken)
+                        poll();
+
+                    else
+                        if (errorCallback)
+                            errorCallback(response['status']);
+                }, retry
+            );
+        }
+
+        poll();
+    }
+
+    // Retargets the session and loads the new page with a single request.
+    // If the page has an element with data-motdplayer-fragment attribute,
+    // only that element is replaced (scripts inside of it are not run)
     this.goto = function (newPageId, args) {
-        motdPlayer.retarget(newPageId, function () {
-            var url = "/" + serverId + "/" + pluginId + "/" + newPageId + "/" + steamid + "/" + authMethod + "/" + authToken + "/" + sessionId + "/";
-            if (args)
-                url += "?" + args;
-            location.href = url;
-        }, function (error) {
-            alert(error);
-        });
+        var query = args ? "?" + args : "";
+        var xmlhttp = new XMLHttpRequest();
+
+        xmlhttp.onreadystatechange=function() {
+            if (xmlhttp.readyState!=4)
+                return;
+
+            if (loadingScreenNode) {
+                loadingScreenNode.parentNode.removeChild(loadingScreenNode);
+                loadingScreenNode = null;
+            }
+
+            if (xmlhttp.status!=200) {
+                alert("ERROR_AJAX_FAILURE");
+                return;
+            }
+
+            var newAuthToken = xmlhttp.getResponseHeader('X-MOTDPlayer-Auth-Token');
+            if (newAuthToken) {
+                pageId = newPageId;
+                setWebAuthToken(newAuthToken);
+
+                history.replaceState(null, "", "/" + serverId + "/" + pluginId + "/" + pageId + "/" + steamid + "/" + authMethod + "/" + authToken + "/" + sessionId + "/" + query);
+
+                var fragmentNode = document.querySelector('[data-motdplayer-fragment]');
+                if (fragmentNode) {
+                    var newDocument = new DOMParser().parseFromString(xmlhttp.responseText, "text/html");
+                    var newFragmentNode = newDocument.querySelector('[data-motdplayer-fragment]');
+                    if (newFragmentNode) {
+                        newFragmentNode = document.importNode(newFragmentNode, true);
+                        document.title = newDocument.title;
+                        fragmentNode.parentNode.replaceChild(newFragmentNode, fragmentNode);
+                        bindGotoLinks(newFragmentNode);
+                        return;
+                    }
+                }
+            }
+
+            document.open();
+            document.write(xmlhttp.responseText);
+            document.close();
+        }
+
+        xmlhttp.open("GET", "/navigate/" + serverId + "/" + pluginId + "/" + newPageId + "/" + pageId + "/" + steamid + "/" + authMethod + "/" + authToken + "/" + sessionId + "/" + query, true);
+        xmlhttp.send();
+
+        if (!loadingScreenNode) {
+            loadingScreenNode = document.getElementsByTagName('body')[0].appendChild(document.createElement('div'));
+            loadingScreenNode.classList.add('motdplayer-ajax-loading-screen');
+        }
     }
 
-    document.addEventListener('DOMContentLoaded', function (e) {
-        var links = document.getElementsByTagName('a');
+    var bindGotoLinks = function (rootNode) {
+        var links = rootNode.getElementsByTagName('a');
         for (var i=0; i<links.length; i++) {
             (function (link) {
                 if (link.getAttribute('data-motdplayer-goto')) {
@@ -108,5 +304,9 @@ var MOTDPlayer = function (serverId, pluginId, pageId, steamid, authToken, sessi
                 }
             })(links[i]);
         }
+    }
+
+    document.addEventListener('DOMContentLoaded', function (e) {
+        bindGotoLinks(document);
     });
 }
@@ -1,12 +1,26 @@
-from ConfigParser import ConfigParser
-from functools import wraps
+try:
+    from ConfigParser import ConfigParser
+except ImportError:
+    from configparser import ConfigParser
+from functools import partial, wraps
+from hashlib import sha1
+from json import dumps
 import os.path
 import socket
+import zlib
 
 from flask import jsonify, request
+from sqlalchemy.exc import IntegrityError
 
-from .client import SockClient
-from .srcds_client import SRCDSClient
+from .client import ConnectionClose, PROTOCOL_MULTIPLEXED
+from .endpoints import (
+    EndpointBusy, EndpointRegistry, EndpointUnavailable, SRCDSEndpoint)
+from .multi_server import MultiServerExchanger
+from .multiplex import MultiplexedConnectionPool
+from .pool import ConnectionPool, PoolTimeout
+from .response_cache import CachePolicy, PageCache, ResponseCache
+from .serializers import serializers
+from .srcds_client import NOT_MODIFIED, SRCDSClient
 
 
 AUTH_BY_SRCDS = 1
@@ -15,32 +29,423 @@ AUTH_BY_WEB = 2
 MOTDPLAYER_DATA_PATH = os.path.join(os.path.dirname(__file__), 'data')
 CONFIG_FILE = os.path.join(MOTDPLAYER_DATA_PATH, "config.ini")
 
+# Sections named like this override [srcds] options for one server
+SRCDS_SECTION_PREFIX = "srcds:"
+
 config = ConfigParser()
 config.read(CONFIG_FILE)
 
 
 db = None
 User = None
+user_cache = None
+srcds_endpoints = None
 
+# (server ID, plugin ID, page ID) -> view registered by base_authed_request
+page_views = {}
 
-def init(app, db_):
-    global db, User
+# (server ID, plugin ID, page ID) -> PageCache of the page's cacheable actions
+page_caches = {}
+
+# Answers to cacheable actions, shared by all pages
+if int(config.get('cache', 'max_size')) > 0:
+    response_cache = ResponseCache(int(config.get('cache', 'max_size')))
+else:
+    response_cache = None
+
+
+def get_srcds_option(server_id, option):
+    if server_id is not None:
+        section = SRCDS_SECTION_PREFIX + server_id
+        if config.has_option(section, option):
+            return config.get(section, option)
+
+    return config.get('srcds', option)
+
+
+def get_srcds_settings(server_id):
+    """Read [srcds:<server_id>] (or [srcds] if None) options.
+
+    Returns (protocol, pool options, endpoint options).
+    """
+    def get(option):
+        return get_srcds_option(server_id, option)
+
+    def get_timeout(option):
+        timeout = float(get(option))
+        return timeout if timeout > 0 else None
+
+    # Those that are not installed here are not offered to SRCDS
+    srcds_serializers = tuple(
+        name.strip()
+        for name in get('serializers').split(',')
+        if name.strip() in serializers
+    )
+
+    pool_options = {
+        'host': get('host'),
+        'port': int(get('port')),
+        'min_size': int(get('pool_min_size')),
+        'max_size': int(get('pool_max_size')),
+        'idle_timeout': float(get('pool_idle_timeout')),
+        'acquire_timeout': get_timeout('pool_acquire_timeout'),
+        'serializers': srcds_serializers,
+        'connect_timeout': get_timeout('connect_timeout'),
+        'read_timeout': get_timeout('read_timeout'),
+        'write_timeout': get_timeout('write_timeout'),
+    }
+
+    protocol = get('protocol')
+    if protocol == PROTOCOL_MULTIPLEXED:
+        pool_options['max_channels'] = int(get('max_channels'))
+
+    # Polls hold their connection (or channel) for long, so by default
+    # they may only take half of what the pool can hand out at once
+    max_polls = int(get('max_polls'))
+    if max_polls <= 0:
+        capacity = pool_options['max_size']
+        if protocol == PROTOCOL_MULTIPLEXED:
+            capacity *= pool_options['max_channels']
+
+        max_polls = max(1, capacity // 2)
+
+    max_concurrency = int(get('max_concurrency'))
+    breaker_threshold = int(get('breaker_threshold'))
+    endpoint_options = {
+        'max_concurrency': max_concurrency if max_concurrency > 0 else None,
+        'concurrency_timeout': float(get('concurrency_timeout')),
+        'breaker_threshold': (
+            breaker_threshold if breaker_threshold > 0 else None),
+        'probe_interval': float(get('probe_interval')),
+        'max_polls': max_polls,
+    }
+
+    return protocol, pool_options, endpoint_options
+
+
+def get_srcds_server_ids():
+    """Return IDs of servers that have their own [srcds:<id>] section."""
+    return [
+        section[len(SRCDS_SECTION_PREFIX):]
+        for section in config.sections()
+        if section.startswith(SRCDS_SECTION_PREFIX)
+    ]
+
+
+def create_srcds_endpoint(server_id):
+    protocol, pool_options, endpoint_options = get_srcds_settings(server_id)
+
+    if protocol == PROTOCOL_MULTIPLEXED:
+        pool = MultiplexedConnectionPool(**pool_options)
+    else:
+        pool = ConnectionPool(**pool_options)
+
+    return SRCDSEndpoint(server_id, pool, **endpoint_options)
+
+
+def init_users(app, db_):
+    global db, User, user_cache
     db = db_
 
     from .models import init_database
     init_database(app, db)
-    from .models import User
+    from .models import User, user_cache
+
+
+def init(app, db_):
+    global srcds_endpoints
+
+    srcds_endpoints = EndpointRegistry(create_srcds_endpoint(None))
+    for server_id in get_srcds_server_ids():
+        srcds_endpoints.register(create_srcds_endpoint(server_id))
+
+    init_users(app, db_)
 
     from .views import init_views
     init_views(app, db)
 
 
+def load_user(server_id, steamid, create=False):
+    if user_cache is not None:
+        user = user_cache.get(server_id, steamid)
+        if user is None and create:
+            from .models import CachedUser
+            user = CachedUser(server_id, steamid)
+
+        return user
+
+    user = User.query.filter(
+        User.steamid == steamid, User.server_id == server_id).first()
+
+    if user is None and create:
+        user = User(server_id, steamid)
+        db.session.add(user)
+
+    return user
+
+
+def authenticate_user(user, method, plugin_id, page_id, auth_token,
+                      session_id, single_use=True):
+
+    if user.authenticate(
+            method, plugin_id, page_id, auth_token, session_id, single_use):
+
+        return user
+
+    if user_cache is None:
+        return None
+
+    # Cached salts might be stale if another process has rotated them
+    user = user_cache.get(user.server_id, user.steamid, reload=True)
+    if user is not None and user.authenticate(
+            method, plugin_id, page_id, auth_token, session_id, single_use):
+
+        return user
+
+    return None
+
+
+def save_user(user):
+    if user_cache is not None:
+        user_cache.save(user)
+        return
+
+    server_id, steamid = user.server_id, user.steamid
+    salt, web_salt = user.salt, user.web_salt
+
+    try:
+        db.session.commit()
+
+    except IntegrityError:
+        # Concurrent request has inserted the same user first
+        db.session.rollback()
+
+        from .models import upsert_user
+        upsert_user(db, User, server_id, steamid, salt, web_salt)
+
+
+def discard_user_changes():
+    if user_cache is None:
+        db.session.rollback()
+
+
+def srcds_available(server_id):
+    return srcds_endpoints.get(server_id).available
+
+
+def connect_srcds(server_id, poll=False):
+    """Return SRCDSClient or None if the server can't be talked to now."""
+    endpoint = srcds_endpoints.get(server_id)
+    try:
+        if poll:
+            client = endpoint.acquire_poll()
+        else:
+            client = endpoint.acquire()
+    except (ConnectionClose, EndpointBusy, EndpointUnavailable, PoolTimeout,
+            socket.error):
+
+        return None
+
+    return SRCDSClient(client, endpoint)
+
+
 class CustomDataExchanger(object):
-    def __init__(self, srcds_client):
+    def __init__(self, srcds_client, page_cache=None):
         self._srcds_client = srcds_client
+        self._page_cache = page_cache
+
+    @property
+    def available(self):
+        """False once a failed exchange has dropped the connection."""
+        return self._srcds_client.client is not None
+
+    def _get_cache_key(self, custom_data):
+        if self._page_cache is None:
+            return None
+
+        return self._page_cache.get_key(custom_data)
+
+    def exchange(self, custom_data, known_hash=None):
+        """Exchange custom data, return the answer or None if it failed.
+
+        If known_hash is given and the answer hashes the same, SRCDS may
+        answer NOT_MODIFIED instead. Cached answers are always complete.
+        """
+        cache_key = self._get_cache_key(custom_data)
+        if cache_key is None:
+            return self._srcds_client.exchange_custom_data(
+                custom_data, known_hash)
+
+        key, ttl = cache_key
+        return self._page_cache.cache.get_or_load(
+            key, ttl,
+            partial(self._srcds_client.exchange_custom_data, custom_data))
+
+    def _get_cached(self, custom_data_batch):
+        """Return (results, cache keys, indexes of the uncached pieces)."""
+        cache = self._page_cache.cache
+        results = [None] * len(custom_data_batch)
+        cache_keys = []
+        missing = []
+        for i, custom_data in enumerate(custom_data_batch):
+            cache_key = self._get_cache_key(custom_data)
+            cache_keys.append(cache_key)
+
+            if cache_key is not None:
+                results[i] = cache.get(cache_key[0])
+                if results[i] is not None:
+                    continue
+
+            missing.append(i)
+
+        return results, cache_keys, missing
+
+    def _add_answers(self, results, cache_keys, missing, answers):
+        """Put SRCDS answers to the uncached pieces into results."""
+        if answers is None:
+            if len(missing) == len(results):
+                return None
+
+            answers = [None] * len(missing)
+
+        cache = self._page_cache.cache
+        for i, answer in zip(missing, answers):
+            results[i] = answer
+            if answer is None or answer is NOT_MODIFIED:
+                continue
+
+            if cache_keys[i] is not None:
+                key, ttl = cache_keys[i]
+                cache.set(key, answer, ttl)
+
+        return results
+
+    def exchange_many(self, custom_data_batch, known_hashes=None):
+        if self._page_cache is None:
+            return self._srcds_client.exchange_custom_data_batch(
+                custom_data_batch, known_hashes)
+
+        # Only the pieces that are not cached are sent to SRCDS
+        results, cache_keys, missing = self._get_cached(custom_data_batch)
+        if not missing:
+            return results
+
+        answers = self._srcds_client.exchange_custom_data_batch(
+            [custom_data_batch[i] for i in missing],
+            get_missing_hashes(known_hashes, missing))
+
+        return self._add_answers(results, cache_keys, missing, answers)
+
+
+class KnownHashExchanger(object):
+    """Exchanger for a post the page may already have the answer to.
+
+    The hash of that answer is sent to SRCDS along with the posted custom
+    data (once), so SRCDS can answer NOT_MODIFIED instead of sending it
+    again. Anything else is exchanged as usual.
+    """
+    def __init__(self, data_exchanger, custom_data, known_hash):
+        self._data_exchanger = data_exchanger
+        self._custom_data = custom_data
+        self._known_hash = known_hash
+
+    @property
+    def available(self):
+        return self._data_exchanger.available
+
+    def _take_known_hash(self, custom_data):
+        if self._known_hash is None or custom_data != self._custom_data:
+            return None
+
+        known_hash, self._known_hash = self._known_hash, None
+        return known_hash
 
     def exchange(self, custom_data):
-        return self._srcds_client.exchange_custom_data(custom_data)
+        return self._data_exchanger.exchange(
+            custom_data, self._take_known_hash(custom_data))
+
+    def exchange_many(self, custom_data_batch):
+        return self._data_exchanger.exchange_many(custom_data_batch)
+
+
+class PrefetchedExchanger(object):
+    """Exchanger for one item of a batch that was exchanged beforehand.
+
+    The answer to the posted custom data is given out once without going
+    to SRCDS, anything else is exchanged as usual.
+    """
+    def __init__(self, data_exchanger, custom_data, answer):
+        self._data_exchanger = data_exchanger
+        self._custom_data = custom_data
+        self._answer = answer
+        self._prefetched = True
+
+    @property
+    def available(self):
+        return self._data_exchanger.available
+
+    def _take_prefetched(self, custom_data):
+        """Return True (only once) if the answer to custom_data is known."""
+        if self._prefetched and custom_data == self._custom_data:
+            self._prefetched = False
+            return True
+
+        return False
+
+    def exchange(self, custom_data):
+        if self._take_prefetched(custom_data):
+            return self._answer
+
+        return self._data_exchanger.exchange(custom_data)
+
+    def exchange_many(self, custom_data_batch):
+        return self._data_exchanger.exchange_many(custom_data_batch)
+
+
+def get_missing_hashes(known_hashes, indexes):
+    """Return known hashes of the items that are sent to SRCDS."""
+    if known_hashes is None:
+        return None
+
+    return [known_hashes[i] for i in indexes]
+
+
+def get_prefetch_indexes(custom_data_batch):
+    # Items that aren't dicts are left for the views to reject
+    return [
+        i for i, custom_data in enumerate(custom_data_batch)
+        if isinstance(custom_data, dict)
+    ]
+
+
+def get_prefetched_exchangers(data_exchanger, custom_data_batch, indexes,
+                              answers, exchanger_class=None):
+    """Return exchanger per item, prefetched ones for the answered items."""
+    exchanger_class = exchanger_class or PrefetchedExchanger
+
+    exchangers = [data_exchanger] * len(custom_data_batch)
+    if answers is None:
+        return exchangers
+
+    for i, answer in zip(indexes, answers):
+        exchangers[i] = exchanger_class(
+            data_exchanger, custom_data_batch[i], answer)
+
+    return exchangers
+
+
+def prefetch_batch(data_exchanger, custom_data_batch, known_hashes=None):
+    """Exchange the batch in one round trip, return exchanger per item."""
+    indexes = get_prefetch_indexes(custom_data_batch)
+
+    answers = None
+    if indexes:
+        answers = data_exchanger.exchange_many(
+            [custom_data_batch[i] for i in indexes],
+            get_missing_hashes(known_hashes, indexes))
+
+    return get_prefetched_exchangers(
+        data_exchanger, custom_data_batch, indexes, answers)
 
 
 def get_base_authed_route(server_id, plugin_id, page_id):
@@ -61,82 +466,142 @@ def get_json_page_id(page_id):
     return config.get('application', 'json_page_id').format(page_id=page_id)
 
 
-def base_authed_request(app, server_id, plugin_id, page_id, *args, **kwargs):
-    route = get_base_authed_route(server_id, plugin_id, page_id)
+def get_identity_salt(user, auth_method):
+    """Return salt that SRCDS should give the user, None to keep it."""
+    if auth_method == AUTH_BY_SRCDS:
+        return user.get_new_salt()
 
-    def decorator(f):
-        @app.route(route, *args, **kwargs)
-        @wraps(f)
-        def new_func(steamid, auth_method, auth_token, session_id):
-            steamid = str(steamid)
-            user = User.query.filter(
-                User.steamid == steamid, User.server_id == server_id).first()
+    return None
 
-            if user is None:
-                user = User(server_id, steamid)
-                db.session.add(user)
 
-            if not user.authenticate(
-                    auth_method, plugin_id, page_id, auth_token, session_id):
+def confirm_identity(user, salt):
+    """Update the user once SRCDS has accepted them.
 
-                db.session.rollback()
-                return f(
-                    steamid=None,
-                    web_auth_token=None,
-                    session_id=-1,
-                    data_exchanger=None,
-                    error="INVALID_AUTH",
-                )
+    Returns True if the user has changed and should be saved.
+    """
+    if salt is not None:
+        user.salt = salt
+        return True
 
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((
-                config.get('srcds', 'host'), int(config.get('srcds', 'port'))
-            ))
-            client = SockClient(sock)
-            srcds_client = SRCDSClient(client)
+    return user.rotate_web_salt()
 
-            if auth_method == AUTH_BY_SRCDS:
-                new_salt = user.get_new_salt()
 
-                if not srcds_client.set_identity(
-                        steamid, new_salt, session_id):
+def authenticate_and_connect(server_id, plugin_id, page_id, steamid,
+                             auth_method, auth_token, session_id):
+    """Authenticate the user and introduce them to SRCDS.
 
-                    return f(
-                        steamid=None,
-                        web_auth_token=None,
-                        session_id=-1,
-                        data_exchanger=None,
-                        error="IDENTITY_REJECTED",
-                    )
+    Returns (user, SRCDSClient, None) or (None, None, error).
+    """
+    # Don't use up the token if the server is known to be down
+    if not srcds_available(server_id):
+        return None, None, "SRCDS_UNAVAILABLE"
 
-                user.salt = new_salt
+    user = authenticate_user(
+        load_user(server_id, steamid, create=True),
+        auth_method, plugin_id, page_id, auth_token, session_id)
 
-            else:
-                if not srcds_client.set_identity(steamid, None, session_id):
-                    return f(
-                        steamid=None,
-                        web_auth_token=None,
-                        session_id=-1,
-                        data_exchanger=None,
-                        error="IDENTITY_REJECTED",
-                    )
-
-                web_salt = user.get_new_salt()
-                user.web_salt = web_salt
-
-            db.session.commit()
-
-            custom_data_exchanger = CustomDataExchanger(srcds_client)
-            result = f(
-                steamid=steamid,
-                web_auth_token=user.get_web_auth_token(
-                    plugin_id, page_id, session_id),
-                session_id=session_id,
-                data_exchanger=custom_data_exchanger,
-                error=None,
+    if user is None:
+        discard_user_changes()
+        return None, None, "INVALID_AUTH"
+
+    srcds_client = connect_srcds(server_id)
+    if srcds_client is None:
+        discard_user_changes()
+        return None, None, "SRCDS_UNAVAILABLE"
+
+    # Client must get back to the endpoint whatever goes wrong from here
+    try:
+        salt = get_identity_salt(user, auth_method)
+        if not srcds_client.set_identity(steamid, salt, session_id):
+            return None, None, "IDENTITY_REJECTED"
+
+        if confirm_identity(user, salt):
+            save_user(user)
+        else:
+            discard_user_changes()
+
+    except Exception:
+        srcds_client.end_communication(send_action=False)
+        raise
+
+    return user, srcds_client, None
+
+
+def render_page_error(f, error):
+    return f(
+        steamid=None,
+        web_auth_token=None,
+        session_id=-1,
+        data_exchanger=None,
+        error=error,
+    )
+
+
+def render_page(f, srcds_client, steamid, web_auth_token, session_id,
+                page_cache=None):
+    """Call the page view and end the communication with SRCDS."""
+    custom_data_exchanger = CustomDataExchanger(srcds_client, page_cache)
+    try:
+        result = f(
+            steamid=steamid,
+            web_auth_token=web_auth_token,
+            session_id=session_id,
+            data_exchanger=custom_data_exchanger,
+            error=None,
+        )
+
+    except Exception:
+        # We don't know what state the connection was left in
+        srcds_client.end_communication(send_action=False)
+        raise
+
+    srcds_client.end_communication(send_action=True)
+    return result
+
+
+def register_page_cache(server_id, plugin_id, page_id, cacheable_actions):
+    """Return PageCache for the page (None if nothing is cacheable)."""
+    if not cacheable_actions or response_cache is None:
+        return None
+
+    scope = (server_id, plugin_id, page_id)
+    page_cache = page_caches[scope] = PageCache(
+        response_cache, scope, cacheable_actions)
+
+    return page_cache
+
+
+def base_authed_request(app, server_id, plugin_id, page_id, *args, **kwargs):
+    """Register page view.
+
+    cacheable_actions keyword argument maps custom_data['action'] values
+    to CachePolicy, answers to those actions are cached by the exchanger.
+    """
+    route = get_base_authed_route(server_id, plugin_id, page_id)
+    page_cache = register_page_cache(
+        server_id, plugin_id, page_id, kwargs.pop('cacheable_actions', None))
+
+    def decorator(f):
+        # Pages can also be rendered by the navigation route
+        if "GET" in kwargs.get('methods', ("GET", )):
+            page_views[(server_id, plugin_id, page_id)] = f
+
+        @app.route(route, *args, **kwargs)
+        @wraps(f)
+        def new_func(steamid, auth_method, auth_token, session_id):
+            steamid = str(steamid)
+            user, srcds_client, error = authenticate_and_connect(
+                server_id, plugin_id, page_id, steamid, auth_method,
+                auth_token, session_id)
+
+            if error is not None:
+                return render_page_error(f, error)
+
+            return render_page(
+                f, srcds_client, steamid,
+                user.get_web_auth_token(plugin_id, page_id, session_id),
+                session_id, page_cache,
             )
-            srcds_client.end_communication(send_action=True)
-            return result
 
         return new_func
 
@@ -153,8 +618,7 @@ def base_authed_offline_request(
         @wraps(f)
         def new_func(steamid, auth_token, session_id):
             steamid = str(steamid)
-            user = User.query.filter(
-                User.steamid == steamid, User.server_id == server_id).first()
+            user = load_user(server_id, steamid)
 
             if user is None:
                 return f(
@@ -164,9 +628,10 @@ def base_authed_offline_request(
                     error="USER_DOES_NOT_EXIST"
                 )
 
-            if not user.authenticate(
-                    AUTH_BY_WEB, plugin_id, page_id, auth_token, session_id):
+            user = authenticate_user(
+                user, AUTH_BY_WEB, plugin_id, page_id, auth_token, session_id)
 
+            if user is None:
                 return f(
                     steamid=None,
                     web_auth_token=None,
@@ -174,8 +639,8 @@ def base_authed_offline_request(
                     error="INVALID_AUTH",
                 )
 
-            user.web_salt = user.get_new_salt()
-            db.session.commit()
+            if user.rotate_web_salt():
+                save_user(user)
 
             return f(
                 steamid=steamid,
@@ -190,7 +655,153 @@ def base_authed_offline_request(
     return decorator
 
 
+def get_custom_data_hash(data):
+    return sha1(dumps(
+        data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ).hexdigest()
+
+
+def get_custom_data_result(data, known_hash=None):
+    """Return result of a custom data exchange to send to the page.
+
+    If the page asks for a hash (by sending the one it knows, possibly
+    empty), data is only sent if it doesn't match that hash.
+    """
+    # SRCDS has already compared them
+    if data is NOT_MODIFIED:
+        return {
+            'status': "OK",
+            'custom_data_hash': known_hash,
+            'not_modified': True,
+        }
+
+    if known_hash is None:
+        return {
+            'status': "OK",
+            'custom_data': data,
+        }
+
+    data_hash = get_custom_data_hash(data)
+    if data_hash == known_hash:
+        return {
+            'status': "OK",
+            'custom_data_hash': data_hash,
+            'not_modified': True,
+        }
+
+    return {
+        'status': "OK",
+        'custom_data_hash': data_hash,
+        'custom_data': data,
+    }
+
+
+def parse_custom_data_request(request_json):
+    """Return (is batch, custom data batch, known hashes) of the post.
+
+    Single piece of custom data is returned as a batch of one. None means
+    the action is unknown.
+    """
+    if request_json['action'] == 'receive-custom-data':
+        return (
+            False,
+            [request_json['custom_data']],
+            [request_json.get('custom_data_hash')],
+        )
+
+    if request_json['action'] != 'receive-custom-data-batch':
+        return None
+
+    custom_data_batch = request_json['custom_data_batch']
+    known_hashes = list(request_json.get('custom_data_hash_batch') or ())
+    known_hashes += [None] * (len(custom_data_batch) - len(known_hashes))
+    return True, custom_data_batch, known_hashes
+
+
+def get_custom_data_response(is_batch, results, known_hashes,
+                             web_auth_token):
+    """Return JSON response with the view results (None where it failed)."""
+    if not is_batch:
+        if results[0] is None:
+            return {
+                'status': "ERROR_SRCDS_FAILURE",
+                'web_auth_token': web_auth_token,
+            }
+
+        response = get_custom_data_result(results[0], known_hashes[0])
+        response['web_auth_token'] = web_auth_token
+        return response
+
+    return {
+        'status': "OK",
+        'web_auth_token': web_auth_token,
+        'custom_data_batch': [
+            {'status': "ERROR_SRCDS_FAILURE"} if data is None
+            else get_custom_data_result(data, known_hash)
+            for data, known_hash in zip(results, known_hashes)
+        ],
+    }
+
+
+def compress_body(data, accept_encodings):
+    """Return (encoding, compressed data), or None if it's not worth it."""
+    min_size = int(config.get('application', 'compress_min_size'))
+    if min_size < 0 or len(data) < min_size:
+        return None
+
+    # gzip and zlib wrappers around the same deflate stream
+    if accept_encodings['gzip']:
+        encoding, wbits = "gzip", 16 + zlib.MAX_WBITS
+    elif accept_encodings['deflate']:
+        encoding, wbits = "deflate", zlib.MAX_WBITS
+    else:
+        return None
+
+    compressor = zlib.compressobj(
+        int(config.get('application', 'compress_level')),
+        zlib.DEFLATED,
+        wbits,
+    )
+
+    return encoding, compressor.compress(data) + compressor.flush()
+
+
+def compress_response(response):
+    """Compress the response if it's big enough and the client accepts it."""
+    if response.direct_passthrough:
+        return response
+
+    compressed = compress_body(response.get_data(), request.accept_encodings)
+    if compressed is None:
+        return response
+
+    encoding, data = compressed
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = "Accept-Encoding"
+    return response
+
+
+def json_response(obj):
+    return compress_response(jsonify(obj))
+
+
 def json_authed_request(app, server_id, plugin_id, page_id, *args, **kwargs):
+    """Register JSON view.
+
+    If batch_exchange keyword argument is True, batched posts are sent to
+    SRCDS in one round trip before the view is called for every item.
+    Only use it if the view sends the posted custom data as it is.
+
+    If skip_unchanged keyword argument is True, the hash of the answer the
+    page has is sent to SRCDS along with the posted custom data, and
+    SRCDS may answer NOT_MODIFIED instead of building and sending the
+    same answer again. Only use it if the view returns the answer to the
+    posted custom data as it is.
+    """
+    batch_exchange = kwargs.pop('batch_exchange', False)
+    skip_unchanged = kwargs.pop('skip_unchanged', False)
+
     def decorator(f):
         @base_authed_request(
             app, server_id, plugin_id, page_id, *args,
@@ -200,30 +811,47 @@ def json_authed_request(app, server_id, plugin_id, page_id, *args, **kwargs):
                 steamid, web_auth_token, session_id, data_exchanger, error):
 
             if error is not None:
-                return jsonify({
+                return json_response({
                     'status': error,
                     'web_auth_token': web_auth_token,
                 })
 
-            if request.json['action'] != 'receive-custom-data':
-                return jsonify({
+            parsed = parse_custom_data_request(request.json)
+            if parsed is None:
+                return json_response({
                     'status': "ERROR_BAD_REQUEST",
                     'web_auth_token': web_auth_token,
                 })
 
-            data = f(data_exchanger, request.json['custom_data'])
+            is_batch, custom_data_batch, known_hashes = parsed
+            exchangers = [data_exchanger] * len(custom_data_batch)
+            if is_batch and batch_exchange and data_exchanger.available:
+                exchangers = prefetch_batch(
+                    data_exchanger, custom_data_batch,
+                    known_hashes if skip_unchanged else None)
 
-            if data is None:
-                return jsonify({
-                    'status': "ERROR_SRCDS_FAILURE",
-                    'web_auth_token': web_auth_token,
-                })
+            elif skip_unchanged:
+                exchangers = [
+                    KnownHashExchanger(data_exchanger, custom_data, known_hash)
+                    for custom_data, known_hash in zip(
+                        custom_data_batch, known_hashes)
+                ]
 
-            return jsonify({
-                'status': "OK",
-                'web_auth_token': web_auth_token,
-                'custom_data': data,
-            })
+            if not is_batch:
+                results = [f(exchangers[0], custom_data_batch[0])]
+
+            else:
+                # Every item is handled as if it came in its own request,
+                # but they all share the auth and the SRCDS connection
+                results = [
+                    f(exchanger, custom_data) if exchanger.available
+                    else None
+                    for custom_data, exchanger in zip(
+                        custom_data_batch, exchangers)
+                ]
+
+            return json_response(get_custom_data_response(
+                is_batch, results, known_hashes, web_auth_token))
 
         return base_authed_request_func
 
@@ -0,0 +1,1100 @@
+"""Asyncio variant of the bridge, for Quart apps served by an ASGI server.
+
+Talking to SRCDS is done with non-blocking streams, so a request that
+waits for SRCDS (or for a poll to be answered) costs a coroutine rather
+than a worker. User auth state is read and written from a thread pool,
+under the app context of the Flask app the database is bound to.
+
+It needs Python 3 and the user cache ([users] cache_size > 0): cached
+users are plain objects, so they outlive the app context they were
+loaded in.
+
+    app = Quart(__name__)
+    db_app = Flask(__name__)
+    db = SQLAlchemy(db_app)
+    motdplayer.aio.init(app, db, db_app)
+
+    @motdplayer.aio.json_authed_request(app, "my_server", "plugin", "page")
+    async def page(data_exchanger, custom_data):
+        return await data_exchanger.exchange(custom_data)
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from time import time
+
+from quart import jsonify, request
+
+from . import (
+    authenticate_user, compress_body, config, confirm_identity,
+    CustomDataExchanger, get_base_authed_route, get_custom_data_response,
+    get_identity_salt, get_missing_hashes, get_prefetch_indexes,
+    get_prefetched_exchangers, get_srcds_server_ids, get_srcds_settings,
+    init_users, KnownHashExchanger, load_user, parse_custom_data_request,
+    PrefetchedExchanger, register_page_cache, save_user)
+from .client import (
+    ConnectionClose, ConnectionTimeout, get_negotiation_request,
+    parse_negotiation_response, PROTOCOL_LEGACY, PROTOCOL_MULTIPLEXED)
+from .endpoints import (
+    EndpointBusy, EndpointRegistry, EndpointUnavailable, SRCDSEndpoint)
+from .framing import (
+    FLAG_CLOSE, FLAG_MORE, get_legacy_fields, LEGACY_HEADER,
+    MULTIPLEXED_HEADER)
+from .multiplex import (
+    BaseChannel, BaseMultiplexedConnectionPool, MAX_CHANNEL_ID)
+from .pool import (
+    BaseConnectionPool, get_deadline, get_remaining, PoolTimeout)
+from .serializers import get_serializer
+from .srcds_client import (
+    BaseSRCDSClient, get_custom_data, get_custom_data_batch,
+    get_custom_data_message, get_custom_data_batch_message,
+    get_identity_message, get_poll_message, get_retarget_message,
+    get_server_data_message)
+
+
+db_app = None
+db_executor = None
+srcds_endpoints = None
+
+# (server ID, plugin ID, page ID) -> view registered by base_authed_request
+page_views = {}
+
+# Cache key -> future of the answer that is being loaded
+_cache_flights = {}
+
+
+class AsyncSockClient(object):
+    multiplexed = False
+    timed_out = False
+
+    header = LEGACY_HEADER
+
+    def __init__(self, reader, writer, serializer=None, read_timeout=None,
+                 write_timeout=None):
+
+        super(AsyncSockClient, self).__init__()
+
+        self.reader = reader
+        self.writer = writer
+        self.serializer = serializer or get_serializer()
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+
+    @property
+    def alive(self):
+        return not (self.reader.at_eof() or self.writer.is_closing())
+
+    def _time_out(self, message):
+        self.timed_out = True
+        self.stop()
+        raise ConnectionTimeout(message)
+
+    async def _read_frame(self):
+        fields = self.header.unpack(
+            await self.reader.readexactly(self.header.size))
+
+        return fields, await self.reader.readexactly(fields[-1])
+
+    async def receive_frame(self, extra_time=0):
+        timeout = self.read_timeout
+        if timeout is not None:
+            timeout += extra_time
+
+        try:
+            return await asyncio.wait_for(self._read_frame(), timeout)
+
+        except asyncio.TimeoutError:
+            self._time_out("SRCDS didn't respond in time")
+
+        except (asyncio.IncompleteReadError, OSError):
+            self.stop()
+            raise ConnectionClose("Connection closed by the other side")
+
+    async def receive_message(self, extra_time=0):
+        fields, message = await self.receive_frame(extra_time)
+        return message
+
+    async def _drain(self):
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.write_timeout)
+
+        except asyncio.TimeoutError:
+            self._time_out("SRCDS didn't accept the message in time")
+
+        except OSError:
+            self.stop()
+            raise ConnectionClose("Connection closed by the other side")
+
+    async def send_message(self, message):
+        self.writer.write(
+            LEGACY_HEADER.pack(*get_legacy_fields(message)) + message)
+
+        await self._drain()
+
+    async def negotiate(self, protocols, serializers=()):
+        await self.send_message(
+            get_negotiation_request(protocols, serializers))
+
+        protocol, self.serializer = parse_negotiation_response(
+            await self.receive_message())
+
+        return protocol
+
+    def stop(self):
+        self.writer.close()
+
+
+class AsyncChannel(BaseChannel):
+    def __init__(self, connection, id_):
+        super(AsyncChannel, self).__init__(connection, id_)
+
+        self._messages = asyncio.Queue()
+
+    def deliver(self, message):
+        self._messages.put_nowait(message)
+
+    async def send_message(self, message):
+        self._check_open()
+
+        try:
+            await self.connection.send_frame(self.id, message)
+        except ConnectionTimeout:
+            self.timed_out = True
+            raise
+
+    async def receive_message(self, extra_time=0):
+        try:
+            message = await asyncio.wait_for(
+                self._messages.get(), self._get_read_timeout(extra_time))
+
+        except asyncio.TimeoutError:
+            self._time_out()
+
+        return self._check_message(message)
+
+
+class AsyncMultiplexedConnection(AsyncSockClient):
+    """Single connection shared by many concurrent exchanges.
+
+    Frames are routed to the waiting channels by a reader task.
+    """
+    header = MULTIPLEXED_HEADER
+
+    def __init__(self, reader, writer, serializer=None, read_timeout=None,
+                 write_timeout=None):
+
+        super(AsyncMultiplexedConnection, self).__init__(
+            reader, writer, serializer, read_timeout, write_timeout)
+
+        self.running = True
+        self.last_used = time()
+
+        self._channels = {}
+        self._next_channel_id = 1
+        self._write_lock = asyncio.Lock()
+
+        self._reader = asyncio.ensure_future(self._read_frames())
+
+    @property
+    def load(self):
+        return len(self._channels)
+
+    async def _read_frames(self):
+        try:
+            while self.running:
+                (channel_id, flags, length), message = (
+                    await self._read_frame())
+
+                if flags & FLAG_CLOSE:
+                    channel = self._channels.pop(channel_id, None)
+                    if channel is not None:
+                        channel.deliver(None)
+
+                    continue
+
+                channel = self._channels.get(channel_id)
+                if channel is not None:
+                    channel.deliver_chunk(message, flags & FLAG_MORE)
+
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+
+        self.stop()
+
+    def open_channel(self):
+        if not self.running:
+            raise ConnectionClose("Connection is closed")
+
+        channel = AsyncChannel(self, self._next_channel_id)
+        self._channels[channel.id] = channel
+
+        self._next_channel_id += 1
+        if self._next_channel_id > MAX_CHANNEL_ID:
+            self._next_channel_id = 1
+
+        return channel
+
+    def close_channel(self, channel):
+        self._channels.pop(channel.id, None)
+        self.last_used = time()
+
+        if channel.closed:
+            return
+
+        channel.closed = True
+
+        # Nobody waits for the close frame to be sent
+        if self.running:
+            self.writer.write(
+                MULTIPLEXED_HEADER.pack(channel.id, FLAG_CLOSE, 0))
+
+    async def send_frame(self, channel_id, message, flags=0):
+        if not self.running:
+            raise ConnectionClose("Connection is closed")
+
+        async with self._write_lock:
+            self.writer.write(MULTIPLEXED_HEADER.pack(
+                channel_id, flags, len(message)) + message)
+
+            try:
+                await self._drain()
+            except ConnectionTimeout:
+                # Frame might have been sent partially, nothing else can
+                # be sent over this connection
+                self.timed_out = True
+                raise
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self.running = False
+        channels = list(self._channels.values())
+        self._channels.clear()
+
+        super(AsyncMultiplexedConnection, self).stop()
+
+        # Wake up everybody who waits for a response
+        for channel in channels:
+            channel.deliver(None)
+
+
+async def _open_connection(host, port, connect_timeout):
+    return await asyncio.wait_for(
+        asyncio.open_connection(host, port), connect_timeout)
+
+
+async def _wait_for_pool(condition, deadline, message):
+    """Wait on the pool condition, raise PoolTimeout past the deadline."""
+    try:
+        await asyncio.wait_for(
+            condition.wait(), get_remaining(deadline, message))
+
+    except asyncio.TimeoutError:
+        pass
+
+
+class AsyncConnectionPool(BaseConnectionPool):
+    def __init__(self, *args, **kwargs):
+        super(AsyncConnectionPool, self).__init__(*args, **kwargs)
+
+        # Pools are created by init() before the loop is running, so the
+        # condition is created on first use, inside that loop
+        self._loop_condition = None
+
+    @property
+    def _condition(self):
+        if self._loop_condition is None:
+            self._loop_condition = asyncio.Condition()
+
+        return self._loop_condition
+
+    @staticmethod
+    def _is_alive(client):
+        return client.alive
+
+    async def _connect(self):
+        reader, writer = await _open_connection(
+            self.host, self.port, self.connect_timeout)
+
+        # Negotiation is bound by the connect timeout, too
+        client = AsyncSockClient(
+            reader, writer,
+            read_timeout=self.connect_timeout,
+            write_timeout=self.connect_timeout,
+        )
+        if self.serializers:
+            try:
+                await client.negotiate((PROTOCOL_LEGACY, ), self.serializers)
+
+            except Exception:
+                client.stop()
+                raise
+
+        client.read_timeout = self.read_timeout
+        client.write_timeout = self.write_timeout
+        return client
+
+    async def acquire(self):
+        deadline = get_deadline(self.acquire_timeout)
+
+        async with self._condition:
+            while True:
+                client = self._take_idle()
+                if client is not None:
+                    return client
+
+                if self._reserve():
+                    break
+
+                await _wait_for_pool(
+                    self._condition, deadline, self._timeout_message())
+
+        try:
+            return await self._connect()
+        except BaseException:
+            async with self._condition:
+                self._size -= 1
+                self._condition.notify()
+
+            raise
+
+    async def release(self, client):
+        async with self._condition:
+            self._idle.append((client, time()))
+            self._condition.notify()
+
+    async def discard(self, client):
+        async with self._condition:
+            self._close(client)
+
+    async def close(self):
+        async with self._condition:
+            while self._idle:
+                client, released_at = self._idle.pop()
+                self._close(client)
+
+
+class AsyncMultiplexedConnectionPool(BaseMultiplexedConnectionPool):
+    """Pool that hands out channels over a few shared connections.
+
+    If SRCDS refuses to multiplex, the pool falls back to the regular
+    AsyncConnectionPool that uses legacy framing.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AsyncMultiplexedConnectionPool, self).__init__(*args, **kwargs)
+
+        # Created on first use, see AsyncConnectionPool
+        self._loop_condition = None
+
+    @property
+    def _condition(self):
+        if self._loop_condition is None:
+            self._loop_condition = asyncio.Condition()
+
+        return self._loop_condition
+
+    async def _connect(self):
+        reader, writer = await _open_connection(
+            self.host, self.port, self.connect_timeout)
+
+        client = AsyncSockClient(
+            reader, writer,
+            read_timeout=self.connect_timeout,
+            write_timeout=self.connect_timeout,
+        )
+        try:
+            protocol = await client.negotiate(
+                self.protocols, self.serializers)
+
+        except Exception:
+            client.stop()
+            raise
+
+        if protocol == PROTOCOL_MULTIPLEXED:
+            return AsyncMultiplexedConnection(
+                reader, writer, client.serializer, self.read_timeout,
+                self.write_timeout)
+
+        client.stop()
+        return None
+
+    async def _get_connection(self):
+        deadline = get_deadline(self.acquire_timeout)
+
+        async with self._condition:
+            while True:
+                connection = self._pick_connection()
+                if connection is not None:
+                    return connection
+
+                if self._reserve():
+                    break
+
+                await _wait_for_pool(
+                    self._condition, deadline, self._timeout_message())
+
+        connection = None
+        try:
+            connection = await self._connect()
+
+        finally:
+            async with self._condition:
+                self._connected(connection)
+                self._condition.notify_all()
+
+        return connection
+
+    async def acquire(self):
+        if self.fallback is not None:
+            return await self.fallback.acquire()
+
+        connection = await self._get_connection()
+        if connection is None:
+            async with self._condition:
+                # Several acquires may have been refused multiplexing
+                if self.fallback is None:
+                    self.fallback = AsyncConnectionPool(
+                        self.host, self.port,
+                        **self._get_fallback_options())
+
+            return await self.fallback.acquire()
+
+        return connection.open_channel()
+
+    async def _close_channel(self, channel):
+        channel.stop()
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def release(self, client):
+        if not client.multiplexed:
+            return await self.fallback.release(client)
+
+        await self._close_channel(client)
+
+    async def discard(self, client):
+        if not client.multiplexed:
+            return await self.fallback.discard(client)
+
+        await self._close_channel(client)
+
+    async def close(self):
+        if self.fallback is not None:
+            await self.fallback.close()
+
+        async with self._condition:
+            for connection in self._connections:
+                connection.stop()
+
+            self._connections = []
+
+
+class AsyncSRCDSEndpoint(SRCDSEndpoint):
+    """SRCDSEndpoint that hands out clients from an async pool.
+
+    Health state and the circuit breaker are shared with the threaded one,
+    the probe runs as a task instead of a thread.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AsyncSRCDSEndpoint, self).__init__(*args, **kwargs)
+
+        # Created on first use, see AsyncConnectionPool
+        self._loop_condition = None
+
+    @property
+    def _slot_condition(self):
+        if self._loop_condition is None:
+            self._loop_condition = asyncio.Condition()
+
+        return self._loop_condition
+
+    async def _take_slot(self):
+        async with self._slot_condition:
+            if self.max_concurrency is None:
+                self._in_use += 1
+                return
+
+            if self._in_use >= self.max_concurrency:
+                try:
+                    await asyncio.wait_for(self._slot_condition.wait_for(
+                        lambda: self._in_use < self.max_concurrency
+                    ), self.concurrency_timeout)
+
+                except asyncio.TimeoutError:
+                    raise EndpointBusy(
+                        "Too many concurrent requests to server "
+                        "'{}'".format(self.server_id))
+
+            self._in_use += 1
+
+    async def _free_slot(self):
+        async with self._slot_condition:
+            self._in_use -= 1
+            self._slot_condition.notify()
+
+    def _start_probing(self):
+        asyncio.ensure_future(self._probe())
+
+    async def _probe(self):
+        while self._breaker_open:
+            await asyncio.sleep(self.probe_interval)
+
+            # Being able to connect is not enough, SRCDS should answer
+            try:
+                alive = await AsyncSRCDSClient(
+                    await self.pool.acquire(), self.pool).ping()
+
+            except (ConnectionClose, OSError, PoolTimeout,
+                    asyncio.TimeoutError) as e:
+
+                alive = False
+                error = e
+
+            else:
+                error = ConnectionTimeout("SRCDS didn't answer the ping")
+
+            if alive:
+                self.record_success()
+                continue
+
+            with self._health_lock:
+                self.last_failure_at = time()
+                self.last_error = error
+
+    async def _acquire_client(self, free_slot):
+        try:
+            return await self.pool.acquire()
+
+        except (ConnectionClose, OSError, PoolTimeout,
+                asyncio.TimeoutError) as e:
+
+            await free_slot()
+            self.record_failure(e)
+            raise
+
+        except BaseException:
+            await free_slot()
+            raise
+
+    async def acquire(self):
+        self._check_available()
+        await self._take_slot()
+        return await self._acquire_client(self._free_slot)
+
+    async def _free_poll_slot_async(self):
+        self._free_poll_slot()
+
+    async def acquire_poll(self):
+        """Acquire a client for a poll, it takes a poll slot instead."""
+        self._check_available()
+        self._take_poll_slot()
+        client = await self._acquire_client(self._free_poll_slot_async)
+        self._add_polling(client)
+        return client
+
+    async def release(self, client):
+        # Client only gets released after a complete exchange
+        try:
+            await self.pool.release(client)
+        finally:
+            if not self._stop_polling(client):
+                await self._free_slot()
+
+        self.record_success()
+
+    async def discard(self, client):
+        try:
+            await self.pool.discard(client)
+        finally:
+            if not self._stop_polling(client):
+                await self._free_slot()
+
+        if client.timed_out:
+            self.record_failure(ConnectionTimeout(
+                "SRCDS didn't respond in time"))
+
+    async def close(self):
+        await self.pool.close()
+
+
+class AsyncSRCDSClient(BaseSRCDSClient):
+    async def _send(self, message):
+        await self.client.send_message(self._encode(message))
+
+    async def _receive(self, extra_time=0):
+        return self._decode(await self.client.receive_message(extra_time))
+
+    async def end_communication(self, send_action=True):
+        if self.client is None:
+            return
+
+        client, self.client = self.client, None
+
+        if self.pool is None:
+            if send_action:
+                try:
+                    await client.send_message(
+                        client.serializer.action("end_communication"))
+
+                except (ConnectionClose, OSError):
+                    pass
+
+            client.stop()
+            return
+
+        # If we're not supposed to talk to SRCDS anymore, the connection
+        # is considered broken and should not get back to the pool
+        if not send_action:
+            await self.pool.discard(client)
+            return
+
+        # Multiplexed channels are not reused, closing one is enough
+        if client.multiplexed:
+            await self.pool.release(client)
+            return
+
+        try:
+            await client.send_message(client.serializer.action("release"))
+
+        except (ConnectionClose, OSError):
+            await self.pool.discard(client)
+
+        else:
+            await self.pool.release(client)
+
+    async def _exchange(self, message, extra_time=0):
+        """Send message, return the response or None if it failed."""
+        try:
+            await self._send(message)
+            response = await self._receive(extra_time)
+
+        except (ConnectionClose, OSError):
+            await self.end_communication(send_action=False)
+            return None
+
+        if response['status'] == "OK":
+            return response
+
+        await self.end_communication(send_action=False)
+        return None
+
+    async def ping(self):
+        """Check that SRCDS answers, end the communication either way."""
+        response = await self._exchange({
+            'action': "ping",
+        })
+
+        if response is None:
+            return False
+
+        await self.end_communication(send_action=True)
+        return True
+
+    async def set_identity(self, steamid, salt, session_id):
+        response = await self._exchange(
+            get_identity_message(steamid, salt, session_id))
+
+        return response is not None
+
+    async def request_retargeting(self, new_page_id, end_communication=True):
+        response = await self._exchange(get_retarget_message(new_page_id))
+
+        if response is None:
+            return False
+
+        if end_communication:
+            await self.end_communication(send_action=True)
+
+        return True
+
+    async def exchange_custom_data(self, data, known_hash=None):
+        return get_custom_data(
+            await self._exchange(get_custom_data_message(data, known_hash)))
+
+    async def exchange_custom_data_batch(self, data_batch,
+                                         known_hashes=None):
+        """Exchange several pieces of custom data in one round trip.
+
+        Returns a list with the answer to every piece (None if that one
+        failed), or None if the whole exchange failed.
+        """
+        return get_custom_data_batch(await self._exchange(
+            get_custom_data_batch_message(data_batch, known_hashes)))
+
+    async def exchange_server_data(self, plugin_id, data):
+        """Exchange custom data with the plugin itself, not a player.
+
+        Must be used instead of set_identity, not after it.
+        """
+        return get_custom_data(
+            await self._exchange(get_server_data_message(plugin_id, data)))
+
+    async def poll(self, timeout):
+        """Wait for the data pushed to the session, {} means there was none."""
+        return get_custom_data(await self._exchange(
+            get_poll_message(timeout), extra_time=timeout))
+
+
+async def get_or_load(cache, key, ttl, load):
+    """Async counterpart of ResponseCache.get_or_load."""
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    flight = _cache_flights.get(key)
+    if flight is not None:
+        cache.count_coalesced()
+        return await asyncio.shield(flight)
+
+    flight = _cache_flights[key] = asyncio.get_running_loop().create_future()
+
+    value = None
+    try:
+        value = await load()
+
+    finally:
+        del _cache_flights[key]
+        if value is not None:
+            cache.set(key, value, ttl)
+
+        flight.set_result(value)
+
+    return value
+
+
+class AsyncCustomDataExchanger(CustomDataExchanger):
+    async def exchange(self, custom_data, known_hash=None):
+        cache_key = self._get_cache_key(custom_data)
+        if cache_key is None:
+            return await self._srcds_client.exchange_custom_data(
+                custom_data, known_hash)
+
+        key, ttl = cache_key
+        return await get_or_load(
+            self._page_cache.cache, key, ttl,
+            partial(self._srcds_client.exchange_custom_data, custom_data))
+
+    async def exchange_many(self, custom_data_batch, known_hashes=None):
+        if self._page_cache is None:
+            return await self._srcds_client.exchange_custom_data_batch(
+                custom_data_batch, known_hashes)
+
+        # Only the pieces that are not cached are sent to SRCDS
+        results, cache_keys, missing = self._get_cached(custom_data_batch)
+        if not missing:
+            return results
+
+        answers = await self._srcds_client.exchange_custom_data_batch(
+            [custom_data_batch[i] for i in missing],
+            get_missing_hashes(known_hashes, missing))
+
+        return self._add_answers(results, cache_keys, missing, answers)
+
+
+class AsyncKnownHashExchanger(KnownHashExchanger):
+    async def exchange(self, custom_data):
+        return await self._data_exchanger.exchange(
+            custom_data, self._take_known_hash(custom_data))
+
+    async def exchange_many(self, custom_data_batch):
+        return await self._data_exchanger.exchange_many(custom_data_batch)
+
+
+class AsyncPrefetchedExchanger(PrefetchedExchanger):
+    async def exchange(self, custom_data):
+        if self._take_prefetched(custom_data):
+            return self._answer
+
+        return await self._data_exchanger.exchange(custom_data)
+
+    async def exchange_many(self, custom_data_batch):
+        return await self._data_exchanger.exchange_many(custom_data_batch)
+
+
+async def prefetch_batch(data_exchanger, custom_data_batch,
+                         known_hashes=None):
+
+    indexes = get_prefetch_indexes(custom_data_batch)
+
+    answers = None
+    if indexes:
+        answers = await data_exchanger.exchange_many(
+            [custom_data_batch[i] for i in indexes],
+            get_missing_hashes(known_hashes, indexes))
+
+    return get_prefetched_exchangers(
+        data_exchanger, custom_data_batch, indexes, answers,
+        AsyncPrefetchedExchanger)
+
+
+def create_srcds_endpoint(server_id):
+    protocol, pool_options, endpoint_options = get_srcds_settings(server_id)
+
+    if protocol == PROTOCOL_MULTIPLEXED:
+        pool = AsyncMultiplexedConnectionPool(**pool_options)
+    else:
+        pool = AsyncConnectionPool(**pool_options)
+
+    return AsyncSRCDSEndpoint(server_id, pool, **endpoint_options)
+
+
+def init(app, db, db_app_):
+    """Set up the bridge for Quart app.
+
+    db is Flask-SQLAlchemy instance bound to Flask app db_app_, which is
+    only used for the database access.
+    """
+    global db_app, db_executor, srcds_endpoints
+
+    if int(config.get('users', 'cache_size')) <= 0:
+        raise ValueError("Asyncio mode requires the user cache, set "
+                         "[users] cache_size in config.ini")
+
+    db_app = db_app_
+    db_executor = ThreadPoolExecutor(
+        max_workers=int(config.get('aio', 'db_workers')))
+
+    srcds_endpoints = EndpointRegistry(create_srcds_endpoint(None))
+    for server_id in get_srcds_server_ids():
+        srcds_endpoints.register(create_srcds_endpoint(server_id))
+
+    # Sync helpers (load_user and others) work the same in both modes
+    init_users(db_app, db)
+
+    from .aio_views import init_views
+    init_views(app)
+
+
+def _call_in_db_context(func, *args):
+    with db_app.app_context():
+        return func(*args)
+
+
+async def run_in_db_context(func, *args):
+    """Run blocking function that might access the database."""
+    return await asyncio.get_running_loop().run_in_executor(
+        db_executor, partial(_call_in_db_context, func, *args))
+
+
+def _load_and_authenticate(server_id, steamid, create, auth_method,
+                           plugin_id, page_id, auth_token, session_id,
+                           single_use):
+
+    user = load_user(server_id, steamid, create=create)
+    if user is None:
+        return None
+
+    return authenticate_user(
+        user, auth_method, plugin_id, page_id, auth_token, session_id,
+        single_use)
+
+
+async def load_and_authenticate(server_id, steamid, auth_method, plugin_id,
+                                page_id, auth_token, session_id, create=True,
+                                single_use=True):
+
+    return await run_in_db_context(
+        _load_and_authenticate, server_id, steamid, create, auth_method,
+        plugin_id, page_id, auth_token, session_id, single_use)
+
+
+def srcds_available(server_id):
+    return srcds_endpoints.get(server_id).available
+
+
+async def connect_srcds(server_id, poll=False):
+    """Return AsyncSRCDSClient or None if the server can't be talked to."""
+    endpoint = srcds_endpoints.get(server_id)
+    try:
+        if poll:
+            client = await endpoint.acquire_poll()
+        else:
+            client = await endpoint.acquire()
+
+    except (ConnectionClose, EndpointBusy, EndpointUnavailable, OSError,
+            PoolTimeout, asyncio.TimeoutError):
+
+        return None
+
+    return AsyncSRCDSClient(client, endpoint)
+
+
+async def authenticate_and_connect(server_id, plugin_id, page_id, steamid,
+                                   auth_method, auth_token, session_id):
+    """Authenticate the user and introduce them to SRCDS.
+
+    Returns (user, AsyncSRCDSClient, None) or (None, None, error).
+    """
+    # Don't use up the token if the server is known to be down
+    if not srcds_available(server_id):
+        return None, None, "SRCDS_UNAVAILABLE"
+
+    user = await load_and_authenticate(
+        server_id, steamid, auth_method, plugin_id, page_id, auth_token,
+        session_id)
+
+    if user is None:
+        return None, None, "INVALID_AUTH"
+
+    srcds_client = await connect_srcds(server_id)
+    if srcds_client is None:
+        return None, None, "SRCDS_UNAVAILABLE"
+
+    # Client must get back to the endpoint whatever goes wrong from here
+    try:
+        salt = get_identity_salt(user, auth_method)
+        if not await srcds_client.set_identity(steamid, salt, session_id):
+            return None, None, "IDENTITY_REJECTED"
+
+        if confirm_identity(user, salt):
+            await run_in_db_context(save_user, user)
+
+    except BaseException:
+        await srcds_client.end_communication(send_action=False)
+        raise
+
+    return user, srcds_client, None
+
+
+async def render_page_error(f, error):
+    return await f(
+        steamid=None,
+        web_auth_token=None,
+        session_id=-1,
+        data_exchanger=None,
+        error=error,
+    )
+
+
+async def render_page(f, srcds_client, steamid, web_auth_token, session_id,
+                      page_cache=None):
+    """Call the page view and end the communication with SRCDS."""
+    custom_data_exchanger = AsyncCustomDataExchanger(srcds_client, page_cache)
+    try:
+        result = await f(
+            steamid=steamid,
+            web_auth_token=web_auth_token,
+            session_id=session_id,
+            data_exchanger=custom_data_exchanger,
+            error=None,
+        )
+
+    except BaseException:
+        # We don't know what state the connection was left in
+        await srcds_client.end_communication(send_action=False)
+        raise
+
+    await srcds_client.end_communication(send_action=True)
+    return result
+
+
+def base_authed_request(app, server_id, plugin_id, page_id, *args, **kwargs):
+    route = get_base_authed_route(server_id, plugin_id, page_id)
+    page_cache = register_page_cache(
+        server_id, plugin_id, page_id, kwargs.pop('cacheable_actions', None))
+
+    def decorator(f):
+        # Pages can also be rendered by the navigation route
+        if "GET" in kwargs.get('methods', ("GET", )):
+            page_views[(server_id, plugin_id, page_id)] = f
+
+        @app.route(route, *args, **kwargs)
+        @wraps(f)
+        async def new_func(steamid, auth_method, auth_token, session_id):
+            steamid = str(steamid)
+            user, srcds_client, error = await authenticate_and_connect(
+                server_id, plugin_id, page_id, steamid, auth_method,
+                auth_token, session_id)
+
+            if error is not None:
+                return await render_page_error(f, error)
+
+            return await render_page(
+                f, srcds_client, steamid,
+                user.get_web_auth_token(plugin_id, page_id, session_id),
+                session_id, page_cache,
+            )
+
+        return new_func
+
+    return decorator
+
+
+async def json_response(obj):
+    response = jsonify(obj)
+
+    compressed = compress_body(
+        await response.get_data(), request.accept_encodings)
+
+    if compressed is not None:
+        encoding, data = compressed
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = "Accept-Encoding"
+
+    return response
+
+
+def json_authed_request(app, server_id, plugin_id, page_id, *args, **kwargs):
+    batch_exchange = kwargs.pop('batch_exchange', False)
+    skip_unchanged = kwargs.pop('skip_unchanged', False)
+
+    def decorator(f):
+        @base_authed_request(
+            app, server_id, plugin_id, page_id, *args,
+            methods=["POST", ], **kwargs)
+        @wraps(f)
+        async def base_authed_request_func(
+                steamid, web_auth_token, session_id, data_exchanger, error):
+
+            if error is not None:
+                return await json_response({
+                    'status': error,
+                    'web_auth_token': web_auth_token,
+                })
+
+            parsed = parse_custom_data_request(await request.get_json())
+            if parsed is None:
+                return await json_response({
+                    'status': "ERROR_BAD_REQUEST",
+                    'web_auth_token': web_auth_token,
+                })
+
+            is_batch, custom_data_batch, known_hashes = parsed
+            exchangers = [data_exchanger] * len(custom_data_batch)
+            if is_batch and batch_exchange and data_exchanger.available:
+                exchangers = await prefetch_batch(
+                    data_exchanger, custom_data_batch,
+                    known_hashes if skip_unchanged else None)
+
+            elif skip_unchanged:
+                exchangers = [
+                    AsyncKnownHashExchanger(
+                        data_exchanger, custom_data, known_hash)
+                    for custom_data, known_hash in zip(
+                        custom_data_batch, known_hashes)
+                ]
+
+            if not is_batch:
+                results = [await f(exchangers[0], custom_data_batch[0])]
+
+            else:
+                # Every item is handled as if it came in its own request,
+                # but they all share the auth and the SRCDS connection
+                results = []
+                for custom_data, exchanger in zip(
+                        custom_data_batch, exchangers):
+
+                    data = None
+                    if exchanger.available:
+                        data = await f(exchanger, custom_data)
+
+                    results.append(data)
+
+            return await json_response(get_custom_data_response(
+                is_batch, results, known_hashes, web_auth_token))
+
+        return base_authed_request_func
+
+    return decorator
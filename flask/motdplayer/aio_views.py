@@ -0,0 +1,163 @@
+from quart import abort, jsonify, make_response, render_template, request
+
+from . import AUTH_BY_WEB, config, get_srcds_option, page_caches
+from .aio import (
+    authenticate_and_connect, connect_srcds, load_and_authenticate,
+    page_views, render_page, render_page_error, srcds_available)
+
+
+def init_views(app):
+    @app.route(config.get('application', 'csgo_redirect_from'))
+    async def route_csgo_redirect(
+            server_id, plugin_id, page_id, steamid, auth_method, auth_token,
+            session_id):
+
+        redirect_to = config.get('application', 'csgo_redirect_to').format(
+            server_id=server_id,
+            plugin_id=plugin_id,
+            page_id=page_id,
+            steamid=steamid,
+            auth_method=auth_method,
+            auth_token=auth_token,
+            session_id=session_id,
+        )
+
+        return await render_template(
+            "motdplayer/csgo_redirect.html", redirect_to=redirect_to)
+
+    @app.route(config.get('application', 'retarget_url'), methods=['POST', ])
+    async def route_json_retarget(server_id, plugin_id, new_page_id, page_id,
+                                  steamid, auth_method, auth_token,
+                                  session_id):
+
+        if (await request.get_json())['action'] != "retarget":
+            return jsonify({
+                'status': "ERROR_BAD_REQUEST",
+            })
+
+        steamid = str(steamid)
+        user, srcds_client, error = await authenticate_and_connect(
+            server_id, plugin_id, page_id, steamid, auth_method, auth_token,
+            session_id)
+
+        if error is not None:
+            return jsonify({
+                'status': "ERROR_" + error,
+            })
+
+        try:
+            retargeted = await srcds_client.request_retargeting(new_page_id)
+
+        except BaseException:
+            await srcds_client.end_communication(send_action=False)
+            raise
+
+        if not retargeted:
+            return jsonify({
+                'status': "ERROR_RETARGETING_REJECTED",
+            })
+
+        return jsonify({
+            'status': "OK",
+            'web_auth_token': user.get_web_auth_token(
+                plugin_id, new_page_id, session_id),
+        })
+
+    @app.route(config.get('application', 'navigate_url'))
+    async def route_navigate(server_id, plugin_id, new_page_id, page_id,
+                             steamid, auth_method, auth_token, session_id):
+
+        # Retarget the session and render the new page in one go, over
+        # the same SRCDS connection
+        f = page_views.get((server_id, plugin_id, new_page_id))
+        if f is None:
+            abort(404)
+
+        steamid = str(steamid)
+        user, srcds_client, error = await authenticate_and_connect(
+            server_id, plugin_id, page_id, steamid, auth_method, auth_token,
+            session_id)
+
+        if error is not None:
+            return await render_page_error(f, error)
+
+        try:
+            retargeted = await srcds_client.request_retargeting(
+                new_page_id, end_communication=False)
+
+        except BaseException:
+            await srcds_client.end_communication(send_action=False)
+            raise
+
+        if not retargeted:
+            return await render_page_error(f, "RETARGETING_REJECTED")
+
+        web_auth_token = user.get_web_auth_token(
+            plugin_id, new_page_id, session_id)
+
+        response = await make_response(await render_page(
+            f, srcds_client, steamid, web_auth_token, session_id,
+            page_caches.get((server_id, plugin_id, new_page_id))))
+
+        # Lets the page swap its content without reloading itself
+        response.headers['X-MOTDPlayer-Page-Id'] = new_page_id
+        response.headers['X-MOTDPlayer-Auth-Token'] = web_auth_token
+        return response
+
+    @app.route(config.get('application', 'poll_url'), methods=['POST', ])
+    async def route_json_poll(server_id, plugin_id, page_id, steamid,
+                              auth_token, session_id):
+
+        if (await request.get_json())['action'] != "poll":
+            return jsonify({
+                'status': "ERROR_BAD_REQUEST",
+            })
+
+        if not srcds_available(server_id):
+            return jsonify({
+                'status': "ERROR_SRCDS_UNAVAILABLE",
+            })
+
+        steamid = str(steamid)
+
+        # Poll hangs for a while, so it doesn't use up (or rotate) the
+        # token: other requests of the same page are made with it meanwhile
+        user = await load_and_authenticate(
+            server_id, steamid, AUTH_BY_WEB, plugin_id, page_id, auth_token,
+            session_id, create=False, single_use=False)
+
+        if user is None:
+            return jsonify({
+                'status': "ERROR_INVALID_AUTH",
+            })
+
+        # Waiting poll doesn't hold up other requests to the server
+        srcds_client = await connect_srcds(server_id, poll=True)
+        if srcds_client is None:
+            return jsonify({
+                'status': "ERROR_SRCDS_UNAVAILABLE",
+            })
+
+        try:
+            if not await srcds_client.set_identity(steamid, None, session_id):
+                return jsonify({
+                    'status': "ERROR_IDENTITY_REJECTED",
+                })
+
+            data = await srcds_client.poll(
+                float(get_srcds_option(server_id, 'poll_timeout')))
+
+        except BaseException:
+            await srcds_client.end_communication(send_action=False)
+            raise
+
+        if data is None:
+            return jsonify({
+                'status': "ERROR_SRCDS_FAILURE",
+            })
+
+        await srcds_client.end_communication(send_action=True)
+        return jsonify({
+            'status': "OK",
+            'custom_data': data,
+        })
@@ -1,54 +1,122 @@
+from json import dumps, loads
 from select import select
+import socket
 
+from .framing import (
+    FrameReader, get_legacy_fields, LEGACY_HEADER, write_frame)
+from .serializers import DEFAULT_SERIALIZER, get_serializer
 
-CHUNK_SIZE = 4096
+
+# Negotiation message can't be confused with a regular message, and it's
+# always JSON-encoded
+NEGOTIATION_MAGIC = b'\x00MOTDPLAYER\x00'
+
+PROTOCOL_LEGACY = "legacy"
+PROTOCOL_MULTIPLEXED = "multiplexed"
 
 
 class ConnectionClose(Exception):
     pass
 
 
-class SockClient(object):
-    def __init__(self, sock):
-        super(SockClient, self).__init__()
+class ConnectionTimeout(ConnectionClose):
+    pass
 
-        self.sock = sock
 
-    def _read_sock(self, length):
-        data = b''
-        while len(data) < length:
-            chunk = self.sock.recv(min(CHUNK_SIZE, length - len(data)))
-            if chunk == b'':
-                self.stop()
-                return None
+class BadMessage(ConnectionClose):
+    """Message from the other side can't be decoded.
+
+    Connection is dropped, as it's not known what else went wrong there.
+    """
+
+
+def get_negotiation_request(protocols, serializers=()):
+    request = {
+        'protocols': list(protocols),
+    }
+
+    if serializers:
+        request['serializers'] = list(serializers)
+
+    return NEGOTIATION_MAGIC + dumps(request).encode('utf-8')
 
-            data += chunk
 
-        return data
+def parse_negotiation_response(response):
+    """Return (protocol, serializer) that SRCDS has picked."""
+    if not response.startswith(NEGOTIATION_MAGIC):
+        raise ConnectionClose("SRCDS doesn't support negotiation")
 
-    def _write_sock(self, data):
-        total_sent = 0
-        while total_sent < len(data):
-            sent = self.sock.send(data[total_sent:])
-            if sent == 0:
-                self.stop()
-                raise ConnectionClose("Sent zero bytes")
+    response = loads(response[len(NEGOTIATION_MAGIC):].decode('utf-8'))
 
-            total_sent += sent
+    # SRCDS that doesn't know about serializers only speaks JSON
+    return response['protocol'], get_serializer(
+        response.get('serializer', DEFAULT_SERIALIZER))
 
-    def receive_message(self):
-        # Parse message length - first 2 bytes
-        length_bytes = bytearray(self._read_sock(2))
-        length = length_bytes[0] * 256 + length_bytes[1]
 
-        # Receive the message
-        message = self._read_sock(length)
+class SockClient(object):
+    multiplexed = False
+
+    # Set once the other side has failed to keep up with us, such
+    # connection is closed as it's not known where the stream is at
+    timed_out = False
+
+    def __init__(self, sock, serializer=None, read_timeout=None,
+                 write_timeout=None):
+
+        super(SockClient, self).__init__()
+
+        self.sock = sock
+        self.reader = FrameReader(LEGACY_HEADER)
+        self.serializer = serializer or get_serializer()
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+
+    def _time_out(self, message):
+        self.timed_out = True
+        self.stop()
+        raise ConnectionTimeout(message)
+
+    def receive_frame(self, extra_time=0):
+        if self.read_timeout is None:
+            self.sock.settimeout(None)
+        else:
+            self.sock.settimeout(self.read_timeout + extra_time)
+
+        try:
+            frame = self.reader.read_frame(self.sock)
+        except socket.timeout:
+            self._time_out("SRCDS didn't respond in time")
+
+        if frame is None:
+            self.stop()
+            raise ConnectionClose("Connection closed by the other side")
+
+        return frame
+
+    def receive_message(self, extra_time=0):
+        """Receive the next message.
+
+        extra_time is how much longer than read_timeout it may take.
+        """
+        fields, message = self.receive_frame(extra_time)
         return message
 
     def send_message(self, message):
-        length = len(message)
-        length_bytes = bytes(bytearray((length // 256, length % 256)))
-        self._write_sock(length_bytes + message)
+        fields = get_legacy_fields(message)
+
+        self.sock.settimeout(self.write_timeout)
+        try:
+            write_frame(self.sock, LEGACY_HEADER, fields, message)
+        except socket.timeout:
+            self._time_out("SRCDS didn't accept the message in time")
+
+    def negotiate(self, protocols, serializers=()):
+        self.send_message(get_negotiation_request(protocols, serializers))
+
+        protocol, self.serializer = parse_negotiation_response(
+            self.receive_message())
+
+        return protocol
 
     def stop(self):
         self.sock.close()
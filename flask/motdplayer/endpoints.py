@@ -0,0 +1,283 @@
+"""SRCDS endpoints, one per game server.
+
+Every endpoint has its own connection pool, its own limit on how many
+requests may talk to that server at once and its own health state, so a
+slow or dead server only holds up the requests that are made to it.
+
+Polls hang for long, so they don't count towards that limit. They have
+a limit of their own instead, which is never waited for: a poll over it
+fails right away.
+
+After a number of failures in a row the endpoint's circuit breaker
+opens: requests fail right away without touching the network, and a
+background thread probes the server until it can be connected to again.
+"""
+import socket
+from threading import Condition, Lock, Thread
+from time import sleep, time
+
+from .client import ConnectionClose, ConnectionTimeout
+from .pool import PoolTimeout
+from .srcds_client import SRCDSClient
+
+
+class EndpointBusy(Exception):
+    pass
+
+
+class EndpointUnavailable(Exception):
+    pass
+
+
+class SRCDSEndpoint(object):
+    """Pool-like wrapper that limits concurrency and tracks health.
+
+    It can be handed to SRCDSClient in place of the pool.
+    """
+    def __init__(self, server_id, pool, max_concurrency=None,
+                 concurrency_timeout=0.0, breaker_threshold=None,
+                 probe_interval=5.0, max_polls=None):
+
+        super(SRCDSEndpoint, self).__init__()
+
+        self.server_id = server_id
+        self.pool = pool
+        self.max_concurrency = max_concurrency
+        self.concurrency_timeout = concurrency_timeout
+
+        # Number of failures in a row that opens the breaker (None never)
+        self.breaker_threshold = breaker_threshold
+        self.probe_interval = probe_interval
+
+        # Number of clients that are currently handed out
+        self._in_use = 0
+        self._condition = Condition()
+
+        # Clients that are handed out for polls (None means no limit)
+        self.max_polls = max_polls
+        self._polls = 0
+        self._polling = set()
+        self._poll_lock = Lock()
+
+        # Number of exchanges (or connection attempts) that have failed
+        # in a row
+        self.failures = 0
+        self.last_failure_at = None
+        self.last_error = None
+        self._health_lock = Lock()
+
+        self._breaker_open = False
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    @property
+    def healthy(self):
+        return self.failures == 0
+
+    @property
+    def available(self):
+        """False while the breaker is open."""
+        return not self._breaker_open
+
+    def _take_slot(self):
+        with self._condition:
+            if self.max_concurrency is None:
+                self._in_use += 1
+                return
+
+            deadline = time() + self.concurrency_timeout
+            while self._in_use >= self.max_concurrency:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise EndpointBusy("Too many concurrent requests to "
+                                       "server '{}'".format(self.server_id))
+
+                self._condition.wait(remaining)
+
+            self._in_use += 1
+
+    def _free_slot(self):
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify()
+
+    def _take_poll_slot(self):
+        with self._poll_lock:
+            if self.max_polls is not None and self._polls >= self.max_polls:
+                raise EndpointBusy("Too many polls to server '{}'".format(
+                    self.server_id))
+
+            self._polls += 1
+
+    def _free_poll_slot(self):
+        with self._poll_lock:
+            self._polls -= 1
+
+    def _add_polling(self, client):
+        with self._poll_lock:
+            self._polling.add(client)
+
+    def _stop_polling(self, client):
+        """Free poll slot of the client, return False if it has none."""
+        with self._poll_lock:
+            if client not in self._polling:
+                return False
+
+            self._polling.remove(client)
+            self._polls -= 1
+            return True
+
+    def _check_available(self):
+        if self._breaker_open:
+            raise EndpointUnavailable("Server '{}' is unavailable".format(
+                self.server_id))
+
+    def record_success(self):
+        with self._health_lock:
+            self.failures = 0
+            self._breaker_open = False
+
+    def record_failure(self, error):
+        with self._health_lock:
+            self.failures += 1
+            self.last_failure_at = time()
+            self.last_error = error
+
+            if (self._breaker_open or self.breaker_threshold is None or
+                    self.failures < self.breaker_threshold):
+
+                return
+
+            self._breaker_open = True
+
+        self._start_probing()
+
+    def _start_probing(self):
+        prober = Thread(target=self._probe)
+        prober.daemon = True
+        prober.start()
+
+    def _probe(self):
+        while self._breaker_open:
+            sleep(self.probe_interval)
+
+            # Being able to connect is not enough, SRCDS should answer
+            try:
+                alive = SRCDSClient(self.pool.acquire(), self.pool).ping()
+
+            except (ConnectionClose, PoolTimeout, socket.error) as e:
+                alive = False
+                error = e
+
+            else:
+                error = ConnectionTimeout("SRCDS didn't answer the ping")
+
+            if alive:
+                self.record_success()
+                continue
+
+            with self._health_lock:
+                self.last_failure_at = time()
+                self.last_error = error
+
+    def _acquire_client(self, free_slot):
+        try:
+            return self.pool.acquire()
+
+        except (ConnectionClose, PoolTimeout, socket.error) as e:
+            free_slot()
+            self.record_failure(e)
+            raise
+
+        except Exception:
+            free_slot()
+            raise
+
+    def acquire(self):
+        self._check_available()
+        self._take_slot()
+        return self._acquire_client(self._free_slot)
+
+    def acquire_poll(self):
+        """Acquire a client for a poll, it takes a poll slot instead."""
+        self._check_available()
+        self._take_poll_slot()
+        client = self._acquire_client(self._free_poll_slot)
+        self._add_polling(client)
+        return client
+
+    def release(self, client):
+        # Client only gets released after a complete exchange
+        try:
+            self.pool.release(client)
+        finally:
+            if not self._stop_polling(client):
+                self._free_slot()
+
+        self.record_success()
+
+    def discard(self, client):
+        try:
+            self.pool.discard(client)
+        finally:
+            if not self._stop_polling(client):
+                self._free_slot()
+
+        if client.timed_out:
+            self.record_failure(ConnectionTimeout(
+                "SRCDS didn't respond in time"))
+
+    def close(self):
+        self.pool.close()
+
+    def get_status(self):
+        return {
+            'server_id': self.server_id,
+            'healthy': self.healthy,
+            'available': self.available,
+            'failures': self.failures,
+            'last_failure_at': self.last_failure_at,
+            'last_error': (
+                None if self.last_error is None else str(self.last_error)),
+            'in_use': self._in_use,
+            'max_concurrency': self.max_concurrency,
+            'polls': self._polls,
+            'max_polls': self.max_polls,
+            'pool_size': self.pool.size,
+        }
+
+
+class EndpointRegistry(object):
+    """Maps server IDs to their endpoints.
+
+    Servers that don't have an endpoint of their own share the default one.
+    """
+    def __init__(self, default=None):
+        super(EndpointRegistry, self).__init__()
+
+        self.default = default
+        self._endpoints = {}
+
+    def register(self, endpoint):
+        self._endpoints[endpoint.server_id] = endpoint
+
+    def get(self, server_id):
+        endpoint = self._endpoints.get(server_id, self.default)
+        if endpoint is None:
+            raise KeyError("No SRCDS endpoint for server '{}'".format(
+                server_id))
+
+        return endpoint
+
+    def __iter__(self):
+        if self.default is not None:
+            yield self.default
+
+        for endpoint in self._endpoints.values():
+            yield endpoint
+
+    def close(self):
+        for endpoint in self:
+            endpoint.close()
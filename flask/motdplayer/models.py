@@ -1,14 +1,21 @@
-from hashlib import sha512
+import atexit
+from collections import OrderedDict
 import os.path
-from random import choice, randrange
-import string
+from threading import Event, Lock, Thread
 
-from . import AUTH_BY_SRCDS, AUTH_BY_WEB, MOTDPLAYER_DATA_PATH
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
 
+from . import AUTH_BY_SRCDS, AUTH_BY_WEB, config, MOTDPLAYER_DATA_PATH
+from .signed_tokens import WebTokenSigner
+from .tokens import compare_tokens, get_new_salt, TokenEngine
+
+
+WEB_TOKENS_SALTED = "salted"
+WEB_TOKENS_SIGNED = "signed"
 
-SALT_CHARACTERS = string.ascii_letters + string.digits
-SALT_LENGTH = 64
 SERVER_SALTS_DIR = os.path.join(MOTDPLAYER_DATA_PATH, "server_salts")
+USERS_INDEX_NAME = "uq_motdplayer_users_server_id_steamid"
 
 
 server_salts = {}
@@ -20,15 +27,336 @@ for item in os.listdir(SERVER_SALTS_DIR):
         with open(full_item, 'rb') as f:
             server_salts[base_item] = f.read()
 
+token_engines = {
+    server_id: TokenEngine(server_id, server_salt)
+    for server_id, server_salt in server_salts.items()
+}
+
 
 User = None
+user_cache = None
+web_token_signer = None
+
+
+def upsert_user(db, model, server_id, steamid, salt=None, web_salt=None):
+    """Insert a user or update existing one, commit the result.
+
+    Salts that are None are left as they are (empty for a new user).
+    Relies on the unique index: if a concurrent request has inserted
+    the same user first, our insert fails and we update their row.
+    """
+    def update(user):
+        if salt is not None:
+            user.salt = salt
+
+        if web_salt is not None:
+            user.web_salt = web_salt
+
+    user = model.query.filter(
+        model.steamid == steamid, model.server_id == server_id).first()
+
+    if user is None:
+        user = model(server_id, steamid)
+        update(user)
+        db.session.add(user)
+
+        try:
+            db.session.commit()
+            return
+
+        except IntegrityError:
+            db.session.rollback()
+
+        user = model.query.filter(
+            model.steamid == steamid, model.server_id == server_id).one()
+
+    update(user)
+    db.session.commit()
+
+
+def migrate_users_table(db, model):
+    """Remove duplicate users and add the unique index to an old table."""
+    inspector = inspect(db.engine)
+    table_name = model.__tablename__
+
+    if table_name not in inspector.get_table_names():
+        # Table will be created by create_all() along with the index
+        return
+
+    for index in inspector.get_indexes(table_name):
+        if index['name'] == USERS_INDEX_NAME:
+            return
+
+    # Keep the most recent row of every user. Subquery is wrapped in a
+    # derived table, otherwise MySQL refuses to delete from the same table
+    db.session.execute(db.text(
+        "DELETE FROM {table} WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MAX(id) AS id FROM {table} "
+        "GROUP BY server_id, steamid) AS latest_users)".format(
+            table=table_name)))
+    db.session.commit()
+
+    for index in model.__table__.indexes:
+        if index.name == USERS_INDEX_NAME:
+            index.create(bind=db.engine)
+
+
+class UserAuthMixin(object):
+    def get_auth_token(self, plugin_id, page_id, session_id):
+        return token_engines[self.server_id].get_token(
+            self.salt, plugin_id, self.steamid, page_id, session_id)
+
+    def get_web_auth_token(self, plugin_id, page_id, session_id):
+        if web_token_signer is not None:
+            return web_token_signer.issue(
+                self.server_id, plugin_id, page_id, self.steamid, session_id)
+
+        return token_engines[self.server_id].get_token(
+            self.web_salt, plugin_id, self.steamid, page_id, session_id)
+
+    def authenticate(self, method, plugin_id, page_id, auth_token,
+                     session_id, single_use=True):
+
+        if method == AUTH_BY_SRCDS:
+            return compare_tokens(auth_token, self.get_auth_token(
+                plugin_id, page_id, session_id))
+
+        if method == AUTH_BY_WEB:
+            if web_token_signer is not None:
+                return web_token_signer.verify(
+                    auth_token, self.server_id, plugin_id, page_id,
+                    self.steamid, session_id, consume=single_use)
+
+            return compare_tokens(auth_token, self.get_web_auth_token(
+                plugin_id, page_id, session_id))
+
+        return False
+
+    def rotate_web_salt(self):
+        """Invalidate issued web auth token, return True if it changed
+        the user (and the user needs to be saved)."""
+        if web_token_signer is not None:
+            # Signed tokens are single-use by themselves
+            return False
+
+        self.web_salt = self.get_new_salt()
+        return True
+
+    @staticmethod
+    def get_new_salt():
+        return get_new_salt()
+
+
+class CachedUser(UserAuthMixin):
+    """Auth state of a user that lives in UserCache."""
+    FIELDS = ('salt', 'web_salt')
+
+    def __init__(self, server_id, steamid, salt="", web_salt=""):
+        super(CachedUser, self).__init__()
+
+        self.server_id = server_id
+        self.steamid = steamid
+        self.salt = salt
+        self.web_salt = web_salt
+
+        # Values the database is known to have
+        self._stored = {
+            'salt': salt,
+            'web_salt': web_salt,
+        }
+
+    def get_changes(self):
+        """Return {field: value} of the fields that have changed since
+        the user was loaded or last written."""
+        changes = {}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value != self._stored[field]:
+                changes[field] = value
+
+        return changes
+
+    def mark_stored(self, changes):
+        self._stored.update(changes)
+
+
+class UserCache(object):
+    """Bounded LRU cache of user auth state with coalesced commits.
+
+    Salt rotations only mark the cached user as dirty. Dirty users are
+    written to the database in one transaction every flush_interval
+    seconds by a background thread, before they're evicted, and when
+    the process exits.
+
+    Only the fields that have changed are written, so a flush never
+    puts back the salts it has loaded. Still, every worker process has
+    its own cache, so the bridge should run as a single (multi-threaded)
+    process while the cache is enabled.
+    """
+    def __init__(self, app, db, model, max_size=4096, flush_interval=2.0):
+        super(UserCache, self).__init__()
+
+        self.app = app
+        self.db = db
+        self.model = model
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+
+        self._users = OrderedDict()
+        self._dirty = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._stopped = Event()
+
+        self._worker = Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+        atexit.register(self.stop)
+
+    def __len__(self):
+        return len(self._users)
+
+    def _load(self, server_id, steamid):
+        user = self.model.query.filter(
+            self.model.steamid == steamid,
+            self.model.server_id == server_id
+        ).first()
+
+        if user is None:
+            return None
+
+        return CachedUser(server_id, steamid, user.salt, user.web_salt)
+
+    def get(self, server_id, steamid, reload=False):
+        key = (server_id, steamid)
+        with self._lock:
+            user = None if reload else self._users.pop(key, None)
+            if user is not None:
+                # Move to the most recently used end
+                self._users[key] = user
+                return user
+
+        # Another process might have rotated the salts meanwhile
+        if reload:
+            self.flush()
+
+        user = self._load(server_id, steamid)
+        if user is None:
+            return None
+
+        with self._lock:
+            self._users.pop(key, None)
+            self._users[key] = user
+            evicted = self._evict()
+
+        if evicted:
+            self.flush()
+
+        return user
+
+    def _evict(self):
+        evicted = False
+        while len(self._users) > self.max_size:
+            key, user = self._users.popitem(last=False)
+
+            # Dirty users are kept in _dirty until they're flushed
+            evicted = evicted or key in self._dirty
+
+        return evicted
+
+    def save(self, user):
+        key = (user.server_id, user.steamid)
+        with self._lock:
+            self._users.pop(key, None)
+            self._users[key] = user
+            self._dirty[key] = user
+            evicted = self._evict()
+
+        if evicted:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+
+                dirty, self._dirty = self._dirty, {}
+
+            try:
+                with self.app.app_context():
+                    self._write_to_database(dirty)
+
+            except Exception:
+                with self._lock:
+                    for key, user in dirty.items():
+                        self._dirty.setdefault(key, user)
+
+                raise
+
+    def _write_to_database(self, users):
+        # (server ID, SteamID) -> (user, changed fields)
+        changes = {}
+        for key, user in users.items():
+            user_changes = user.get_changes()
+            if user_changes:
+                changes[key] = user, user_changes
+
+        steamids_by_server = {}
+        for server_id, steamid in changes.keys():
+            steamids_by_server.setdefault(server_id, []).append(steamid)
+
+        missing = []
+        for server_id, steamids in steamids_by_server.items():
+            db_users = self.model.query.filter(
+                self.model.server_id == server_id,
+                self.model.steamid.in_(steamids)
+            )
+
+            missing_steamids = set(steamids)
+            for db_user in db_users:
+                user_changes = changes[(server_id, db_user.steamid)][1]
+                for field, value in user_changes.items():
+                    setattr(db_user, field, value)
+
+                missing_steamids.discard(db_user.steamid)
+
+            missing.extend(
+                changes[(server_id, steamid)] for steamid in missing_steamids)
+
+        self.db.session.commit()
+
+        # New users are rare, so they're inserted one by one to deal with
+        # those that might've been inserted by other processes
+        for user, user_changes in missing:
+            upsert_user(
+                self.db, self.model, user.server_id, user.steamid,
+                **user_changes)
+
+        for user, user_changes in changes.values():
+            user.mark_stored(user_changes)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Failed to flush user cache")
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
 
 
 def init_database(app, db):
-    global User
+    global User, user_cache, web_token_signer
 
-    class User(db.Model):
+    class User(db.Model, UserAuthMixin):
         __tablename__ = "motdplayer_users"
+        __table_args__ = (
+            db.Index(USERS_INDEX_NAME, 'server_id', 'steamid', unique=True),
+        )
 
         id = db.Column(db.Integer, primary_key=True)
         server_id = db.Column(db.String(32))
@@ -44,44 +372,19 @@ def init_database(app, db):
             self.salt = ""
             self.web_salt = ""
 
-        def get_auth_token(self, plugin_id, page_id, session_id):
-            return sha512(
-                (
-                    self.salt +
-                    self.server_id +
-                    plugin_id +
-                    self.steamid +
-                    page_id +
-                    str(session_id)
-                ).encode('ascii') + server_salts[self.server_id]
-            ).hexdigest()
-
-        def get_web_auth_token(self, plugin_id, page_id, session_id):
-            return sha512(
-                (
-                    self.web_salt +
-                    self.server_id +
-                    plugin_id +
-                    self.steamid +
-                    page_id +
-                    str(session_id)
-                ).encode('ascii') + server_salts[self.server_id]
-            ).hexdigest()
-
-        def authenticate(
-                self, method, plugin_id, page_id, auth_token, session_id):
-
-            if method == AUTH_BY_SRCDS:
-                return auth_token == self.get_auth_token(
-                    plugin_id, page_id, session_id)
-
-            if method == AUTH_BY_WEB:
-                return auth_token == self.get_web_auth_token(
-                    plugin_id, page_id, session_id)
+    with app.app_context():
+        migrate_users_table(db, User)
 
-            return False
+    if int(config.get('users', 'cache_size')) > 0:
+        user_cache = UserCache(
+            app, db, User,
+            max_size=int(config.get('users', 'cache_size')),
+            flush_interval=float(config.get('users', 'flush_interval')),
+        )
 
-        @staticmethod
-        def get_new_salt():
-            return ''.join(
-                [choice(SALT_CHARACTERS) for x in range(SALT_LENGTH)])
+    if config.get('auth', 'web_tokens') == WEB_TOKENS_SIGNED:
+        web_token_signer = WebTokenSigner(
+            server_salts,
+            ttl=int(config.get('auth', 'signed_token_ttl')),
+            window_size=int(config.get('auth', 'nonce_window_size')),
+        )
@@ -0,0 +1,180 @@
+"""Exchange of server data with many game servers at once.
+
+Servers are asked in parallel from a pool of threads shared by all
+exchanges, so the whole exchange takes as long as the slowest server
+does, but never longer than the deadline. Servers that miss the deadline
+are left to finish in the background and their connections go back to
+their endpoints once they do. Requests that are still waiting for a free
+thread when their deadline passes are dropped.
+"""
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+import socket
+from threading import Event, Lock, Thread
+from time import time
+from traceback import print_exc
+
+from .client import ConnectionClose
+
+
+class MultiServerResult(object):
+    def __init__(self):
+        super(MultiServerResult, self).__init__()
+
+        # server_id -> custom data that server has answered with
+        self.results = {}
+
+        # IDs of servers that couldn't be reached or refused to answer
+        self.failed = []
+
+        # IDs of servers that didn't answer in time
+        self.timed_out = []
+
+    @property
+    def complete(self):
+        return not (self.failed or self.timed_out)
+
+
+class _WorkerPool(object):
+    """Fixed number of daemon threads, started on first use."""
+    def __init__(self, max_workers):
+        super(_WorkerPool, self).__init__()
+
+        self.max_workers = max_workers
+
+        self._tasks = Queue()
+        self._started = False
+        self._lock = Lock()
+
+    def _work(self):
+        while True:
+            func, args = self._tasks.get()
+            try:
+                func(*args)
+            except Exception:
+                print_exc()
+
+    def submit(self, func, *args):
+        with self._lock:
+            if not self._started:
+                for i in range(self.max_workers):
+                    thread = Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+
+                self._started = True
+
+        self._tasks.put((func, args))
+
+
+_worker_pool = None
+_worker_pool_lock = Lock()
+
+
+def get_worker_pool():
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            from . import config
+            _worker_pool = _WorkerPool(
+                int(config.get('multi_server', 'workers')))
+
+        return _worker_pool
+
+
+class _ServerRequest(object):
+    def __init__(self, server_id, deadline):
+        super(_ServerRequest, self).__init__()
+
+        self.server_id = server_id
+        self.deadline = deadline
+        self.done = Event()
+        self.data = None
+
+
+class MultiServerExchanger(object):
+    def __init__(self, plugin_id, server_ids=None, timeout=None):
+        """
+        If server_ids is None, all servers the bridge knows about (those
+        that have a salt file) are asked. If timeout is None, every server
+        uses its multi_server_timeout option.
+        """
+        super(MultiServerExchanger, self).__init__()
+
+        self.plugin_id = plugin_id
+        self.server_ids = server_ids
+        self.timeout = timeout
+
+    def _get_server_ids(self):
+        if self.server_ids is not None:
+            return list(self.server_ids)
+
+        from .models import server_salts
+        return sorted(server_salts.keys())
+
+    def _get_timeout(self, server_id):
+        if self.timeout is not None:
+            return self.timeout
+
+        from . import get_srcds_option
+        return float(get_srcds_option(server_id, 'multi_server_timeout'))
+
+    def _exchange_one(self, request, custom_data):
+        from . import connect_srcds
+
+        # Nobody waits for the answer anymore
+        if time() >= request.deadline:
+            request.done.set()
+            return
+
+        srcds_client = connect_srcds(request.server_id)
+        if srcds_client is None:
+            request.done.set()
+            return
+
+        try:
+            request.data = srcds_client.exchange_server_data(
+                self.plugin_id, custom_data)
+
+        except (ConnectionClose, socket.error):
+            srcds_client.end_communication(send_action=False)
+
+        except Exception:
+            srcds_client.end_communication(send_action=False)
+            raise
+
+        else:
+            srcds_client.end_communication(send_action=True)
+
+        finally:
+            request.done.set()
+
+    def exchange(self, custom_data):
+        """Send custom data to every server, return MultiServerResult."""
+        worker_pool = get_worker_pool()
+
+        now = time()
+        requests = []
+        for server_id in self._get_server_ids():
+            request = _ServerRequest(
+                server_id, now + self._get_timeout(server_id))
+
+            worker_pool.submit(self._exchange_one, request, custom_data)
+            requests.append(request)
+
+        result = MultiServerResult()
+        for request in requests:
+            request.done.wait(max(0, request.deadline - time()))
+
+            if not request.done.is_set():
+                result.timed_out.append(request.server_id)
+
+            elif request.data is None:
+                result.failed.append(request.server_id)
+
+            else:
+                result.results[request.server_id] = request.data
+
+        return result
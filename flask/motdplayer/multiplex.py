@@ -0,0 +1,457 @@
+import socket
+from threading import Condition, Lock, Thread
+from time import time
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+from .client import (
+    ConnectionClose, ConnectionTimeout, PROTOCOL_LEGACY,
+    PROTOCOL_MULTIPLEXED, SockClient)
+from .framing import FLAG_CLOSE, FLAG_MORE, MULTIPLEXED_HEADER, write_frame
+from .pool import ConnectionPool, get_deadline, get_remaining
+from .serializers import SUPPORTED_SERIALIZERS
+
+
+MAX_CHANNEL_ID = 2 ** 32 - 1
+
+
+class BaseChannel(object):
+    """Channel state that doesn't depend on how the waiting is done.
+
+    Subclasses deliver the messages to the waiting side and send them.
+    """
+    multiplexed = True
+    timed_out = False
+
+    def __init__(self, connection, id_):
+        super(BaseChannel, self).__init__()
+
+        self.connection = connection
+        self.id = id_
+        self.closed = False
+
+        # Chunks of the message that is being streamed to us
+        self._pending_chunks = []
+
+    @property
+    def serializer(self):
+        return self.connection.serializer
+
+    def deliver(self, message):
+        raise NotImplementedError
+
+    def deliver_chunk(self, chunk, more):
+        if more:
+            self._pending_chunks.append(chunk)
+            return
+
+        if self._pending_chunks:
+            self._pending_chunks.append(chunk)
+            chunk = b''.join(self._pending_chunks)
+            self._pending_chunks = []
+
+        self.deliver(chunk)
+
+    def _check_open(self):
+        if self.closed:
+            raise ConnectionClose("Channel is closed")
+
+    def _get_read_timeout(self, extra_time):
+        timeout = self.connection.read_timeout
+        if timeout is not None:
+            timeout += extra_time
+
+        return timeout
+
+    def _time_out(self):
+        # Whatever comes later is dropped along with the channel
+        self.timed_out = True
+        raise ConnectionTimeout("SRCDS didn't respond in time")
+
+    def _check_message(self, message):
+        """Return delivered message, None means the channel was closed."""
+        if message is None:
+            self.closed = True
+            raise ConnectionClose("Channel closed by the other side")
+
+        return message
+
+    def stop(self):
+        self.connection.close_channel(self)
+
+
+class Channel(BaseChannel):
+    def __init__(self, connection, id_):
+        super(Channel, self).__init__(connection, id_)
+
+        self._messages = Queue()
+
+    def deliver(self, message):
+        self._messages.put(message)
+
+    def send_message(self, message):
+        self._check_open()
+
+        try:
+            self.connection.send_frame(self.id, message)
+        except ConnectionTimeout:
+            self.timed_out = True
+            raise
+
+    def receive_message(self, extra_time=0):
+        try:
+            message = self._messages.get(
+                timeout=self._get_read_timeout(extra_time))
+
+        except Empty:
+            self._time_out()
+
+        return self._check_message(message)
+
+
+class MultiplexedConnection(SockClient):
+    """Single connection shared by many concurrent exchanges.
+
+    Every frame carries a channel ID. Channels are opened implicitly by
+    the first frame sent over them, so SRCDS creates a separate
+    SiteClient for every channel. Frames are routed to the waiting
+    channels by a reader thread, so responses can come in any order.
+    """
+    def __init__(self, sock, serializer=None, read_timeout=None,
+                 write_timeout=None):
+
+        super(MultiplexedConnection, self).__init__(
+            sock, serializer, read_timeout, write_timeout)
+
+        self.reader.header = MULTIPLEXED_HEADER
+
+        # Socket is shared by the reader thread and the writers, so its
+        # timeout is only there for writes; channels time out on their own
+        sock.settimeout(write_timeout)
+
+        self.running = True
+        self.last_used = time()
+
+        self._channels = {}
+        self._next_channel_id = 1
+        self._lock = Lock()
+        self._write_lock = Lock()
+
+        self._reader = Thread(target=self._read_frames)
+        self._reader.daemon = True
+        self._reader.start()
+
+    @property
+    def load(self):
+        return len(self._channels)
+
+    def _read_frames(self):
+        try:
+            while self.running:
+                try:
+                    frame = self.reader.read_frame(self.sock)
+                except socket.timeout:
+                    continue
+
+                if frame is None:
+                    break
+
+                (channel_id, flags, length), message = frame
+                if flags & FLAG_CLOSE:
+                    with self._lock:
+                        channel = self._channels.pop(channel_id, None)
+
+                    if channel is not None:
+                        channel.deliver(None)
+
+                    continue
+
+                with self._lock:
+                    channel = self._channels.get(channel_id)
+
+                if channel is not None:
+                    channel.deliver_chunk(message, flags & FLAG_MORE)
+
+        except socket.error:
+            pass
+
+        self.stop()
+
+    def open_channel(self):
+        with self._lock:
+            if not self.running:
+                raise ConnectionClose("Connection is closed")
+
+            channel = Channel(self, self._next_channel_id)
+            self._channels[channel.id] = channel
+
+            self._next_channel_id += 1
+            if self._next_channel_id > MAX_CHANNEL_ID:
+                self._next_channel_id = 1
+
+        return channel
+
+    def close_channel(self, channel):
+        with self._lock:
+            self._channels.pop(channel.id, None)
+            self.last_used = time()
+
+        if channel.closed:
+            return
+
+        channel.closed = True
+        try:
+            self.send_frame(channel.id, b'', FLAG_CLOSE)
+        except (ConnectionClose, socket.error):
+            pass
+
+    def send_frame(self, channel_id, message, flags=0):
+        with self._write_lock:
+            try:
+                write_frame(self.sock, MULTIPLEXED_HEADER,
+                            (channel_id, flags, len(message)), message)
+
+            except socket.timeout:
+                # Frame might have been sent partially, nothing else can
+                # be sent over this connection
+                self.timed_out = True
+                self.stop()
+                raise ConnectionTimeout(
+                    "SRCDS didn't accept the message in time")
+
+    def stop(self):
+        with self._lock:
+            if not self.running:
+                return
+
+            self.running = False
+            channels = list(self._channels.values())
+            self._channels.clear()
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+        super(MultiplexedConnection, self).stop()
+
+        # Wake up everybody who waits for a response
+        for channel in channels:
+            channel.deliver(None)
+
+
+class BaseMultiplexedConnectionPool(object):
+    """Bookkeeping of the multiplexed pools, without any I/O or locking.
+
+    Methods that touch the connections are called under the subclass'
+    _condition.
+    """
+    protocols = (PROTOCOL_MULTIPLEXED, PROTOCOL_LEGACY)
+
+    def __init__(self, host, port, min_size=0, max_size=4, max_channels=64,
+                 idle_timeout=60.0, acquire_timeout=None,
+                 serializers=SUPPORTED_SERIALIZERS, connect_timeout=None,
+                 read_timeout=None, write_timeout=None):
+
+        super(BaseMultiplexedConnectionPool, self).__init__()
+
+        if max_size < 1:
+            raise ValueError("Pool max size should be at least 1")
+
+        self.host = host
+        self.port = port
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.max_channels = max_channels
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.serializers = serializers
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+
+        self.fallback = None
+
+        self._connections = []
+        self._connecting = 0
+
+    @property
+    def size(self):
+        if self.fallback is not None:
+            return self.fallback.size
+
+        return len(self._connections)
+
+    def _get_fallback_options(self):
+        return {
+            'min_size': self.min_size,
+            'max_size': self.max_size * self.max_channels,
+            'idle_timeout': self.idle_timeout,
+            'acquire_timeout': self.acquire_timeout,
+            'serializers': self.serializers,
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout,
+            'write_timeout': self.write_timeout,
+        }
+
+    def _forget_connections(self):
+        now = time()
+        connections = []
+        for connection in self._connections:
+            if not connection.running:
+                continue
+
+            if (self.idle_timeout is not None and
+                    connection.load == 0 and
+                    len(connections) >= self.min_size and
+                    now - connection.last_used > self.idle_timeout):
+
+                connection.stop()
+                continue
+
+            connections.append(connection)
+
+        self._connections = connections
+
+    def _pick_connection(self):
+        """Return the least loaded connection with a free channel."""
+        self._forget_connections()
+
+        if self._connections:
+            connection = min(self._connections, key=lambda c: c.load)
+            if connection.load < self.max_channels:
+                return connection
+
+        return None
+
+    def _reserve(self):
+        """Count in a new connection, return False if the pool is full."""
+        if len(self._connections) + self._connecting >= self.max_size:
+            return False
+
+        self._connecting += 1
+        return True
+
+    def _timeout_message(self):
+        return "Timed out waiting for a free channel to {}:{}".format(
+            self.host, self.port)
+
+    def _connected(self, connection):
+        """Count the connection attempt out (and the connection in)."""
+        self._connecting -= 1
+        if connection is not None:
+            self._connections.append(connection)
+
+
+class MultiplexedConnectionPool(BaseMultiplexedConnectionPool):
+    """Pool that hands out channels over a few shared connections.
+
+    If SRCDS refuses to multiplex, the pool falls back to the regular
+    ConnectionPool that uses legacy framing.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MultiplexedConnectionPool, self).__init__(*args, **kwargs)
+
+        self._condition = Condition()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect((self.host, self.port))
+        except socket.error:
+            sock.close()
+            raise
+
+        # Negotiation is bound by the connect timeout, too
+        client = SockClient(
+            sock,
+            read_timeout=self.connect_timeout,
+            write_timeout=self.connect_timeout,
+        )
+        try:
+            protocol = client.negotiate(self.protocols, self.serializers)
+
+        except Exception:
+            client.stop()
+            raise
+
+        if protocol == PROTOCOL_MULTIPLEXED:
+            return MultiplexedConnection(
+                sock, client.serializer, self.read_timeout, self.write_timeout)
+
+        client.stop()
+        return None
+
+    def _get_connection(self):
+        deadline = get_deadline(self.acquire_timeout)
+
+        with self._condition:
+            while True:
+                connection = self._pick_connection()
+                if connection is not None:
+                    return connection
+
+                if self._reserve():
+                    break
+
+                self._condition.wait(
+                    get_remaining(deadline, self._timeout_message()))
+
+        connection = None
+        try:
+            connection = self._connect()
+
+        finally:
+            with self._condition:
+                self._connected(connection)
+                self._condition.notify_all()
+
+        return connection
+
+    def acquire(self):
+        if self.fallback is not None:
+            return self.fallback.acquire()
+
+        connection = self._get_connection()
+        if connection is None:
+            # Several first acquires may get refused at once, all of them
+            # should end up in the same fallback pool
+            with self._condition:
+                if self.fallback is None:
+                    self.fallback = ConnectionPool(
+                        self.host, self.port, **self._get_fallback_options())
+
+            return self.fallback.acquire()
+
+        return connection.open_channel()
+
+    def _close_channel(self, channel):
+        channel.stop()
+        with self._condition:
+            self._condition.notify_all()
+
+    def release(self, client):
+        if not client.multiplexed:
+            return self.fallback.release(client)
+
+        self._close_channel(client)
+
+    def discard(self, client):
+        if not client.multiplexed:
+            return self.fallback.discard(client)
+
+        self._close_channel(client)
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
+
+        with self._condition:
+            for connection in self._connections:
+                connection.stop()
+
+            self._connections = []
@@ -1,6 +1,6 @@
 from . import (
     base_authed_offline_request, base_authed_request, get_base_authed_route,
-    get_base_authed_offline_route, json_authed_request)
+    get_base_authed_offline_route, json_authed_request, MultiServerExchanger)
 
 
 class PluginInstance:
@@ -30,3 +30,6 @@ class PluginInstance:
 
     def json_authed_offline_request(self, page_id, *args, **kwargs):
         raise NotImplementedError
+
+    def get_multi_server_exchanger(self, server_ids=None, timeout=None):
+        return MultiServerExchanger(self.plugin_id, server_ids, timeout)
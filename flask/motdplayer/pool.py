@@ -0,0 +1,210 @@
+from select import select
+import socket
+from threading import Condition
+from time import time
+
+from .client import PROTOCOL_LEGACY, SockClient
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def get_deadline(timeout):
+    return None if timeout is None else time() + timeout
+
+
+def get_remaining(deadline, message):
+    """Return time left until the deadline, None if there's no deadline.
+
+    Raises PoolTimeout with the message once the deadline has passed.
+    """
+    if deadline is None:
+        return None
+
+    remaining = deadline - time()
+    if remaining <= 0:
+        raise PoolTimeout(message)
+
+    return remaining
+
+
+class BaseConnectionPool(object):
+    """Bookkeeping of the pools, without any I/O or locking.
+
+    Methods that touch the idle list are called under the subclass'
+    _condition.
+    """
+    def __init__(self, host, port, min_size=0, max_size=16,
+                 idle_timeout=60.0, acquire_timeout=None, serializers=None,
+                 connect_timeout=None, read_timeout=None, write_timeout=None):
+
+        super(BaseConnectionPool, self).__init__()
+
+        if max_size < 1:
+            raise ValueError("Pool max size should be at least 1")
+
+        self.host = host
+        self.port = port
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+
+        # Connections only negotiate the serializer if we're given a choice,
+        # SRCDS that doesn't support negotiation only speaks legacy JSON
+        self.serializers = serializers
+
+        # None means no timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+
+        # Number of connections that are currently open, both idle and busy
+        self._size = 0
+
+        # (client, released_at) pairs, the most recently used one goes last
+        self._idle = []
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle_size(self):
+        return len(self._idle)
+
+    @staticmethod
+    def _is_alive(client):
+        raise NotImplementedError
+
+    def _evict_idle(self):
+        if self.idle_timeout is None:
+            return
+
+        expire_before = time() - self.idle_timeout
+        while self._idle and self._size > self.min_size:
+            client, released_at = self._idle[0]
+            if released_at > expire_before:
+                break
+
+            del self._idle[0]
+            self._close(client)
+
+    def _close(self, client):
+        try:
+            client.stop()
+        except socket.error:
+            pass
+
+        self._size -= 1
+        self._condition.notify()
+
+    def _take_idle(self):
+        """Return live idle client, or None if there are none."""
+        self._evict_idle()
+
+        while self._idle:
+            client, released_at = self._idle.pop()
+            if self._is_alive(client):
+                return client
+
+            self._close(client)
+
+        return None
+
+    def _reserve(self):
+        """Count in a new connection, return False if the pool is full."""
+        if self._size >= self.max_size:
+            return False
+
+        self._size += 1
+        return True
+
+    def _timeout_message(self):
+        return "Timed out waiting for a free connection to {}:{}".format(
+            self.host, self.port)
+
+
+class ConnectionPool(BaseConnectionPool):
+    def __init__(self, *args, **kwargs):
+        super(ConnectionPool, self).__init__(*args, **kwargs)
+
+        self._condition = Condition()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect((self.host, self.port))
+        except socket.error:
+            sock.close()
+            raise
+
+        # Negotiation is bound by the connect timeout, too
+        client = SockClient(
+            sock,
+            read_timeout=self.connect_timeout,
+            write_timeout=self.connect_timeout,
+        )
+        if self.serializers:
+            try:
+                client.negotiate((PROTOCOL_LEGACY, ), self.serializers)
+
+            except Exception:
+                client.stop()
+                raise
+
+        client.read_timeout = self.read_timeout
+        client.write_timeout = self.write_timeout
+        return client
+
+    @staticmethod
+    def _is_alive(client):
+        # Nothing should ever be sent to an idle connection, so if the socket
+        # turns out to be readable, the other end has closed it
+        try:
+            r, w, e = select([client.sock], [], [], 0)
+        except (ValueError, socket.error):
+            return False
+
+        return not r
+
+    def acquire(self):
+        deadline = get_deadline(self.acquire_timeout)
+
+        with self._condition:
+            while True:
+                client = self._take_idle()
+                if client is not None:
+                    return client
+
+                if self._reserve():
+                    break
+
+                self._condition.wait(
+                    get_remaining(deadline, self._timeout_message()))
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+
+            raise
+
+    def release(self, client):
+        with self._condition:
+            self._idle.append((client, time()))
+            self._condition.notify()
+
+    def discard(self, client):
+        with self._condition:
+            self._close(client)
+
+    def close(self):
+        with self._condition:
+            while self._idle:
+                client, released_at = self._idle.pop()
+                self._close(client)
@@ -0,0 +1,178 @@
+"""In-memory cache of custom data answers that are the same for everyone.
+
+Plugins declare which actions (custom_data['action']) of a page can be
+cached, for how long, and which custom_data fields the answer depends on:
+
+    @plugin.json_authed_request("stats", cacheable_actions={
+        'top10': CachePolicy(ttl=30, key_fields=('map', )),
+    })
+
+Concurrent misses of the same key are single-flighted: only one of them
+reaches SRCDS, the others wait for its answer. Failed exchanges (None)
+are not cached. Cached answers are shared, views must not modify them.
+"""
+from collections import OrderedDict
+from json import dumps
+from threading import Event, Lock
+from time import time
+
+
+ACTION_FIELD = 'action'
+
+
+class CachePolicy(object):
+    def __init__(self, ttl, key_fields=()):
+        super(CachePolicy, self).__init__()
+
+        self.ttl = ttl
+        self.key_fields = tuple(key_fields)
+
+
+class _Flight(object):
+    def __init__(self):
+        super(_Flight, self).__init__()
+
+        self.done = Event()
+        self.value = None
+
+
+class ResponseCache(object):
+    """Bounded LRU cache with per-entry TTL."""
+    def __init__(self, max_size=1024):
+        super(ResponseCache, self).__init__()
+
+        self.max_size = max_size
+
+        # key -> (expires_at, value), the most recently used one goes last
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = Lock()
+
+        # Misses include coalesced lookups (those that waited for another
+        # request to load the same key), so misses - coalesced of them
+        # have reached SRCDS
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time():
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries[key] = entry
+        self.hits += 1
+        return value
+
+    def _set(self, key, value, ttl):
+        self._entries.pop(key, None)
+        self._entries[key] = (time() + ttl, value)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def count_coalesced(self):
+        with self._lock:
+            self.coalesced += 1
+
+    def get_or_load(self, key, ttl, load):
+        """Return cached value, or the one load() returns (and cache it)."""
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                return value
+
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+            else:
+                leader_flight = self._flights[key] = _Flight()
+
+        if flight is not None:
+            flight.done.wait()
+            return flight.value
+
+        value = None
+        try:
+            value = load()
+
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if value is not None:
+                    self._set(key, value, ttl)
+
+            leader_flight.value = value
+            leader_flight.done.set()
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class PageCache(object):
+    """Cache policies of one page."""
+    def __init__(self, cache, scope, policies):
+        super(PageCache, self).__init__()
+
+        self.cache = cache
+
+        # (server ID, plugin ID, page ID)
+        self.scope = scope
+        self.policies = policies
+
+    def get_key(self, custom_data):
+        """Return (key, TTL), or None if the answer can't be cached."""
+        if not isinstance(custom_data, dict):
+            return None
+
+        action = custom_data.get(ACTION_FIELD)
+        try:
+            policy = self.policies.get(action)
+        except TypeError:
+            # Unhashable action can't be one of the cacheable ones
+            return None
+
+        if policy is None:
+            return None
+
+        fields = dumps(
+            [custom_data.get(field) for field in policy.key_fields],
+            sort_keys=True,
+        )
+        return (self.scope, action, fields), policy.ttl
@@ -0,0 +1,113 @@
+from binascii import hexlify, unhexlify, Error as BinasciiError
+from collections import OrderedDict
+from hashlib import sha256
+import hmac
+import os
+from struct import Struct
+from threading import Lock
+from time import time
+
+
+# Expiry timestamp (4 bytes) + nonce (8 bytes)
+TOKEN_HEADER = Struct('>I8s')
+TOKEN_HEADER_HEX_LENGTH = TOKEN_HEADER.size * 2
+TOKEN_LENGTH = TOKEN_HEADER_HEX_LENGTH + sha256().digest_size * 2
+
+
+class NonceWindow(object):
+    """Bounded memory of the nonces that were already used.
+
+    Nonces are forgotten once their tokens expire. If the window is full,
+    the oldest nonces are forgotten even before that.
+    """
+    def __init__(self, max_size):
+        super(NonceWindow, self).__init__()
+
+        self.max_size = max_size
+
+        # nonce -> expiry, tokens have the same TTL, so the oldest go first
+        self._nonces = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._nonces)
+
+    def use(self, nonce, expiry, now):
+        """Remember the nonce, return False if it's been used already."""
+        with self._lock:
+            while self._nonces:
+                oldest_nonce, oldest_expiry = next(iter(self._nonces.items()))
+                if (oldest_expiry >= now and
+                        len(self._nonces) < self.max_size):
+
+                    break
+
+                del self._nonces[oldest_nonce]
+
+            if nonce in self._nonces:
+                return False
+
+            self._nonces[nonce] = expiry
+            return True
+
+
+class WebTokenSigner(object):
+    """Issues and verifies stateless single-use web auth tokens.
+
+    Token is an HMAC of everything it's bound to (server, plugin, page,
+    player, session, expiry and a random nonce), signed with the server
+    salt. Verifying one doesn't touch the database; replays are caught by
+    the in-memory nonce window of this process.
+    """
+    def __init__(self, keys, ttl=600, window_size=100000):
+        super(WebTokenSigner, self).__init__()
+
+        self.keys = keys
+        self.ttl = ttl
+        self.nonces = NonceWindow(window_size)
+
+    def _sign(self, server_id, plugin_id, page_id, steamid, session_id,
+              header):
+
+        message = '\0'.join((
+            server_id, plugin_id, page_id, steamid, str(session_id)
+        )).encode('utf-8') + header
+
+        return hmac.new(self.keys[server_id], message, sha256).hexdigest()
+
+    def issue(self, server_id, plugin_id, page_id, steamid, session_id):
+        header = TOKEN_HEADER.pack(int(time() + self.ttl), os.urandom(8))
+        return hexlify(header).decode('ascii') + self._sign(
+            server_id, plugin_id, page_id, steamid, session_id, header)
+
+    def verify(self, token, server_id, plugin_id, page_id, steamid,
+               session_id, consume=True):
+
+        if len(token) != TOKEN_LENGTH:
+            return False
+
+        # Token comes from the client, so it may be anything
+        try:
+            header = unhexlify(token[:TOKEN_HEADER_HEX_LENGTH].encode('ascii'))
+            token_signature = token[TOKEN_HEADER_HEX_LENGTH:].encode('ascii')
+        except (BinasciiError, TypeError, UnicodeError):
+            return False
+
+        expiry, nonce = TOKEN_HEADER.unpack(header)
+
+        now = time()
+        if expiry < now:
+            return False
+
+        signature = self._sign(
+            server_id, plugin_id, page_id, steamid, session_id, header)
+
+        if not hmac.compare_digest(
+                token_signature, signature.encode('ascii')):
+
+            return False
+
+        if not consume:
+            return True
+
+        return self.nonces.use(nonce, expiry, now)
@@ -1,30 +1,194 @@
-from json import dumps, loads
+import socket
 
+from .client import BadMessage, ConnectionClose
+
+
+# Answer to custom data when SRCDS knows the page already has it
+NOT_MODIFIED = object()
+
+
+def check_custom_data(data):
+    if not isinstance(data, dict):
+        raise TypeError("Excepted type of custom data: 'dict', got '{}' "
+                        "instead".format(type(data)))
+
+
+# Messages are built here and answers are read here, so that SRCDSClient
+# and aio.AsyncSRCDSClient only differ in how they're sent
+def get_identity_message(steamid, salt, session_id):
+    return {
+        'action': "set_identity",
+        'new_salt': salt,
+        'steamid': steamid,
+        'session_id': session_id,
+    }
+
+
+def get_retarget_message(new_page_id):
+    return {
+        'action': "retarget",
+        'new_page_id': new_page_id,
+    }
+
+
+def get_custom_data_message(data, known_hash=None):
+    """Return message with custom data for the session.
+
+    known_hash is the hash of the answer the page has, SRCDS doesn't send
+    the answer again if it's still the same.
+    """
+    check_custom_data(data)
+    message = {
+        'action': "receive_custom_data",
+        'custom_data': data,
+    }
+
+    if known_hash:
+        message['known_hash'] = known_hash
+
+    return message
+
+
+def get_custom_data_batch_message(data_batch, known_hashes=None):
+    for data in data_batch:
+        check_custom_data(data)
+
+    message = {
+        'action': "receive_custom_data_batch",
+        'custom_data_batch': data_batch,
+    }
+
+    if known_hashes and any(known_hashes):
+        message['known_hash_batch'] = list(known_hashes)
+
+    return message
+
+
+def get_server_data_message(plugin_id, data):
+    check_custom_data(data)
+    return {
+        'action': "receive_server_data",
+        'plugin_id': plugin_id,
+        'custom_data': data,
+    }
+
+
+def get_poll_message(timeout):
+    return {
+        'action': "poll",
+        'timeout': timeout,
+    }
+
+
+def get_custom_data(response):
+    """Return custom data of the answer, None if the exchange failed."""
+    if response is None:
+        return None
+
+    if response.get('not_modified'):
+        return NOT_MODIFIED
+
+    return response['custom_data']
+
+
+def get_custom_data_batch(response):
+    """Return answer to every piece of the batch (None if that one failed).
+
+    None means the whole exchange failed.
+    """
+    if response is None:
+        return None
+
+    return [
+        get_custom_data(item) if item['status'] == "OK" else None
+        for item in response['custom_data_batch']
+    ]
+
+
+class BaseSRCDSClient(object):
+    def __init__(self, client, pool=None):
+        super(BaseSRCDSClient, self).__init__()
 
-class SRCDSClient(object):
-    def __init__(self, client):
         self.client = client
+        self.pool = pool
+
+    def _encode(self, message):
+        return self.client.serializer.encode(message)
+
+    def _decode(self, message):
+        try:
+            return self.client.serializer.decode(message)
+        except ValueError as e:
+            raise BadMessage("Can't decode message from SRCDS: {}".format(e))
+
+
+class SRCDSClient(BaseSRCDSClient):
+    def _send(self, message):
+        self.client.send_message(self._encode(message))
+
+    def _receive(self, extra_time=0):
+        return self._decode(self.client.receive_message(extra_time))
 
     def end_communication(self, send_action=True):
         if self.client is None:
             return
 
-        if send_action:
-            self.client.send_message(dumps({
-                'action': "end_communication",
-            }).encode('utf-8'))
+        client, self.client = self.client, None
+
+        if self.pool is None:
+            if send_action:
+                client.send_message(
+                    client.serializer.action("end_communication"))
+
+            client.stop()
+            return
+
+        # If we're not supposed to talk to SRCDS anymore, the connection
+        # is considered broken and should not get back to the pool
+        if not send_action:
+            self.pool.discard(client)
+            return
+
+        # Multiplexed channels are not reused, closing one is enough
+        if client.multiplexed:
+            self.pool.release(client)
+            return
+
+        try:
+            client.send_message(client.serializer.action("release"))
+
+        except (ConnectionClose, socket.error):
+            self.pool.discard(client)
+
+        else:
+            self.pool.release(client)
 
-        self.client.stop()
-        self.client = None
+    def ping(self):
+        """Check that SRCDS answers, end the communication either way."""
+        try:
+            self.client.send_message(self.client.serializer.action("ping"))
+            response = self._receive()
+
+        except (ConnectionClose, socket.error):
+            self.end_communication(send_action=False)
+            return False
+
+        if response['status'] == "OK":
+            self.end_communication(send_action=True)
+            return True
+
+        self.end_communication(send_action=False)
+        return False
 
     def set_identity(self, steamid, salt, session_id):
-        self.client.send_message(dumps({
-            'action': "set_identity",
-            'new_salt': salt,
-            'steamid': steamid,
-            'session_id': session_id,
-        }).encode('utf-8'))
-        response = loads(self.client.receive_message().decode('utf-8'))
+        # Connection is handed back to the endpoint whatever happens here
+        try:
+            self._send(get_identity_message(steamid, salt, session_id))
+            response = self._receive()
+
+        except (ConnectionClose, socket.error):
+            self.end_communication(send_action=False)
+            return False
 
         if response['status'] == "OK":
             return True
@@ -32,34 +196,69 @@ class SRCDSClient(object):
         self.end_communication(send_action=False)
         return False
 
-    def request_retargeting(self, new_page_id):
-        self.client.send_message(dumps({
-            'action': "retarget",
-            'new_page_id': new_page_id,
-        }).encode('utf-8'))
-        response = loads(self.client.receive_message().decode('utf-8'))
+    def _exchange(self, message, extra_time=0):
+        """Send message, return the response or None if it failed.
+
+        Pooled sockets may have been closed by SRCDS in the meantime, so a
+        failure to send is handled the same way as a failure to receive.
+        """
+        try:
+            self._send(message)
+            response = self._receive(extra_time)
+
+        except (ConnectionClose, socket.error):
+            self.end_communication(send_action=False)
+            return None
+
+        if response['status'] == "OK":
+            return response
 
         self.end_communication(send_action=False)
+        return None
 
-        return response['status'] == "OK"
+    def request_retargeting(self, new_page_id, end_communication=True):
+        response = self._exchange(get_retarget_message(new_page_id))
 
-    def exchange_custom_data(self, data):
-        if not isinstance(data, dict):
-            self.client.send_message(dumps({
+        if response is None:
+            return False
+
+        if end_communication:
+            self.end_communication(send_action=True)
+
+        return True
+
+    def exchange_custom_data(self, data, known_hash=None):
+        try:
+            message = get_custom_data_message(data, known_hash)
+
+        except TypeError:
+            self._send({
                 'action': "receive_custom_data",
                 'custom_data': None,
-            }))
-            raise TypeError("Excepted type of custom data: 'dict', got '{}' "
-                            "instead".format(type(data)))
+            })
+            raise
 
-        self.client.send_message(dumps({
-            'action': "receive_custom_data",
-            'custom_data': data,
-        }).encode('utf-8'))
+        # SRCDS drops the channel if streamed answer fails half way through
+        return get_custom_data(self._exchange(message))
 
-        response = loads(self.client.receive_message().decode('utf-8'))
+    def exchange_custom_data_batch(self, data_batch, known_hashes=None):
+        """Exchange several pieces of custom data in one round trip.
 
-        if response['status'] == "OK":
-            return response['custom_data']
+        Returns a list with the answer to every piece (None if that one
+        failed), or None if the whole exchange failed.
+        """
+        return get_custom_data_batch(self._exchange(
+            get_custom_data_batch_message(data_batch, known_hashes)))
 
-        return None
+    def exchange_server_data(self, plugin_id, data):
+        """Exchange custom data with the plugin itself, not a player.
+
+        Must be used instead of set_identity, not after it.
+        """
+        return get_custom_data(
+            self._exchange(get_server_data_message(plugin_id, data)))
+
+    def poll(self, timeout):
+        """Wait for the data pushed to the session, {} means there was none."""
+        return get_custom_data(
+            self._exchange(get_poll_message(timeout), extra_time=timeout))
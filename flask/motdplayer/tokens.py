@@ -0,0 +1,75 @@
+"""Auth token engine shared by SRCDS and the bridge.
+
+Token is sha512 of (personal salt + server ID + plugin ID + SteamID +
+page ID + session ID) followed by the server's secret salt. Tokens are
+compared in constant time.
+"""
+from hashlib import sha512
+import hmac
+import os
+import string
+
+
+SALT_CHARACTERS = string.ascii_letters + string.digits
+SALT_LENGTH = 64
+
+# Random bytes above this limit are dropped, so that every salt character
+# is equally likely
+_SALT_BYTE_LIMIT = 256 - 256 % len(SALT_CHARACTERS)
+
+
+def get_new_salt(length=SALT_LENGTH):
+    characters = []
+    while len(characters) < length:
+        for byte in bytearray(os.urandom(length + length // 4)):
+            if byte < _SALT_BYTE_LIMIT:
+                characters.append(
+                    SALT_CHARACTERS[byte % len(SALT_CHARACTERS)])
+
+    return ''.join(characters[:length])
+
+
+def compare_tokens(token, expected_token):
+    if token is None:
+        return False
+
+    return hmac.compare_digest(
+        token.encode('utf-8'), expected_token.encode('utf-8'))
+
+
+class TokenEngine(object):
+    def __init__(self, server_id, secret_salt):
+        super(TokenEngine, self).__init__()
+
+        self.server_id = server_id
+        self.secret_salt = secret_salt
+
+    def get_token(self, salt, plugin_id, steamid, page_id, session_id):
+        return sha512(
+            (
+                salt +
+                self.server_id +
+                plugin_id +
+                steamid +
+                page_id +
+                str(session_id)
+            ).encode('ascii') + self.secret_salt
+        ).hexdigest()
+
+    def get_tokens(self, plugin_id, page_id, requests):
+        """Issue tokens for (salt, steamid, session_id) requests."""
+        server_and_plugin_id = self.server_id + plugin_id
+        secret_salt = self.secret_salt
+
+        return [
+            sha512(
+                (
+                    salt +
+                    server_and_plugin_id +
+                    steamid +
+                    page_id +
+                    str(session_id)
+                ).encode('ascii') + secret_salt
+            ).hexdigest()
+            for salt, steamid, session_id in requests
+        ]
@@ -1,10 +1,9 @@
-import socket
+from flask import abort, jsonify, make_response, render_template, request
 
-from flask import jsonify, render_template, request
-
-from . import AUTH_BY_SRCDS, config, User
-from .client import SockClient
-from .srcds_client import SRCDSClient
+from . import (
+    AUTH_BY_WEB, authenticate_and_connect, authenticate_user, config,
+    connect_srcds, get_srcds_option, load_user, page_caches, page_views,
+    render_page, render_page_error, srcds_available)
 
 
 def init_views(app, db):
@@ -37,56 +36,128 @@ def init_views(app, db):
             })
 
         steamid = str(steamid)
-        user = User.query.filter(
-            User.steamid == steamid, User.server_id == server_id).first()
+        user, srcds_client, error = authenticate_and_connect(
+            server_id, plugin_id, page_id, steamid, auth_method, auth_token,
+            session_id)
+
+        if error is not None:
+            return jsonify({
+                'status': "ERROR_" + error,
+            })
 
-        if user is None:
-            user = User(server_id, steamid)
-            db.session.add(user)
+        try:
+            retargeted = srcds_client.request_retargeting(new_page_id)
 
-        if not user.authenticate(
-                auth_method, plugin_id, page_id, auth_token, session_id):
+        except Exception:
+            srcds_client.end_communication(send_action=False)
+            raise
 
-            db.session.rollback()
+        if not retargeted:
             return jsonify({
-                'status': "ERROR_INVALID_AUTH",
+                'status': "ERROR_RETARGETING_REJECTED",
             })
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((
-            config.get('srcds', 'host'), int(config.get('srcds', 'port'))
-        ))
-        client = SockClient(sock)
-        srcds_client = SRCDSClient(client)
+        return jsonify({
+            'status': "OK",
+            'web_auth_token': user.get_web_auth_token(
+                plugin_id, new_page_id, session_id),
+        })
 
-        if auth_method == AUTH_BY_SRCDS:
-            new_salt = user.get_new_salt()
+    @app.route(config.get('application', 'navigate_url'))
+    def route_navigate(server_id, plugin_id, new_page_id, page_id, steamid,
+                       auth_method, auth_token, session_id):
 
-            if not srcds_client.set_identity(steamid, new_salt, session_id):
-                return jsonify({
-                    'status': "ERROR_IDENTITY_REJECTED",
-                })
+        # Retarget the session and render the new page in one go, over
+        # the same SRCDS connection
+        f = page_views.get((server_id, plugin_id, new_page_id))
+        if f is None:
+            abort(404)
+
+        steamid = str(steamid)
+        user, srcds_client, error = authenticate_and_connect(
+            server_id, plugin_id, page_id, steamid, auth_method, auth_token,
+            session_id)
+
+        if error is not None:
+            return render_page_error(f, error)
+
+        try:
+            retargeted = srcds_client.request_retargeting(
+                new_page_id, end_communication=False)
+
+        except Exception:
+            srcds_client.end_communication(send_action=False)
+            raise
+
+        if not retargeted:
+            return render_page_error(f, "RETARGETING_REJECTED")
+
+        web_auth_token = user.get_web_auth_token(
+            plugin_id, new_page_id, session_id)
 
-            user.salt = new_salt
+        response = make_response(render_page(
+            f, srcds_client, steamid, web_auth_token, session_id,
+            page_caches.get((server_id, plugin_id, new_page_id))))
 
-        else:
+        # Lets the page swap its content without reloading itself
+        response.headers['X-MOTDPlayer-Page-Id'] = new_page_id
+        response.headers['X-MOTDPlayer-Auth-Token'] = web_auth_token
+        return response
+
+    @app.route(config.get('application', 'poll_url'), methods=['POST', ])
+    def route_json_poll(server_id, plugin_id, page_id, steamid, auth_token,
+                        session_id):
+
+        if request.json['action'] != "poll":
+            return jsonify({
+                'status': "ERROR_BAD_REQUEST",
+            })
+
+        if not srcds_available(server_id):
+            return jsonify({
+                'status': "ERROR_SRCDS_UNAVAILABLE",
+            })
+
+        steamid = str(steamid)
+        user = load_user(server_id, steamid)
+
+        # Poll hangs for a while, so it doesn't use up (or rotate) the
+        # token: other requests of the same page are made with it meanwhile
+        if user is None or authenticate_user(
+                user, AUTH_BY_WEB, plugin_id, page_id, auth_token,
+                session_id, single_use=False) is None:
+
+            return jsonify({
+                'status': "ERROR_INVALID_AUTH",
+            })
+
+        # Waiting poll doesn't hold up other requests to the server
+        srcds_client = connect_srcds(server_id, poll=True)
+        if srcds_client is None:
+            return jsonify({
+                'status': "ERROR_SRCDS_UNAVAILABLE",
+            })
+
+        try:
             if not srcds_client.set_identity(steamid, None, session_id):
                 return jsonify({
                     'status': "ERROR_IDENTITY_REJECTED",
                 })
 
-            web_salt = user.get_new_salt()
-            user.web_salt = web_salt
+            data = srcds_client.poll(
+                float(get_srcds_option(server_id, 'poll_timeout')))
 
-        db.session.commit()
+        except Exception:
+            srcds_client.end_communication(send_action=False)
+            raise
 
-        if not srcds_client.request_retargeting(new_page_id):
+        if data is None:
             return jsonify({
-                'status': "ERROR_RETARGETING_REJECTED",
+                'status': "ERROR_SRCDS_FAILURE",
             })
 
+        srcds_client.end_communication(send_action=True)
         return jsonify({
             'status': "OK",
-            'web_auth_token': user.get_web_auth_token(
-                plugin_id, new_page_id, session_id),
+            'custom_data': data,
         })
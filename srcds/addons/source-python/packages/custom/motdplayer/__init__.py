@@ -1,24 +1,35 @@
+import atexit
 from configparser import ConfigParser
-from hashlib import sha512
-from random import randrange
-from warnings import warn
-
-from sqlalchemy import create_engine, Column, Integer, String
+import os
+from collections import OrderedDict
+from inspect import signature
+from threading import Event, Lock
+from time import sleep, time
+from traceback import print_exc
+
+from sqlalchemy import (
+    create_engine, event, inspect, text, Column, Index, Integer, String)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from core import GAME_NAME
 from cvars import ConVar
-from listeners import OnClientActive, OnClientDisconnect, OnLevelInit
+from listeners import (
+    OnClientActive, OnClientDisconnect, OnLevelInit, OnLevelShutdown,
+    on_tick_listener_manager)
 from listeners.tick import GameThread
 from messages import VGUIMenu
 from paths import CUSTOM_DATA_PATH
 from players.entity import Player
-from players.helpers import index_from_userid
 
+from .client import set_allowed_serializers, SockClient
+from .dispatch import TickDispatcher, TimerWheel, WorkerDispatcher
+from .reactor import ReactorServer
 from .server import SockServer
-from .site_client import SiteClient
+from .site_client import NOT_MODIFIED, SiteClient
 from .steamid import SteamID
+from .tokens import TokenEngine
 
 
 AUTH_BY_SRCDS = 1
@@ -28,13 +39,16 @@ MESSED_UP_GAMES = ('csgo', )
 MOTDPLAYER_DATA_PATH = CUSTOM_DATA_PATH / "motdplayer"
 SECRET_SALT_FILE = MOTDPLAYER_DATA_PATH / "secret_salt.dat"
 CONFIG_FILE = MOTDPLAYER_DATA_PATH / "config.ini"
+SALT_JOURNAL_FILE = MOTDPLAYER_DATA_PATH / "salt_journal.txt"
+FLUSHING_SALT_JOURNAL_FILE = MOTDPLAYER_DATA_PATH / "salt_journal.flushing.txt"
+USERS_INDEX_NAME = "uq_motdplayers_srcds_users_steamid"
 SERVER_ADDR = ConVar('ip').get_string()     # TODO: Better way?
 
 if SECRET_SALT_FILE.isfile():
     with open(SECRET_SALT_FILE, 'rb') as f:
         SECRET_SALT = f.read()
 else:
-    SECRET_SALT = bytes([randrange(256) for x in range(32)])
+    SECRET_SALT = os.urandom(32)
     with open(SECRET_SALT_FILE, 'wb') as f:
         f.write(SECRET_SALT)
 
@@ -44,14 +58,52 @@ config.read(CONFIG_FILE)
 engine = create_engine(config['database']['uri'].format(
     motdplayer_data_path=MOTDPLAYER_DATA_PATH,
 ))
+token_engine = TokenEngine(config['server']['id'], SECRET_SALT)
+
 Base = declarative_base()
 Session = sessionmaker(bind=engine)
 
+
+@event.listens_for(engine, 'connect')
+def on_engine_connect(dbapi_connection, connection_record):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    # Salts are journaled on our side, so a commit doesn't have to
+    # wait for a full fsync, and readers don't block the writer
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
 server = None
 
+# In 'tick' mode session callbacks are only called from the game thread
+if config.get('dispatch', 'mode', fallback="immediate") == "tick":
+    dispatcher = TickDispatcher(
+        time_budget=config.getfloat(
+            'dispatch', 'tick_budget_ms', fallback=2.0) / 1000,
+        max_batch=config.getint('dispatch', 'max_batch', fallback=0),
+    )
+    on_tick_listener_manager.register_listener(dispatcher.drain)
+
+else:
+    dispatcher = None
+
+# In 'immediate' mode they're called from the worker threads
+if dispatcher is None:
+    worker_dispatcher = WorkerDispatcher(
+        config.getint('dispatch', 'workers', fallback=8))
+
+else:
+    worker_dispatcher = None
+
 
 class User(Base):
     __tablename__ = 'motdplayers_srcds_users'
+    __table_args__ = (
+        Index(USERS_INDEX_NAME, 'steamid', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     steamid = Column(String(32))
@@ -61,13 +113,319 @@ class User(Base):
         return "<User({})>".format(self.steamid)
 
 
+def migrate_users_table():
+    """Remove duplicate users and add the unique index to an old table."""
+    inspector = inspect(engine)
+    if User.__tablename__ not in inspector.get_table_names():
+        # Table will be created by create_all() along with the index
+        return
+
+    for index in inspector.get_indexes(User.__tablename__):
+        if index['name'] == USERS_INDEX_NAME:
+            return
+
+    # Keep the most recent row of every user. Subquery is wrapped in a
+    # derived table, otherwise MySQL refuses to delete from the same table
+    with engine.begin() as connection:
+        connection.execute(text(
+            "DELETE FROM {table} WHERE id NOT IN ("
+            "SELECT id FROM (SELECT MAX(id) AS id FROM {table} "
+            "GROUP BY steamid) AS latest_users)".format(
+                table=User.__tablename__)))
+
+    for index in User.__table__.indexes:
+        if index.name == USERS_INDEX_NAME:
+            index.create(bind=engine)
+
+
+def upsert_user_salt(db_session, communityid, salt):
+    """Insert a user or update existing one, commit the result.
+
+    Relies on the unique index: if somebody else has inserted the same
+    user first, our insert fails and we update their row instead.
+    """
+    user = db_session.query(User).filter_by(steamid=communityid).first()
+
+    if user is None:
+        user = User()
+        user.steamid = communityid
+        user.salt = salt
+        db_session.add(user)
+
+        try:
+            db_session.commit()
+            return
+
+        except IntegrityError:
+            db_session.rollback()
+
+        user = db_session.query(User).filter_by(steamid=communityid).one()
+
+    user.salt = salt
+    db_session.commit()
+
+
+migrate_users_table()
 Base.metadata.create_all(engine)
 
 
+class SaltCache(dict):
+    """Personal salts by community ID, shared by all MOTDPlayer instances.
+
+    The cache isn't cleared on level change, so players that are
+    recreated after OnLevelInit don't hit the database at all. Salts of
+    players that are missing from the cache are loaded by a single worker
+    thread that collects them into one batched query.
+    """
+    # How long the worker waits for more players to join the batch
+    BATCH_DELAY = 0.1
+
+    def __init__(self):
+        super().__init__()
+
+        self._pending = set()
+        self._lock = Lock()
+        self._worker = None
+
+    def request(self, motd_player):
+        if motd_player.communityid in self:
+            motd_player.salt = self[motd_player.communityid]
+            return
+
+        with self._lock:
+            self._pending.add(motd_player.communityid)
+
+            if self._worker is None:
+                self._worker = GameThread(target=self._load_pending)
+                self._worker.start()
+
+    def _load_pending(self):
+        sleep(self.BATCH_DELAY)
+
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._worker = None
+                    return
+
+                communityids, self._pending = self._pending, set()
+
+            # Salts that are yet to be written to the database are newer
+            # than those in it
+            salts = salt_journal.get_pending(communityids)
+
+            missing = communityids.difference(salts)
+            if missing:
+                db_session = Session()
+                salts.update(db_session.query(User.steamid, User.salt).filter(
+                    User.steamid.in_(missing)))
+                db_session.close()
+
+            for communityid in communityids:
+                # Salt that was confirmed while we were querying is newer
+                salt = self.setdefault(communityid, salts.get(communityid))
+
+                motd_player = player_manager.get_by_communityid(communityid)
+                if motd_player is not None and motd_player.salt is None:
+                    motd_player.salt = salt
+
+salt_cache = SaltCache()
+
+
+class SaltJournal:
+    """Write-behind storage for confirmed personal salts.
+
+    Every new salt is appended to a small journal file (without fsync)
+    and remembered in memory. A worker thread writes all remembered salts
+    to the database in a single transaction every flush_interval seconds.
+    The journal only matters if the server crashes before that: it's
+    replayed on the next load. stop() writes whatever is left.
+    """
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+
+        self._dirty = {}
+
+        # Salts that are being written to the database right now
+        self._flushing = {}
+
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._stopped = Event()
+        self._flush_requested = Event()
+
+        self._replay()
+        self._file = open(SALT_JOURNAL_FILE, 'a')
+
+        self._worker = GameThread(target=self._run)
+        self._worker.start()
+
+    def _replay(self):
+        for path in (FLUSHING_SALT_JOURNAL_FILE, SALT_JOURNAL_FILE):
+            if not os.path.isfile(path):
+                continue
+
+            with open(path) as f:
+                for line in f:
+                    try:
+                        communityid, salt = line.split()
+                    except ValueError:
+                        # Last line might have been written partially
+                        continue
+
+                    self._dirty[communityid] = salt
+
+        # Journaled salts are newer than those in the database
+        salt_cache.update(self._dirty)
+
+    def record(self, communityid, salt):
+        with self._lock:
+            self._dirty[communityid] = salt
+            self._file.write("{} {}\n".format(communityid, salt))
+            self._file.flush()
+
+    def get_pending(self, communityids):
+        """Return {communityid: salt} of those not in the database yet."""
+        salts = {}
+        with self._lock:
+            for communityid in communityids:
+                salt = self._dirty.get(communityid)
+                if salt is None:
+                    salt = self._flushing.get(communityid)
+
+                if salt is not None:
+                    salts[communityid] = salt
+
+        return salts
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+
+                dirty, self._dirty = self._dirty, {}
+                self._flushing = dirty
+
+                # Salts recorded from now on go to a fresh journal
+                self._file.close()
+                if not os.path.isfile(FLUSHING_SALT_JOURNAL_FILE):
+                    os.replace(SALT_JOURNAL_FILE, FLUSHING_SALT_JOURNAL_FILE)
+                else:
+                    # Previous flush has failed, so its journal is still
+                    # needed, and so is the current one
+                    with open(FLUSHING_SALT_JOURNAL_FILE, 'a') as dst:
+                        with open(SALT_JOURNAL_FILE) as src:
+                            dst.write(src.read())
+
+                self._file = open(SALT_JOURNAL_FILE, 'w')
+
+            try:
+                self._write_to_database(dirty)
+
+            except Exception:
+                with self._lock:
+                    for communityid, salt in dirty.items():
+                        self._dirty.setdefault(communityid, salt)
+
+                    self._flushing = {}
+
+                raise
+
+            with self._lock:
+                self._flushing = {}
+
+            os.remove(FLUSHING_SALT_JOURNAL_FILE)
+
+    @staticmethod
+    def _write_to_database(salts):
+        db_session = Session()
+        try:
+            users = db_session.query(User).filter(
+                User.steamid.in_(salts.keys()))
+
+            missing = set(salts.keys())
+            for user in users:
+                user.salt = salts[user.steamid]
+                missing.discard(user.steamid)
+
+            db_session.commit()
+
+            # Users are only written to the database once they get a salt.
+            # New users are rare, so they're inserted one by one.
+            for communityid in missing:
+                upsert_user_salt(db_session, communityid, salts[communityid])
+
+        finally:
+            db_session.close()
+
+    def request_flush(self):
+        """Make the worker thread flush now, without waiting for it."""
+        self._flush_requested.set()
+
+    def _run(self):
+        while True:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+
+            # stop() flushes whatever is left itself
+            if self._stopped.is_set():
+                return
+
+            try:
+                self.flush()
+            except Exception:
+                print_exc()
+
+    def stop(self):
+        self._stopped.set()
+        self._flush_requested.set()
+        self.flush()
+
+salt_journal = SaltJournal(
+    config.getfloat('database', 'flush_interval', fallback=5.0))
+
+
+# (plugin ID, page ID) -> MOTD URL template, see get_url_template()
+_url_templates = {}
+
+# User messages of spread broadcasts are sent this many per tick
+page_message_dispatcher = TickDispatcher(
+    time_budget=float('inf'),
+    max_batch=config.getint('motd', 'messages_per_tick', fallback=8),
+)
+on_tick_listener_manager.register_listener(page_message_dispatcher.drain)
+
+
+# Sessions are dropped after being unused for idle_ttl seconds or after
+# max_ttl seconds in total (0 disables either), only max_per_player most
+# recently used sessions are kept
+SESSION_IDLE_TTL = config.getfloat('sessions', 'idle_ttl', fallback=1800.0)
+SESSION_MAX_TTL = config.getfloat('sessions', 'max_ttl', fallback=14400.0)
+MAX_SESSIONS_PER_PLAYER = config.getint(
+    'sessions', 'max_per_player', fallback=32)
+
+# Poll for pushed data is answered with nothing at most after this long
+MAX_POLL_TIMEOUT = config.getfloat(
+    'sessions', 'max_poll_timeout', fallback=60.0)
+
+session_timers = TimerWheel(
+    resolution=config.getfloat('sessions', 'timer_resolution', fallback=1.0))
+on_tick_listener_manager.register_listener(session_timers.advance)
+
+
 class SessionClosedException(Exception):
     pass
 
 
+def _takes_known_hash(callback):
+    """Check if the session callback wants to know what the page has."""
+    try:
+        return 'known_hash' in signature(callback).parameters
+    except (TypeError, ValueError):
+        return False
+
+
 class MOTDPlayer:
     class Session:
         def __init__(self, motd_player, id_, callback, retargeting_callback):
@@ -77,64 +435,197 @@ class MOTDPlayer:
             self.callback = callback
             self.retargeting_callback = retargeting_callback
 
+            self.created_at = self.last_used = time()
+
+            # Pushed data that the page hasn't polled yet, and the poll
+            # that waits for it
+            self._pushed = None
+            self._poll_waiter = None
+            self._push_lock = Lock()
+
+        @property
+        def closed(self):
+            return self._closed
+
+        @property
+        def expires_at(self):
+            expires_at = float('inf')
+            if SESSION_IDLE_TTL:
+                expires_at = self.last_used + SESSION_IDLE_TTL
+
+            if SESSION_MAX_TTL:
+                expires_at = min(expires_at, self.created_at + SESSION_MAX_TTL)
+
+            return expires_at
+
+        def touch(self):
+            self.last_used = time()
+            self._motd_player.touch_session(self)
+
         def error(self, error):
             if self._closed:
                 raise SessionClosedException("Please stop data transmission")
 
             self.callback(data=None, error=error)
 
-        def receive(self, data):
+        @property
+        def callback(self):
+            return self._callback
+
+        @callback.setter
+        def callback(self, callback):
+            self._callback = callback
+            self._takes_known_hash = _takes_known_hash(callback)
+
+        def receive(self, data, known_hash=None):
+            # Callback can either return a dict or yield (key, value)
+            # pairs, in which case the answer is streamed to the site
             if self._closed:
                 raise SessionClosedException("Please stop data transmission")
 
+            self.touch()
+
+            # Hash of the answer the page already has, if it has one
+            if self._takes_known_hash:
+                return self.callback(
+                    data=data, error=None, known_hash=known_hash)
+
             return self.callback(data=data, error=None)
 
         def request_retargeting(self, new_page_id):
             if self._closed:
                 raise SessionClosedException("Please stop data transmission")
 
+            self.touch()
             if self.retargeting_callback is None:
                 return None
 
             return self.retargeting_callback(new_page_id)
 
+        def push(self, data):
+            """Send data to the page. If the page hasn't received previous
+            pushes yet, they're merged into one (newer keys win)."""
+            if self._closed:
+                raise SessionClosedException("Please stop data transmission")
+
+            if not isinstance(data, dict):
+                raise TypeError("Excepted type of pushed data: 'dict', got "
+                                "'{}' instead".format(type(data)))
+
+            with self._push_lock:
+                if self._pushed is None:
+                    self._pushed = dict(data)
+                else:
+                    self._pushed.update(data)
+
+                waiter, self._poll_waiter = self._poll_waiter, None
+                if waiter is None:
+                    return
+
+                pushed, self._pushed = self._pushed, None
+
+            waiter(pushed)
+
+        def wait_for_push(self, waiter):
+            """Call waiter with pushed data as soon as there is some."""
+            self.touch()
+
+            with self._push_lock:
+                pushed, self._pushed = self._pushed, None
+                if pushed is None:
+                    previous_waiter, self._poll_waiter = (
+                        self._poll_waiter, waiter)
+                else:
+                    previous_waiter = None
+
+            # Only one poll is answered, the older one gets nothing
+            if previous_waiter is not None:
+                previous_waiter({})
+
+            if pushed is not None:
+                waiter(pushed)
+
+        def cancel_wait(self, waiter):
+            """Forget the waiter, return False if it's been called."""
+            with self._push_lock:
+                if self._poll_waiter is not waiter:
+                    return False
+
+                self._poll_waiter = None
+                return True
+
         def close(self):
             self._closed = True
             self._motd_player.discard_session(self.id)
 
     def __init__(self, player):
         self.player = player
+        self.userid = player.userid
         self.salt = None
         self.communityid = str(SteamID(self.player.steamid).steamid64)
 
         self._next_session_id = 1
-        self._sessions = {}
+
+        # Least recently used sessions go first
+        self._sessions = OrderedDict()
 
     def get_session_for_data_transmission(self, session_id):
-        if session_id not in self._sessions:
+        session = self._sessions.get(session_id)
+        if session is None:
             return None
 
-        session = self._sessions[session_id]
-        for session_ in self._sessions.values():
-            if session_.id != session.id:
-                try:
-                    session_.error("TAKEN_OVER")
-                except Exception as e:
-                    warn(Warning(e))    # TODO: Print traceback instead
+        session.touch()
 
-        self._sessions = {
-            session_id: session
-        }
+        # Usually the session has already taken over all the others
+        if len(self._sessions) == 1:
+            return session
+
+        # Sessions may be touched from other threads meanwhile, so they're
+        # iterated over a snapshot
+        taken_over_sessions = [
+            session_ for session_ in tuple(self._sessions.values())
+            if session_ is not session
+        ]
+
+        self._sessions = OrderedDict(((session_id, session), ))
+
+        for session_ in taken_over_sessions:
+            try:
+                session_.error("TAKEN_OVER")
+            except Exception:
+                print_exc()
 
         return session
 
+    def _drop_session(self, session, error):
+        del self._sessions[session.id]
+
+        try:
+            session.error(error)
+        except Exception:
+            print_exc()
+
+        session._closed = True
+
+    def _expire_session(self, session):
+        if self._sessions.get(session.id) is not session:
+            return
+
+        expires_at = session.expires_at
+        if expires_at > time():
+            # Session was used since it's been scheduled
+            session_timers.schedule(expires_at, self._expire_session, session)
+            return
+
+        self._drop_session(session, "SESSION_EXPIRED")
+
     def close_all_sessions(self, error=None):
         if error is not None:
-            for session in self._sessions.values():
+            for session in tuple(self._sessions.values()):
                 try:
                     session.error(error)
-                except Exception as e:
-                    warn(Warning(e))    # TODO: Print traceback instead
+                except Exception:
+                    print_exc()
 
         self._sessions.clear()
 
@@ -142,76 +633,55 @@ class MOTDPlayer:
         if session_id in self._sessions:
             del self._sessions[session_id]
 
+    def touch_session(self, session):
+        """Mark the session as the most recently used one."""
+        try:
+            if self._sessions[session.id] is session:
+                self._sessions.move_to_end(session.id)
+
+        except KeyError:
+            # Session has been dropped meanwhile
+            pass
+
     def get_auth_token(self, plugin_id, page_id, session_id):
         personal_salt = '' if self.salt is None else self.salt
-        return sha512(
-            (
-                personal_salt +
-                config['server']['id'] +
-                plugin_id +
-                self.communityid +
-                page_id +
-                str(session_id)
-            ).encode('ascii') + SECRET_SALT
-        ).hexdigest()
+        return token_engine.get_token(
+            personal_salt, plugin_id, self.communityid, page_id, session_id)
 
     def confirm_new_salt(self, new_salt):
         self.salt = new_salt
+        salt_cache[self.communityid] = new_salt
 
-        # We save new salt to the database immediately to prevent
-        # losing it when server crashes
-        self.save_to_database()
+        # We journal new salt immediately to prevent losing it when server
+        # crashes, but the database is only updated in batches
+        salt_journal.record(self.communityid, new_salt)
 
         return True
 
-    def load_from_database(self):
-        db_session = Session()
-
-        user = db_session.query(User).filter_by(
-            steamid=self.communityid).first()
-
-        if user is None:
-            user = User()
-            user.steamid = self.communityid
-            db_session.add(user)
-            db_session.commit()
-        else:
-            self.salt = user.salt
-
-        db_session.close()
+    def create_session(self, callback, retargeting_callback=None):
+        session = self.Session(self, self._next_session_id,
+                               callback, retargeting_callback)
 
-    def save_to_database(self):
-        db_session = Session()
+        self._sessions[self._next_session_id] = session
+        self._next_session_id += 1
 
-        user = db_session.query(User).filter_by(
-            steamid=self.communityid).first()
+        while len(self._sessions) > MAX_SESSIONS_PER_PLAYER > 0:
+            self._drop_session(
+                next(iter(self._sessions.values())), "SESSION_EVICTED")
 
-        user.salt = self.salt
-        db_session.commit()
+        if SESSION_IDLE_TTL or SESSION_MAX_TTL:
+            session_timers.schedule(
+                session.expires_at, self._expire_session, session)
 
-        db_session.close()
+        return session
 
     def send_page(self, plugin_id, page_id, callback,
                   retargeting_callback=None, debug=False):
 
-        session = self.Session(self, self._next_session_id,
-                               callback, retargeting_callback)
+        session = self.create_session(callback, retargeting_callback)
 
-        self._sessions[self._next_session_id] = session
-        self._next_session_id += 1
-
-        if GAME_NAME in MESSED_UP_GAMES:
-            url_base = config['motd']['url_csgo']
-        else:
-            url_base = config['motd']['url']
-
-        url = url_base.format(
-            server_addr=SERVER_ADDR,
-            server_id=config['server']['id'],
-            plugin_id=plugin_id,
-            page_id=page_id,
+        url = get_url_template(plugin_id, page_id).format(
             steamid=self.communityid,
-            auth_method=AUTH_BY_SRCDS,
             auth_token=self.get_auth_token(plugin_id, page_id, session.id),
             session_id=session.id,
         )
@@ -229,24 +699,103 @@ class MOTDPlayer:
         return session
 
 
+def get_url_template(plugin_id, page_id):
+    """Return MOTD URL with everything but the per-player fields filled."""
+    key = (plugin_id, page_id)
+    url_template = _url_templates.get(key)
+    if url_template is None:
+        if GAME_NAME in MESSED_UP_GAMES:
+            url_base = config['motd']['url_csgo']
+        else:
+            url_base = config['motd']['url']
+
+        url_template = _url_templates[key] = url_base.format(
+            server_addr=SERVER_ADDR,
+            server_id=config['server']['id'],
+            plugin_id=plugin_id,
+            page_id=page_id,
+            steamid="{steamid}",
+            auth_method=AUTH_BY_SRCDS,
+            auth_token="{auth_token}",
+            session_id="{session_id}",
+        )
+
+    return url_template
+
+
+def get_auth_tokens(plugin_id, page_id, motd_players_and_session_ids):
+    """Issue auth tokens for many (MOTDPlayer, session ID) pairs at once."""
+    return token_engine.get_tokens(plugin_id, page_id, [
+        ('' if motd_player.salt is None else motd_player.salt,
+         motd_player.communityid, session_id)
+        for motd_player, session_id in motd_players_and_session_ids
+    ])
+
+
+# plugin_id -> callback that answers the requests not tied to any player
+server_data_handlers = {}
+
+
+def register_server_data_handler(plugin_id, handler):
+    """Let the site query the plugin about the server as a whole.
+
+    Handler is called with the custom data the site has sent and should
+    return a dict to answer with, just like a session callback.
+    """
+    server_data_handlers[plugin_id] = handler
+
+
+def unregister_server_data_handler(plugin_id):
+    server_data_handlers.pop(plugin_id, None)
+
+
 class MOTDPlayerManager(dict):
+    def __init__(self):
+        super().__init__()
+
+        # Secondary indexes, kept in sync by create() and delete()
+        self._by_communityid = {}
+        self._by_userid = {}
+
     def create(self, player):
         self[player.index] = motd_player = MOTDPlayer(player)
-        GameThread(target=motd_player.load_from_database).start()
+        self._by_communityid[motd_player.communityid] = motd_player
+        self._by_userid[motd_player.userid] = motd_player
+
+        salt_cache.request(motd_player)
 
     def delete(self, motd_player):
         motd_player.close_all_sessions("MOTDPLAYER_DELETED")
         del self[motd_player.player.index]
 
+        if self._by_communityid.get(motd_player.communityid) is motd_player:
+            del self._by_communityid[motd_player.communityid]
+
+        if self._by_userid.get(motd_player.userid) is motd_player:
+            del self._by_userid[motd_player.userid]
+
     def get_by_userid(self, userid):
-        index = index_from_userid(userid)
-        return self.get(index)
+        return self._by_userid.get(userid)
 
     def get_by_communityid(self, communityid):
-        for motd_player in self.values():
-            if motd_player.communityid == communityid:
-                return motd_player
-        return None
+        return self._by_communityid.get(communityid)
+
+    def get_many_by_communityid(self, communityids):
+        """Return {communityid: MOTDPlayer} for those who are online."""
+        by_communityid = self._by_communityid
+        return {
+            communityid: by_communityid[communityid]
+            for communityid in communityids
+            if communityid in by_communityid
+        }
+
+    def get_many_by_userid(self, userids):
+        """Return {userid: MOTDPlayer} for those who are online."""
+        by_userid = self._by_userid
+        return {
+            userid: by_userid[userid]
+            for userid in userids if userid in by_userid
+        }
 
 player_manager = MOTDPlayerManager()
 
@@ -259,9 +808,7 @@ def get_by_userid(userid):
     return player_manager.get_by_userid(userid)
 
 
-def send_page(player, plugin_id, page_id, callback, retargeting_callback=None,
-              debug=False):
-
+def _get_motd_player(player):
     if isinstance(player, Player):
         motd_player = player_manager.get(player.index)
         if motd_player is None:
@@ -280,12 +827,91 @@ def send_page(player, plugin_id, page_id, callback, retargeting_callback=None,
         raise TypeError("Expected either Player instance or a player index, "
                         "got '{}' instead".format(type(player)))
 
+    return motd_player
+
+
+def send_page(player, plugin_id, page_id, callback, retargeting_callback=None,
+              debug=False):
+
+    motd_player = _get_motd_player(player)
     motd_player.send_page(
         plugin_id, page_id, callback, retargeting_callback, debug)
 
 
+def _send_page_message(vgui_menu, motd_player, url):
+    # Player might've left while the message was waiting for its tick
+    if player_manager.get(motd_player.player.index) is not motd_player:
+        return
+
+    vgui_menu.subkeys['msg'] = url
+    vgui_menu.send(motd_player.player.index)
+
+
+def send_page_many(players, plugin_id, page_id, callback_factory,
+                   retargeting_callback_factory=None, debug=False,
+                   spread=False):
+    """Send the same page to many players at once.
+
+    Callbacks are made by calling callback_factory (and optionally
+    retargeting_callback_factory) with every player. All sessions are
+    created and all tokens are issued right away; with spread=True
+    user messages themselves are sent [motd] messages_per_tick at a time.
+    Returns the list of created sessions.
+    """
+    motd_players = [_get_motd_player(player) for player in players]
+
+    sessions = []
+    for player, motd_player in zip(players, motd_players):
+        if retargeting_callback_factory is None:
+            retargeting_callback = None
+        else:
+            retargeting_callback = retargeting_callback_factory(player)
+
+        sessions.append(motd_player.create_session(
+            callback_factory(player), retargeting_callback))
+
+    auth_tokens = get_auth_tokens(plugin_id, page_id, [
+        (motd_player, session.id)
+        for motd_player, session in zip(motd_players, sessions)
+    ])
+
+    url_template = get_url_template(plugin_id, page_id)
+
+    # Only the URL differs between the players, so one message is reused
+    vgui_menu = VGUIMenu(
+        name='info',
+        show=True,
+        subkeys={
+            'title': 'MOTD',
+            'type': '0' if debug else '2',
+            'msg': "",
+        }
+    )
+
+    for motd_player, session, auth_token in zip(
+            motd_players, sessions, auth_tokens):
+
+        url = url_template.format(
+            steamid=motd_player.communityid,
+            auth_token=auth_token,
+            session_id=session.id,
+        )
+
+        if spread:
+            page_message_dispatcher.put(
+                _send_page_message, vgui_menu, motd_player, url)
+        else:
+            _send_page_message(vgui_menu, motd_player, url)
+
+    return sessions
+
+
 def on_client_accepted(client):
-    SiteClient(client)
+    # Legacy connection of SockServer already has a thread of its own
+    if worker_dispatcher is not None and not isinstance(client, SockClient):
+        SiteClient(client, worker_dispatcher.queue())
+    else:
+        SiteClient(client, dispatcher)
 
 
 def restart_server():
@@ -293,7 +919,18 @@ def restart_server():
     if server is not None:
         server.stop()
 
-    server = SockServer(
+    set_allowed_serializers(
+        name.strip() for name in config['server'].get(
+            'serializers', "msgpack,json").split(','))
+
+    # Reactor serves all connections from a single thread, while
+    # SockServer starts a new thread for every connection
+    if config['server'].get('mode', "reactor") == "reactor":
+        server_class = ReactorServer
+    else:
+        server_class = SockServer
+
+    server = server_class(
         host=config['server']['host'],
         port=int(config['server']['port']),
         whitelist=config['server']['whitelist'].split(','),
@@ -304,6 +941,27 @@ def restart_server():
 restart_server()
 
 
+def unload():
+    """Stop serving the site and write the pending salts to the database.
+
+    Called on interpreter shutdown.
+    """
+    global server
+    if server is not None:
+        server.stop()
+        server = None
+
+    if worker_dispatcher is not None:
+        worker_dispatcher.shutdown()
+
+    try:
+        salt_journal.stop()
+    except Exception:
+        print_exc()
+
+atexit.register(unload)
+
+
 @OnClientActive
 def listener_on_client_active(index):
     player = Player(index)
@@ -321,6 +979,15 @@ def listener_on_client_disconnect(index):
     if motd_player is not None:
         player_manager.delete(motd_player)
 
+        # Only keep the salts of the players that are still on the server
+        salt_cache.pop(motd_player.communityid, None)
+
+
+@OnLevelShutdown
+def listener_on_level_shutdown():
+    # Database may be slow, so the game thread doesn't wait for it
+    salt_journal.request_flush()
+
 
 @OnLevelInit
 def listener_on_level_init(map_name):
@@ -1,86 +1,298 @@
+from json import dumps, loads
 from select import select
+from threading import Lock
+from traceback import print_exc
 
 from listeners.tick import GameThread
 
+from .framing import (
+    FLAG_CLOSE, FLAG_MORE, FrameReader, LEGACY_HEADER,
+    MAX_LEGACY_MESSAGE_LENGTH, MULTIPLEXED_HEADER, write_frame)
+from .serializers import DEFAULT_SERIALIZER, get_serializer, serializers
 
-CHUNK_SIZE = 4096
+
+# Negotiation message can't be confused with a regular message, and it's
+# always JSON-encoded
+NEGOTIATION_MAGIC = b'\x00MOTDPLAYER\x00'
+
+PROTOCOL_LEGACY = "legacy"
+PROTOCOL_MULTIPLEXED = "multiplexed"
+SUPPORTED_PROTOCOLS = (PROTOCOL_MULTIPLEXED, PROTOCOL_LEGACY)
+
+# Serializers that sites are allowed to choose, see set_allowed_serializers()
+allowed_serializers = set(serializers.keys())
+
+
+def set_allowed_serializers(names):
+    allowed_serializers.clear()
+    allowed_serializers.update(name for name in names if name in serializers)
+
+    # Sites that can't negotiate always use it anyway
+    allowed_serializers.add(DEFAULT_SERIALIZER)
 
 
 class ConnectionClose(Exception):
     pass
 
 
-class SockClient(GameThread):
-    def __init__(self, sock_server, sock, on_message_received=None):
-        super().__init__()
+class Channel:
+    """One of the logical connections multiplexed over a Connection.
+
+    Mimics SockClient interface, so SiteClient doesn't need to know
+    whether it talks over a channel or over a dedicated connection.
+    """
+    def __init__(self, sock_client, id_):
+        self._sock_client = sock_client
+        self.id = id_
+        self.on_message_received = None
+
+        self.running = True
+
+        # Chunks of the message that is being streamed to us
+        self.pending_chunks = []
+
+    @property
+    def serializer(self):
+        return self._sock_client.serializer
+
+    def send_message(self, message):
+        if not self.running:
+            raise ConnectionClose("Channel is closed")
+
+        self._sock_client.send_frame(self.id, message)
+
+    def send_stream(self, chunks, dispatcher=None):
+        """Send a message piece by piece as soon as its chunks are ready.
+
+        dispatcher is where session callbacks are run, chunks that can't
+        be produced right away are produced there.
+        """
+        if not self.running:
+            raise ConnectionClose("Channel is closed")
+
+        self._sock_client.stream_frames(self, chunks, dispatcher)
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self.running = False
+
+        self._sock_client.close_channel(self)
+
+
+class Connection:
+    """Protocol logic shared by all kinds of SRCDS-side connections.
+
+    Subclasses decide how the frames are actually written and when the
+    received data is fed to the reader.
+    """
+    def __init__(self, sock_server, sock, on_message_received=None,
+                 on_channel_opened=None):
 
         self._sock_server = sock_server
         self.sock = sock
         self.on_message_received = on_message_received
+        self.on_channel_opened = on_channel_opened
 
         self.running = False
-        self.callbacks = []
 
-    def _read_sock(self, length):
-        data = b''
-        while len(data) < length:
-            chunk = self.sock.recv(min(CHUNK_SIZE, length - len(data)))
-            if chunk == b'':
-                self._sock_server.remove_client(self)
-                self.stop()
-                return None
+        self.protocol = PROTOCOL_LEGACY
+        self.serializer = get_serializer()
+        self.channels = {}
+        self.reader = FrameReader(LEGACY_HEADER)
+
+    def _disconnect(self):
+        if not self.running:
+            return
+
+        self._sock_server.remove_client(self)
+        self.stop()
+
+    def _write_frame(self, header, fields, message):
+        raise NotImplementedError
 
-            data += chunk
+    def send_message(self, message):
+        length = len(message)
+        if length > MAX_LEGACY_MESSAGE_LENGTH:
+            raise ValueError("Message is too long ({} bytes) for legacy "
+                             "framing".format(length))
 
-        return data
+        self._write_frame(LEGACY_HEADER, (length, ), message)
 
-    def _write_sock(self, data):
-        total_sent = 0
-        while total_sent < len(data):
-            sent = self.sock.send(data[total_sent:])
-            if sent == 0:
-                self._sock_server.remove_client(self)
-                self.stop()
-                raise ConnectionClose("Sent zero bytes")
+    def send_stream(self, chunks, dispatcher=None):
+        # Legacy framing can't stream, so the whole message is assembled
+        self.send_message(b''.join(chunks))
 
-            total_sent += sent
+    def send_frame(self, channel_id, message, flags=0):
+        self._write_frame(
+            MULTIPLEXED_HEADER, (channel_id, flags, len(message)), message)
 
-    def receive_message(self):
-        # Parse message length - first 2 bytes
-        length_bytes = self._read_sock(2)
-        length = int.from_bytes(length_bytes, byteorder='big')
+    def stream_frames(self, channel, chunks, dispatcher=None):
+        # Writes block until the site takes the data, so every chunk is
+        # sent before the next one is produced
+        previous_chunk = None
+        for chunk in chunks:
+            if not chunk:
+                continue
 
-        # Receive the message
-        message = self._read_sock(length)
-        return message
+            if previous_chunk is not None:
+                self.send_frame(channel.id, previous_chunk, FLAG_MORE)
 
-    def send_message(self, message):
-        length = len(message)
-        length_bytes = length.to_bytes(2, byteorder='big')
-        self._write_sock(length_bytes + message)
+            previous_chunk = chunk
+
+        self.send_frame(channel.id, previous_chunk or b'')
+
+    def close_channel(self, channel):
+        if self.channels.pop(channel.id, None) is None:
+            return
+
+        if not self.running:
+            return
+
+        try:
+            self.send_frame(channel.id, b'', FLAG_CLOSE)
+        except ConnectionClose:
+            pass
+
+    def _negotiate(self, message):
+        request = loads(message[len(NEGOTIATION_MAGIC):].decode('utf-8'))
+
+        protocol = PROTOCOL_LEGACY
+        for protocol_ in request['protocols']:
+            if protocol_ in SUPPORTED_PROTOCOLS:
+                protocol = protocol_
+                break
+
+        serializer = DEFAULT_SERIALIZER
+        for serializer_ in request.get('serializers', ()):
+            if serializer_ in allowed_serializers:
+                serializer = serializer_
+                break
+
+        self.send_message(NEGOTIATION_MAGIC + dumps({
+            'protocol': protocol,
+            'serializer': serializer,
+        }).encode('utf-8'))
+
+        self.protocol = protocol
+        self.serializer = get_serializer(serializer)
+        if protocol == PROTOCOL_MULTIPLEXED:
+            self.reader.header = MULTIPLEXED_HEADER
+
+    def _on_frame_received(self, fields, message):
+        if self.protocol != PROTOCOL_MULTIPLEXED:
+            # Faulty exchange only takes its own connection down
+            try:
+                if message.startswith(NEGOTIATION_MAGIC):
+                    self._negotiate(message)
+
+                elif self.on_message_received is not None:
+                    self.on_message_received(message)
+
+            except Exception:
+                self._disconnect()
+                print_exc()
+
+            return
+
+        channel_id, flags, length = fields
+        if flags & FLAG_CLOSE:
+            channel = self.channels.pop(channel_id, None)
+            if channel is not None:
+                channel.running = False
+
+            return
+
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = Channel(self, channel_id)
+            if self.on_channel_opened is not None:
+                self.on_channel_opened(channel)
+
+        if flags & FLAG_MORE:
+            channel.pending_chunks.append(message)
+            return
+
+        if channel.pending_chunks:
+            channel.pending_chunks.append(message)
+            message = b''.join(channel.pending_chunks)
+            channel.pending_chunks.clear()
+
+        if channel.on_message_received is None:
+            return
+
+        # Don't let a single faulty exchange break all other channels
+        try:
+            channel.on_message_received(message)
+        except Exception:
+            channel.stop()
+            print_exc()
+
+    def _process_frames(self):
+        # A single read may bring several frames at once
+        while self.running:
+            frame = self.reader.next_frame()
+            if frame is None:
+                break
+
+            self._on_frame_received(*frame)
+
+    def _close_channels(self):
+        # Channels may be stopped from the worker threads meanwhile
+        for channel in tuple(self.channels.values()):
+            channel.running = False
+
+        self.channels.clear()
+
+    def stop(self):
+        raise NotImplementedError
+
+
+class SockClient(Connection, GameThread):
+    def __init__(self, sock_server, sock, on_message_received=None,
+                 on_channel_opened=None):
+
+        GameThread.__init__(self)
+        Connection.__init__(
+            self, sock_server, sock, on_message_received, on_channel_opened)
+
+        self.callbacks = []
+
+        self._write_lock = Lock()
+
+    def _write_frame(self, header, fields, message):
+        with self._write_lock:
+            try:
+                write_frame(self.sock, header, fields, message)
+
+            except OSError as e:
+                self._disconnect()
+                raise ConnectionClose(e)
 
     def run(self):
         self.running = True
 
-        r, w, e = select([self.sock], [], [])
         while self.running:
-            if self.sock in r:
-                message = self.receive_message()
-                if message is None:
-                    continue
+            try:
+                select([self.sock], [], [])
+                received = self.reader.fill(self.sock)
 
-                if self.on_message_received is not None:
-                    self.on_message_received(message)
+            except (OSError, ValueError):
+                received = 0
 
-            if self.running:
-                r, w, e = select([self.sock], [], [])
-            else:
+            if not received:
+                self._disconnect()
                 break
 
+            self._process_frames()
+
     def stop(self):
         if not self.running:
             return
 
         self.running = False
 
+        self._close_channels()
+
         self.sock.close()
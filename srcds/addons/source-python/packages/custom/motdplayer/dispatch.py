@@ -0,0 +1,188 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter, time
+from traceback import print_exc
+
+
+class DispatchStats:
+    def __init__(self):
+        self.dispatched = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.max_queue_length = 0
+        self.last_batch_size = 0
+        self.last_drain_time = 0.0
+
+    @property
+    def average_latency(self):
+        if not self.dispatched:
+            return 0.0
+
+        return self.total_latency / self.dispatched
+
+    def reset(self):
+        self.__init__()
+
+
+class TickDispatcher:
+    """Queue of site requests that is drained on the server tick.
+
+    Network threads only decode the requests and put them here, so session
+    callbacks always run on the game thread. Every tick processes as many
+    requests as fit into the time budget (but at least one, so the queue
+    can't stall), optionally capped by max_batch.
+    """
+    def __init__(self, time_budget=0.002, max_batch=0):
+        self.time_budget = time_budget
+        self.max_batch = max_batch
+        self.stats = DispatchStats()
+
+        self._queue = deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, callback, *args):
+        self._queue.append((perf_counter(), callback, args))
+
+        if len(self._queue) > self.stats.max_queue_length:
+            self.stats.max_queue_length = len(self._queue)
+
+    def drain(self):
+        if not self._queue:
+            return
+
+        started_at = perf_counter()
+        deadline = started_at + self.time_budget
+        processed = 0
+
+        while self._queue:
+            if self.max_batch and processed >= self.max_batch:
+                break
+
+            enqueued_at, callback, args = self._queue.popleft()
+
+            now = perf_counter()
+            latency = now - enqueued_at
+            self.stats.dispatched += 1
+            self.stats.total_latency += latency
+            if latency > self.stats.max_latency:
+                self.stats.max_latency = latency
+
+            try:
+                callback(*args)
+            except Exception:
+                print_exc()
+
+            processed += 1
+            if perf_counter() >= deadline:
+                break
+
+        self.stats.last_batch_size = processed
+        self.stats.last_drain_time = perf_counter() - started_at
+
+
+class _SerialQueue:
+    """Requests of one connection (or channel), processed in order."""
+    def __init__(self, executor):
+        self._executor = executor
+        self._queue = deque()
+        self._lock = Lock()
+        self._scheduled = False
+
+    def put(self, callback, *args):
+        with self._lock:
+            self._queue.append((callback, args))
+            if self._scheduled:
+                return
+
+            self._scheduled = True
+
+        self._executor.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._scheduled = False
+                    return
+
+                callback, args = self._queue.popleft()
+
+            try:
+                callback(*args)
+            except Exception:
+                print_exc()
+
+
+class WorkerDispatcher:
+    """Thread pool that site requests are processed on as they come.
+
+    Every connection and every channel gets its own queue (see queue()),
+    so its requests are still processed one after another, while a slow
+    session callback doesn't hold up the other channels of the same
+    connection or the reactor thread.
+    """
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def queue(self):
+        return _SerialQueue(self._executor)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class TimerWheel:
+    """Hashed timing wheel for the timers that are mostly not needed.
+
+    Scheduling is O(1) and can't be cancelled: a callback is supposed to
+    check whether it's still relevant (and reschedule itself if needed).
+    Deadlines are rounded up to the resolution. advance() is meant to be
+    called on every tick, but only does work once per resolution.
+    """
+    def __init__(self, resolution=1.0, size=512):
+        self.resolution = resolution
+        self._slots = [[] for x in range(size)]
+        self._current_tick = int(time() / resolution)
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+    def schedule(self, deadline, callback, *args):
+        tick = max(-int(-deadline // self.resolution), self._current_tick + 1)
+        self._slots[tick % len(self._slots)].append((tick, callback, args))
+
+    def advance(self, now=None):
+        target_tick = int((time() if now is None else now) / self.resolution)
+        if target_tick <= self._current_tick:
+            return
+
+        # If we're late for a whole revolution, every slot is visited once
+        size = len(self._slots)
+        steps = min(target_tick - self._current_tick, size)
+
+        expired = []
+        for step in range(1, steps + 1):
+            index = (self._current_tick + step) % size
+            slot = self._slots[index]
+            if not slot:
+                continue
+
+            remaining = []
+            for entry in slot:
+                if entry[0] <= target_tick:
+                    expired.append(entry)
+                else:
+                    remaining.append(entry)
+
+            self._slots[index] = remaining
+
+        self._current_tick = target_tick
+
+        for tick, callback, args in expired:
+            try:
+                callback(*args)
+            except Exception:
+                print_exc()
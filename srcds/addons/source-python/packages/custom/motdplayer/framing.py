@@ -0,0 +1,114 @@
+"""Framing codec shared by all connection types.
+
+Incoming data is received straight into a reusable buffer with
+recv_into, so reading a message costs one allocation (the resulting
+bytes object) no matter how many recv calls it took. Outgoing frames
+are passed to sendall, which doesn't copy the data on partial sends.
+"""
+from struct import Struct
+
+
+CHUNK_SIZE = 4096
+
+# Message length (2 bytes)
+LEGACY_HEADER = Struct('>H')
+MAX_LEGACY_MESSAGE_LENGTH = 65535
+
+# Channel ID (4 bytes) + flags (1 byte) + message length (4 bytes)
+MULTIPLEXED_HEADER = Struct('>IBI')
+
+# Message continues in the next frame of the same channel
+FLAG_MORE = 1
+
+# Channel is closed by the sender, everything that was received
+# for it but not completed yet should be dropped
+FLAG_CLOSE = 2
+
+# Smaller frames are sent with a single sendall call, bigger ones are not
+# worth copying just to glue the header to them
+COALESCE_THRESHOLD = 16384
+
+
+class FrameReader:
+    def __init__(self, header, size=CHUNK_SIZE):
+        # Header can be switched on the fly (after negotiation),
+        # length is always the last header field
+        self.header = header
+
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+        # Received data that is not parsed yet lies in [_start, _end)
+        self._start = 0
+        self._end = 0
+
+    def _reserve(self, size):
+        if self._start + size <= len(self._buffer):
+            return
+
+        pending = self._end - self._start
+        if size <= len(self._buffer):
+            # Enough room, just move pending data to the beginning
+            # (through a copy, because the regions may overlap)
+            self._buffer[:pending] = (
+                self._view[self._start:self._end].tobytes())
+        else:
+            buffer = bytearray(max(size, len(self._buffer) * 2))
+            buffer[:pending] = self._view[self._start:self._end]
+
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+
+        self._start = 0
+        self._end = pending
+
+    def fill(self, sock):
+        """Receive available data, return number of bytes (0 means EOF)."""
+        if self._end == len(self._buffer):
+            self._reserve(self._end - self._start + CHUNK_SIZE)
+
+        received = sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def next_frame(self):
+        """Return (header fields, message) if a complete frame is buffered."""
+        pending = self._end - self._start
+        if pending < self.header.size:
+            self._reserve(self.header.size)
+            return None
+
+        fields = self.header.unpack_from(self._buffer, self._start)
+        frame_size = self.header.size + fields[-1]
+        if pending < frame_size:
+            self._reserve(frame_size)
+            return None
+
+        message = self._view[
+            self._start + self.header.size:self._start + frame_size
+        ].tobytes()
+
+        self._start += frame_size
+        if self._start == self._end:
+            self._start = self._end = 0
+
+        return fields, message
+
+    def read_frame(self, sock):
+        """Block until a complete frame is received, None means EOF."""
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+
+            if not self.fill(sock):
+                return None
+
+
+def write_frame(sock, header, fields, message):
+    header_bytes = header.pack(*fields)
+    if len(message) < COALESCE_THRESHOLD:
+        sock.sendall(header_bytes + message)
+    else:
+        sock.sendall(header_bytes)
+        sock.sendall(message)
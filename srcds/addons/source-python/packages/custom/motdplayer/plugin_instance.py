@@ -1,4 +1,6 @@
-from . import send_page
+from . import (
+    register_server_data_handler, send_page, send_page_many,
+    unregister_server_data_handler)
 
 
 class PluginInstance:
@@ -12,3 +14,18 @@ class PluginInstance:
             player, self.plugin_id, page_id,
             callback, retargeting_callback, debug
         )
+
+    def send_page_many(self, players, page_id, callback_factory,
+                       retargeting_callback_factory=None, debug=False,
+                       spread=False):
+
+        return send_page_many(
+            players, self.plugin_id, page_id, callback_factory,
+            retargeting_callback_factory, debug, spread
+        )
+
+    def register_server_data_handler(self, handler):
+        register_server_data_handler(self.plugin_id, handler)
+
+    def unregister_server_data_handler(self):
+        unregister_server_data_handler(self.plugin_id)
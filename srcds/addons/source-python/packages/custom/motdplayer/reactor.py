@@ -0,0 +1,356 @@
+from collections import deque
+import selectors
+import socket
+from threading import get_ident, Lock
+from traceback import print_exc
+
+from listeners.tick import GameThread
+
+from .client import Connection, ConnectionClose
+from .framing import FLAG_MORE
+
+
+# Streamed messages are only produced while less than this many bytes
+# wait in the output buffer
+OUTPUT_HIGH_WATER = 65536
+
+
+class _Stream:
+    def __init__(self, channel, chunks, dispatcher):
+        self.channel = channel
+        self.chunks = iter(chunks)
+        self.dispatcher = dispatcher
+        self.previous_chunk = None
+
+        # Set while producing more chunks is waiting in the dispatcher
+        self.scheduled = False
+
+
+class ReactorConnection(Connection):
+    """Non-blocking connection driven by ReactorServer.
+
+    Frames can be sent from any thread: they're appended to the output
+    buffer, and the reactor thread writes them out when the socket
+    becomes writable.
+
+    Streamed messages are produced as the site takes them: once the output
+    buffer is filled up to OUTPUT_HIGH_WATER, the stream is resumed only
+    after the buffer has been written out. Chunks are produced on the
+    reactor thread, or by the dispatcher if the stream is given one.
+    """
+    def __init__(self, reactor, sock, on_message_received=None,
+                 on_channel_opened=None):
+
+        super().__init__(
+            reactor, sock, on_message_received, on_channel_opened)
+
+        self.running = True
+
+        self._reactor = reactor
+        self._output = bytearray()
+        self._output_lock = Lock()
+        self._streams = []
+        self.closing = False
+
+        sock.setblocking(False)
+
+    @property
+    def wants_write(self):
+        return bool(self._output)
+
+    def _write_frame(self, header, fields, message):
+        if not self.running:
+            raise ConnectionClose("Connection is closed")
+
+        with self._output_lock:
+            self._output += header.pack(*fields)
+            self._output += message
+
+        self._reactor.call_soon(self._reactor.update_events, self)
+
+    def stream_frames(self, channel, chunks, dispatcher=None):
+        stream = _Stream(channel, chunks, dispatcher)
+        with self._output_lock:
+            self._streams.append(stream)
+
+        # We're already on the thread the chunks should be produced on
+        self._produce(stream)
+
+    def _finish_stream(self, stream):
+        with self._output_lock:
+            if stream in self._streams:
+                self._streams.remove(stream)
+
+    def _produce(self, stream):
+        stream.scheduled = False
+
+        channel = stream.channel
+        try:
+            while channel.running and len(self._output) < OUTPUT_HIGH_WATER:
+                chunk = next(stream.chunks, None)
+                if chunk is None:
+                    self._finish_stream(stream)
+                    self.send_frame(channel.id, stream.previous_chunk or b'')
+                    return
+
+                if not chunk:
+                    continue
+
+                if stream.previous_chunk is not None:
+                    self.send_frame(
+                        channel.id, stream.previous_chunk, FLAG_MORE)
+
+                stream.previous_chunk = chunk
+
+        except ConnectionClose:
+            self._finish_stream(stream)
+            return
+
+        except Exception:
+            # Site will drop whatever part of the message it got
+            self._finish_stream(stream)
+            channel.stop()
+            print_exc()
+            return
+
+        if not channel.running:
+            self._finish_stream(stream)
+
+    def _resume_streams(self):
+        with self._output_lock:
+            if len(self._output) >= OUTPUT_HIGH_WATER:
+                return
+
+            streams = []
+            for stream in self._streams:
+                if stream.scheduled:
+                    continue
+
+                if stream.dispatcher is not None:
+                    stream.scheduled = True
+
+                streams.append(stream)
+
+        for stream in streams:
+            if stream.dispatcher is None:
+                self._produce(stream)
+            else:
+                stream.dispatcher.put(self._produce, stream)
+
+    def on_readable(self):
+        try:
+            received = self.reader.fill(self.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+
+        if not received:
+            self._disconnect()
+            return
+
+        self._process_frames()
+
+    def on_writable(self):
+        with self._output_lock:
+            try:
+                sent = self.sock.send(self._output)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self._output.clear()
+                sent = 0
+                self.closing = True
+
+            # Deleting from the beginning of a bytearray doesn't move the rest
+            del self._output[:sent]
+
+        if self.closing and not self._output:
+            self._reactor.close_connection(self)
+            return
+
+        self._resume_streams()
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self.running = False
+
+        self._close_channels()
+        with self._output_lock:
+            self._streams.clear()
+
+        # Whatever is already queued (e.g. the error status) should still
+        # reach the site before the socket is closed
+        self.closing = True
+        self._reactor.call_soon(self._reactor.update_events, self)
+
+
+class ReactorServer(GameThread):
+    """Single-threaded selectors-based alternative to SockServer.
+
+    One thread accepts, reads and writes all site connections, so the
+    number of threads doesn't grow with the number of open MOTDs.
+    """
+    def __init__(self, host, port, whitelist=(), on_client_accepted=None):
+        super().__init__()
+
+        self.running = False
+        self.clients = set()
+        self.whitelist = whitelist
+        self.on_client_accepted = on_client_accepted
+
+        # Restarted server binds the port while the old connections may
+        # still linger in TIME_WAIT
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+
+        self._selector = selectors.DefaultSelector()
+        self._thread_id = None
+
+        # Callbacks scheduled from other threads
+        self._callbacks = deque()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+
+    def call_soon(self, callback, *args):
+        if get_ident() == self._thread_id:
+            callback(*args)
+            return
+
+        self._callbacks.append((callback, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # Reactor is going to wake up anyways
+            pass
+
+    def update_events(self, client):
+        if client not in self.clients:
+            return
+
+        if client.closing and not client.wants_write:
+            self.close_connection(client)
+            return
+
+        events = selectors.EVENT_WRITE if client.wants_write else 0
+        if client.running:
+            events |= selectors.EVENT_READ
+
+        self._selector.modify(client.sock, events, client)
+
+    def close_connection(self, client):
+        if client not in self.clients:
+            return
+
+        self.clients.discard(client)
+        self._selector.unregister(client.sock)
+        client.sock.close()
+
+    def remove_client(self, client):
+        # Connection will be closed when it's done writing
+        pass
+
+    def _accept(self):
+        try:
+            client_sock, addr = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        if addr[0] not in self.whitelist:
+            client_sock.close()
+            return
+
+        client = ReactorConnection(
+            self, client_sock, on_channel_opened=self.on_client_accepted)
+
+        self.clients.add(client)
+        self._selector.register(client_sock, selectors.EVENT_READ, client)
+
+        if self.on_client_accepted is not None:
+            self.on_client_accepted(client)
+
+    def _run_callbacks(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while self._callbacks:
+            callback, args = self._callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                print_exc()
+
+    def _abort_connection(self, client):
+        try:
+            client.stop()
+        except Exception:
+            print_exc()
+
+        self.close_connection(client)
+
+    def run(self):
+        self._thread_id = get_ident()
+        self.running = True
+
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self._selector.register(self.sock, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+        while self.running:
+            for key, events in self._selector.select():
+                if key.fileobj is self.sock:
+                    try:
+                        self._accept()
+                    except Exception:
+                        print_exc()
+
+                elif key.fileobj is self._wakeup_r:
+                    self._run_callbacks()
+
+                else:
+                    # Whatever goes wrong with one of the connections,
+                    # the others are still served
+                    client = key.data
+                    try:
+                        if events & selectors.EVENT_READ and client.running:
+                            client.on_readable()
+
+                        if events & selectors.EVENT_WRITE:
+                            client.on_writable()
+
+                        self.update_events(client)
+
+                    except Exception:
+                        print_exc()
+                        self._abort_connection(client)
+
+                if not self.running:
+                    break
+
+        for client in tuple(self.clients):
+            client.stop()
+            self.close_connection(client)
+
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        self.sock.close()
+
+    def stop(self):
+        """Stop the reactor, return once the listening socket is closed."""
+        if not self.running:
+            return
+
+        self.call_soon(setattr, self, 'running', False)
+
+        # New server is usually bound to the same port right after
+        if get_ident() != self._thread_id:
+            self.join()
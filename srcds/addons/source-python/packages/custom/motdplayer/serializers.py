@@ -0,0 +1,114 @@
+"""Message serializers, negotiated per connection.
+
+"json" is always available. It's encoded with orjson or ujson when one
+of them is installed, which is a local detail: the other side still gets
+plain JSON. "msgpack" is more compact and is only offered when the
+msgpack package is installed.
+
+Messages that never change (like status replies) are encoded once and
+reused afterwards.
+"""
+from json import dumps, loads
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Serializer:
+    name = None
+
+    # Whether the message can be produced piece by piece as JSON text
+    streamable = False
+
+    def __init__(self):
+        self._constants = {}
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, message):
+        raise NotImplementedError
+
+    def _constant(self, key, value):
+        message = self._constants.get((key, value))
+        if message is None:
+            message = self._constants[(key, value)] = self.encode({
+                key: value,
+            })
+
+        return message
+
+    def action(self, action):
+        """Return encoded {'action': action} message."""
+        return self._constant('action', action)
+
+    def status(self, status):
+        """Return encoded {'status': status} message."""
+        return self._constant('status', status)
+
+
+class JSONSerializer(Serializer):
+    name = "json"
+    streamable = True
+
+    if orjson is not None:
+        def encode(self, obj):
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+        def decode(self, message):
+            return orjson.loads(message)
+
+    elif ujson is not None:
+        def encode(self, obj):
+            return ujson.dumps(obj).encode('utf-8')
+
+        def decode(self, message):
+            return ujson.loads(message.decode('utf-8'))
+
+    else:
+        def encode(self, obj):
+            return dumps(obj).encode('utf-8')
+
+        def decode(self, message):
+            return loads(message.decode('utf-8'))
+
+
+class MsgpackSerializer(Serializer):
+    name = "msgpack"
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, message):
+        # Non-str keys are allowed, JSON would have turned them into str
+        return msgpack.unpackb(message, raw=False, strict_map_key=False)
+
+
+DEFAULT_SERIALIZER = JSONSerializer.name
+
+serializers = {
+    JSONSerializer.name: JSONSerializer(),
+}
+
+# The most preferred one goes first
+SUPPORTED_SERIALIZERS = (JSONSerializer.name, )
+
+if msgpack is not None:
+    serializers[MsgpackSerializer.name] = MsgpackSerializer()
+    SUPPORTED_SERIALIZERS = (MsgpackSerializer.name, ) + SUPPORTED_SERIALIZERS
+
+
+def get_serializer(name=DEFAULT_SERIALIZER):
+    return serializers[name]
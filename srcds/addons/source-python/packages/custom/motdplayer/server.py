@@ -11,15 +11,18 @@ class SockServer(GameThread):
         super().__init__()
 
         self.running = False
-        self.clients = []
+        self.clients = set()
         self.whitelist = whitelist
         self.on_client_accepted = on_client_accepted
 
+        # Restarted server binds the port while the old connections may
+        # still linger in TIME_WAIT
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((host, port))
 
     def remove_client(self, client):
-        self.clients.remove(client)
+        self.clients.discard(client)
 
     def run(self):
         self.running = True
@@ -34,8 +37,11 @@ class SockServer(GameThread):
                     client_sock.close()
                     continue
 
-                client = SockClient(self, client_sock)
-                self.clients.append(client)
+                client = SockClient(
+                    self, client_sock,
+                    on_channel_opened=self.on_client_accepted)
+
+                self.clients.add(client)
                 if self.on_client_accepted is not None:
                     self.on_client_accepted(client)
 
@@ -48,7 +54,7 @@ class SockServer(GameThread):
             return
 
         self.running = False
-        for client in self.clients:
+        for client in tuple(self.clients):
             client.stop()
 
         self.sock.close()
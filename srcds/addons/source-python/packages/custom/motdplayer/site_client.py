@@ -1,16 +1,91 @@
-from json import dumps, loads
+from hashlib import sha1
+from inspect import isgenerator
+from json import dumps
+from time import time
+from traceback import print_exc
+
+from .client import ConnectionClose
+
+
+# How much of a streamed answer is buffered before it's sent out
+STREAM_CHUNK_SIZE = 16384
+
+# Session callback that takes known_hash argument may return it instead of
+# the answer if the page already has it
+NOT_MODIFIED = object()
+
+
+def get_custom_data_hash(data):
+    """Hash the site gives the answers it sends to the page."""
+    return sha1(dumps(
+        data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ).hexdigest()
+
+
+def _is_unchanged(answer, known_hash):
+    """Check if the page already has the answer (streams are never)."""
+    if not known_hash:
+        return False
+
+    if answer is NOT_MODIFIED:
+        return True
+
+    if not isinstance(answer, dict):
+        return False
+
+    try:
+        return get_custom_data_hash(answer) == known_hash
+
+    # Let encoding fail where it normally does
+    except (TypeError, ValueError):
+        return False
+
+
+def _stream_custom_data(items):
+    """Encode (key, value) pairs yielded by a session callback.
+
+    The resulting message is the same as if the callback returned a dict,
+    but it's produced chunk by chunk instead of being built in memory.
+    """
+    chunk = [b'{"status": "OK", "custom_data": {']
+    chunk_size = len(chunk[0])
+    separator = b''
+
+    for key, value in items:
+        if not isinstance(key, str):
+            raise TypeError("Expected type of custom data key: 'str', got "
+                            "'{}' instead".format(type(key)))
+
+        item = (separator + dumps(key).encode('utf-8') + b': ' +
+                dumps(value).encode('utf-8'))
+        separator = b', '
+
+        chunk.append(item)
+        chunk_size += len(item)
+
+        if chunk_size >= STREAM_CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk = []
+            chunk_size = 0
+
+    chunk.append(b'}}')
+    yield b''.join(chunk)
 
 
 class SiteClient:
-    def __init__(self, client):
+    def __init__(self, client, dispatcher=None):
         super().__init__()
 
         self.client = client
+        self.dispatcher = dispatcher
         self.motd_player = None
         self.session = None
 
         client.on_message_received = self._on_message_received
 
+    def _send_status(self, status):
+        self.client.send_message(self.client.serializer.status(status))
+
     def end_communication(self):
         if self.client is None:
             return
@@ -18,20 +93,126 @@ class SiteClient:
         self.client.stop()
         self.client = None
 
+    def _send_answer(self, answer):
+        if not isinstance(answer, dict):
+            self._send_status("ERROR_CALLBACK_INVALID_ANSWER")
+            self.end_communication()
+            raise TypeError("Excepted type of custom data: 'dict', got "
+                            "'{}' instead".format(type(answer)))
+
+        try:
+            message = self.client.serializer.encode({
+                'status': "OK",
+                'custom_data': answer,
+            })
+
+        except Exception as e:
+            self._send_status("ERROR_CALLBACK_INVALID_ANSWER2")
+            self.end_communication()
+            raise e
+
+        try:
+            self.client.send_message(message)
+
+        except ValueError as e:
+            # Only multiplexed protocol can carry that much data
+            self._send_status("ERROR_ANSWER_TOO_LARGE")
+            self.end_communication()
+            raise e
+
     def _on_message_received(self, message):
-        from . import player_manager, SessionClosedException
+        response = self.client.serializer.decode(message)
+
+        # Let the dispatcher decide when it's the right time to process it
+        if self.dispatcher is not None:
+            self.dispatcher.put(self._process_request, response)
+        else:
+            self._process_request(response)
+
+    def _poll(self, timeout):
+        from . import MAX_POLL_TIMEOUT, session_timers
+
+        client = self.client
+
+        def waiter(data):
+            try:
+                client.send_message(client.serializer.encode({
+                    'status': "OK",
+                    'custom_data': data,
+                }))
+
+            except ConnectionClose:
+                pass
 
-        response = loads(message.decode('utf-8'))
+            except Exception:
+                print_exc()
+
+        def on_timeout(session):
+            if session.cancel_wait(waiter):
+                waiter({})
+
+        session = self.session
+        session.wait_for_push(waiter)
+        session_timers.schedule(
+            time() + min(timeout, MAX_POLL_TIMEOUT), on_timeout, session)
+
+    def _process_request(self, response):
+        from . import (
+            player_manager, server_data_handlers, SessionClosedException)
+
+        # Site might have gone while the request was waiting in the queue
+        if self.client is None:
+            return
 
         if response['action'] == "end_communication":
             self.end_communication()
             return
 
+        # Site is done with the current player, but wants to keep
+        # the connection to reuse it for other requests
+        if response['action'] == "release":
+            self.motd_player = None
+            self.session = None
+            return
+
+        if response['action'] == "ping":
+            self._send_status("OK")
+            return
+
+        # Server-wide request, it's not made on behalf of any player
+        if response['action'] == "receive_server_data":
+            if self.motd_player is not None:
+                self._send_status("ERROR_IDENTITY_SET")
+                self.end_communication()
+                raise RuntimeError("Site tried to send server data after "
+                                   "setting identity")
+
+            handler = server_data_handlers.get(response['plugin_id'])
+            if handler is None:
+                self._send_status("ERROR_UNKNOWN_PLUGIN")
+                self.end_communication()
+                return
+
+            try:
+                answer = handler(response['custom_data'])
+
+                if answer is None:
+                    answer = {}
+
+                elif isgenerator(answer):
+                    answer = dict(answer)
+
+            except Exception as e:
+                self._send_status("ERROR_CALLBACK_EXCEPTION")
+                self.end_communication()
+                raise e
+
+            self._send_answer(answer)
+            return
+
         if response['action'] == "set_identity":
             if self.motd_player is not None:
-                self.client.send_message(dumps({
-                    'status': "ERROR_ALREADY_SET",
-                }).encode('utf-8'))
+                self._send_status("ERROR_ALREADY_SET")
                 self.end_communication()
                 raise RuntimeError("Site tried to set identity twice")
 
@@ -39,9 +220,7 @@ class SiteClient:
                 response['steamid'])
 
             if motd_player is None:
-                self.client.send_message(dumps({
-                    'status': "ERROR_UNKNOWN_STEAMID"
-                }).encode('utf-8'))
+                self._send_status("ERROR_UNKNOWN_STEAMID")
                 self.end_communication()
 
             else:
@@ -52,9 +231,7 @@ class SiteClient:
                 )
 
                 if session is None:
-                    self.client.send_message(dumps({
-                        'status': "ERROR_SESSION_CLOSED",
-                    }).encode('utf-8'))
+                    self._send_status("ERROR_SESSION_CLOSED")
                     self.end_communication()
 
                 else:
@@ -64,14 +241,10 @@ class SiteClient:
                     if (new_salt is None or
                             motd_player.confirm_new_salt(new_salt)):
 
-                        self.client.send_message(dumps({
-                            'status': "OK",
-                        }).encode('utf-8'))
+                        self._send_status("OK")
 
                     else:
-                        self.client.send_message(dumps({
-                            'status': "ERROR_SALT_REFUSED",
-                        }).encode('utf-8'))
+                        self._send_status("ERROR_SALT_REFUSED")
 
                         try:
                             session.error("SALT_REFUSED")
@@ -91,23 +264,17 @@ class SiteClient:
                     response['new_page_id'])
 
             except SessionClosedException:
-                self.client.send_message(dumps({
-                    'status': "ERROR_SESSION_CLOSED2",
-                }).encode('utf-8'))
+                self._send_status("ERROR_SESSION_CLOSED2")
                 self.end_communication()
                 return
 
             except Exception as e:
-                self.client.send_message(dumps({
-                    'status': "ERROR_RETARGETING_CALLBACK_EXCEPTION",
-                }).encode('utf-8'))
+                self._send_status("ERROR_RETARGETING_CALLBACK_EXCEPTION")
                 self.end_communication()
                 raise e
 
             if new_callbacks is None:
-                self.client.send_message(dumps({
-                    'status': "ERROR_RETARGETING_REFUSED",
-                }).encode('utf-8'))
+                self._send_status("ERROR_RETARGETING_REFUSED")
                 self.end_communication()
                 return
 
@@ -123,19 +290,104 @@ class SiteClient:
                     raise ValueError
 
             except (TypeError, ValueError):
-                self.client.send_message(dumps({
-                    'status': "ERROR_RETARGETING_CALLBACK_INVALID_ANSWER",
-                }).encode('utf-8'))
+                self._send_status("ERROR_RETARGETING_CALLBACK_INVALID_ANSWER")
                 self.end_communication()
                 return
 
             self.session.callback = new_callback
             self.session.retargeting_callback = new_retargeting_callback
 
-            self.client.send_message(dumps({
-                'status': "OK",
-            }).encode('utf-8'))
-            self.end_communication()
+            self._send_status("OK")
+            return
+
+        if response['action'] == "poll":
+            if self.motd_player is None:
+                self.end_communication()
+                raise RuntimeError("Site tried to poll prior to "
+                                   "setting identity")
+
+            if self.session.closed:
+                self._send_status("ERROR_SESSION_CLOSED2")
+                self.end_communication()
+                return
+
+            self._poll(float(response['timeout']))
+            return
+
+        if response['action'] == "receive_custom_data_batch":
+            if self.motd_player is None:
+                self.end_communication()
+                raise RuntimeError("Site tried to send custom "
+                                   "data prior to setting identity")
+
+            # A faulty item doesn't fail the others
+            results = []
+            custom_data_batch = response['custom_data_batch']
+            known_hashes = list(response.get('known_hash_batch') or ())
+            known_hashes += [None] * (
+                len(custom_data_batch) - len(known_hashes))
+
+            for custom_data, known_hash in zip(
+                    custom_data_batch, known_hashes):
+
+                try:
+                    answer = self.session.receive(custom_data, known_hash)
+
+                    if answer is None:
+                        answer = {}
+
+                    elif isgenerator(answer):
+                        answer = dict(answer)
+
+                except SessionClosedException:
+                    self._send_status("ERROR_SESSION_CLOSED2")
+                    self.end_communication()
+                    return
+
+                except Exception:
+                    results.append({
+                        'status': "ERROR_CALLBACK_EXCEPTION",
+                    })
+                    print_exc()
+                    continue
+
+                if _is_unchanged(answer, known_hash):
+                    results.append({
+                        'status': "OK",
+                        'not_modified': True,
+                    })
+                    continue
+
+                if not isinstance(answer, dict):
+                    results.append({
+                        'status': "ERROR_CALLBACK_INVALID_ANSWER",
+                    })
+                    continue
+
+                results.append({
+                    'status': "OK",
+                    'custom_data': answer,
+                })
+
+            try:
+                message = self.client.serializer.encode({
+                    'status': "OK",
+                    'custom_data_batch': results,
+                })
+
+            except Exception as e:
+                self._send_status("ERROR_CALLBACK_INVALID_ANSWER2")
+                self.end_communication()
+                raise e
+
+            try:
+                self.client.send_message(message)
+
+            except ValueError as e:
+                self._send_status("ERROR_ANSWER_TOO_LARGE")
+                self.end_communication()
+                raise e
+
             return
 
         if response['action'] == "receive_custom_data":
@@ -144,45 +396,54 @@ class SiteClient:
                 raise RuntimeError("Site tried to send custom "
                                    "data prior to setting identity")
 
+            known_hash = response.get('known_hash')
             try:
-                answer = self.session.receive(response['custom_data'])
+                answer = self.session.receive(
+                    response['custom_data'], known_hash)
 
             except SessionClosedException:
-                self.client.send_message(dumps({
-                    'status': "ERROR_SESSION_CLOSED2",
-                }).encode('utf-8'))
+                self._send_status("ERROR_SESSION_CLOSED2")
                 self.end_communication()
                 return
 
             except Exception as e:
-                self.client.send_message(dumps({
-                    'status': "ERROR_CALLBACK_EXCEPTION",
-                }).encode('utf-8'))
+                self._send_status("ERROR_CALLBACK_EXCEPTION")
                 self.end_communication()
                 raise e
 
             if answer is None:
                 answer = {}
 
-            if not isinstance(answer, dict):
-                self.client.send_message(dumps({
-                    'status': "ERROR_CALLBACK_INVALID_ANSWER",
-                }).encode('utf-8'))
-                self.end_communication()
-                raise TypeError("Excepted type of custom data: 'dict', got "
-                                "'{}' instead".format(type(answer)))
-
-            try:
-                message = dumps({
+            # Page keeps what it has, and SRCDS doesn't send it again
+            if _is_unchanged(answer, known_hash):
+                self.client.send_message(self.client.serializer.encode({
                     'status': "OK",
-                    'custom_data': answer,
-                }).encode('utf-8')
+                    'not_modified': True,
+                }))
+                return
 
-            except Exception as e:
-                self.client.send_message(dumps({
-                    'status': "ERROR_CALLBACK_INVALID_ANSWER2",
-                }).encode('utf-8'))
-                self.end_communication()
-                raise e
+            # Only JSON can be produced piece by piece
+            if (isgenerator(answer) and
+                    not self.client.serializer.streamable):
 
-            self.client.send_message(message)
+                try:
+                    answer = dict(answer)
+
+                except Exception as e:
+                    self._send_status("ERROR_CALLBACK_EXCEPTION")
+                    self.end_communication()
+                    raise e
+
+            if isgenerator(answer):
+                try:
+                    self.client.send_stream(
+                        _stream_custom_data(answer), self.dispatcher)
+
+                except Exception as e:
+                    # Site will drop whatever part of the answer it got
+                    self.end_communication()
+                    raise e
+
+                return
+
+            self._send_answer(answer)